@@ -0,0 +1,43 @@
+"""
+Add restriction policy version counter
+The counter is bumped by a statement trigger on every change of nodes or networks tables,
+so that the webservice knows when to reload its in-memory restriction policy map
+"""
+
+from yoyo import step
+
+__depends__ = {'20230321_01_1YK2c-trigger-function-networks'}
+
+steps = [
+    step("""
+    CREATE TABLE public.restriction_policy_version (
+    version bigint NOT NULL,
+    updated_at timestamp with time zone DEFAULT now());
+    INSERT INTO public.restriction_policy_version (version) VALUES (0);
+    """,
+    "DROP TABLE public.restriction_policy_version"),
+    step("""
+    CREATE OR REPLACE FUNCTION bump_restriction_policy_version()
+    RETURNS TRIGGER AS $$
+    BEGIN
+        UPDATE public.restriction_policy_version SET version = version + 1, updated_at = now();
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql SECURITY DEFINER;
+    """,
+    "DROP FUNCTION bump_restriction_policy_version()"),
+    step("""
+    CREATE TRIGGER nodes_policy_version_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON public.nodes
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_restriction_policy_version();
+    """,
+    "DROP TRIGGER nodes_policy_version_trigger ON public.nodes"),
+    step("""
+    CREATE TRIGGER networks_policy_version_trigger
+    AFTER INSERT OR UPDATE OR DELETE ON public.networks
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION bump_restriction_policy_version();
+    """,
+    "DROP TRIGGER networks_policy_version_trigger ON public.networks")
+]
@@ -0,0 +1,39 @@
+"""
+Add monthly rollup table
+Statistics summed up by node, month, network and country, used by the webservice to answer
+requests that need neither station, location nor channel
+Fill rollup table from dataselect_stats table
+"""
+
+from yoyo import step
+
+__depends__ = {'20261017_01_Rp7kQ-add-restriction-policy-version'}
+
+steps = [
+    step("""
+    CREATE TABLE public.dataselect_stats_monthly (
+    node_id integer NOT NULL,
+    date date NOT NULL,
+    network character varying(6) NOT NULL,
+    country character varying(2) NOT NULL,
+    bytes bigint,
+    nb_reqs bigint,
+    nb_successful_reqs bigint,
+    nb_failed_reqs bigint,
+    clients public.hll,
+    updated_at timestamp with time zone DEFAULT now(),
+    PRIMARY KEY (node_id, date, network, country),
+    CONSTRAINT fk_networks
+      FOREIGN KEY(node_id, network)
+      REFERENCES public.networks(node_id, name));
+    """,
+    "DROP TABLE public.dataselect_stats_monthly"),
+    step("""
+    INSERT INTO public.dataselect_stats_monthly
+    (node_id, date, network, country, bytes, nb_reqs, nb_successful_reqs, nb_failed_reqs, clients)
+    SELECT node_id, date, network, coalesce(country, ''),
+    sum(bytes), sum(nb_reqs), sum(nb_successful_reqs), sum(nb_failed_reqs), hll_union_agg(clients)
+    FROM public.dataselect_stats
+    GROUP BY node_id, date, network, coalesce(country, '');
+    """)
+]
@@ -0,0 +1,35 @@
+"""
+Add statistics change watermarks
+One row per node and month holding a version taken from a sequence, bumped by the webservice
+whenever a submission touches the statistics of that node and month
+Fill watermarks table from dataselect_stats table
+"""
+
+from yoyo import step
+
+__depends__ = {'20261017_02_Mw4cT-add-monthly-rollup'}
+
+steps = [
+    step("""
+    CREATE SEQUENCE public.stats_watermarks_version_seq;
+    """,
+    "DROP SEQUENCE public.stats_watermarks_version_seq"),
+    step("""
+    CREATE TABLE public.stats_watermarks (
+    node_id integer NOT NULL,
+    date date NOT NULL,
+    version bigint NOT NULL DEFAULT nextval('public.stats_watermarks_version_seq'),
+    updated_at timestamp with time zone DEFAULT now(),
+    PRIMARY KEY (node_id, date),
+    CONSTRAINT fk_nodes
+      FOREIGN KEY(node_id)
+      REFERENCES public.nodes(id));
+    """,
+    "DROP TABLE public.stats_watermarks"),
+    step("""
+    INSERT INTO public.stats_watermarks (node_id, date, updated_at)
+    SELECT node_id, date, max(greatest(created_at, updated_at))
+    FROM public.dataselect_stats
+    GROUP BY node_id, date;
+    """)
+]
@@ -0,0 +1,28 @@
+"""
+Add pattern indexes on stream identification columns
+text_pattern_ops btree indexes, usable by the webservice exact code and prefix range conditions
+whatever the collation of the database
+"""
+
+from yoyo import step
+
+__depends__ = {'20261017_03_Kd8sZ-add-stats-watermarks'}
+
+steps = [
+    step("""
+    CREATE INDEX dataselect_stats_network_idx ON public.dataselect_stats (network text_pattern_ops, date);
+    """,
+    "DROP INDEX public.dataselect_stats_network_idx"),
+    step("""
+    CREATE INDEX dataselect_stats_station_idx ON public.dataselect_stats (station text_pattern_ops, date);
+    """,
+    "DROP INDEX public.dataselect_stats_station_idx"),
+    step("""
+    CREATE INDEX dataselect_stats_channel_idx ON public.dataselect_stats (channel text_pattern_ops, date);
+    """,
+    "DROP INDEX public.dataselect_stats_channel_idx"),
+    step("""
+    CREATE INDEX dataselect_stats_monthly_network_idx ON public.dataselect_stats_monthly (network text_pattern_ops, date);
+    """,
+    "DROP INDEX public.dataselect_stats_monthly_network_idx")
+]
@@ -0,0 +1,135 @@
+"""
+Partition dataselect_stats by month
+dataselect_stats becomes a table partitioned by range of date, with one partition per month named dataselect_stats_YYYY_MM
+Add create_dataselect_stats_partition function, creating the partition of a month if it does not exist,
+called ahead of time by eida_statsman and on demand by the webservice before ingesting statistics
+Fill partitions from the former dataselect_stats table, statistics without date cannot be partitioned and are dropped
+The privileges granted on the former table, such as those of the webservice role, are granted again on the new one
+"""
+
+from yoyo import step
+
+__depends__ = {'20261017_04_Tp3nV-add-pattern-indexes'}
+
+
+def copy_grants(source, target):
+    """
+    Returns the statement granting on the target table the privileges granted on the source table
+    """
+    return f"""
+    DO $$
+    DECLARE
+        g record;
+    BEGIN
+        FOR g IN SELECT a.privilege_type, a.is_grantable,
+                        CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END AS grantee
+                 FROM pg_class c CROSS JOIN LATERAL aclexplode(c.relacl) a LEFT JOIN pg_roles r ON r.oid = a.grantee
+                 WHERE c.oid = 'public.{source}'::regclass
+        LOOP
+            EXECUTE format('GRANT %s ON public.{target} TO %s', g.privilege_type, g.grantee)
+                    || CASE WHEN g.is_grantable THEN ' WITH GRANT OPTION' ELSE '' END;
+        END LOOP;
+    END
+    $$;
+    """
+
+steps = [
+    step("""
+    CREATE OR REPLACE FUNCTION public.create_dataselect_stats_partition(month date)
+    RETURNS text AS $$
+    DECLARE
+        first_day date := date_trunc('month', month);
+        partition text := 'dataselect_stats_' || to_char(first_day, 'YYYY_MM');
+    BEGIN
+        IF to_regclass('public.' || partition) IS NULL THEN
+            EXECUTE format('CREATE TABLE public.%I PARTITION OF public.dataselect_stats FOR VALUES FROM (%L) TO (%L)',
+                           partition, first_day, (first_day + interval '1 month')::date);
+        END IF;
+        RETURN partition;
+    END;
+    $$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public, pg_temp;
+    """,
+    "DROP FUNCTION public.create_dataselect_stats_partition(date)"),
+    step("""
+    ALTER TABLE public.dataselect_stats RENAME TO dataselect_stats_unpartitioned;
+    ALTER TABLE public.dataselect_stats_unpartitioned RENAME CONSTRAINT uniq_stat TO uniq_stat_unpartitioned;
+    DROP TRIGGER dataselect_stats_trigger ON public.dataselect_stats_unpartitioned;
+    DROP INDEX public.dataselect_stats_network_idx, public.dataselect_stats_station_idx, public.dataselect_stats_channel_idx;
+
+    CREATE TABLE public.dataselect_stats (
+    node_id integer,
+    date date NOT NULL,
+    network character varying(6),
+    station character varying(5),
+    location character varying(2),
+    channel character varying(3),
+    country character varying(2),
+    bytes bigint,
+    nb_reqs integer,
+    nb_successful_reqs integer,
+    nb_failed_reqs integer,
+    clients public.hll(11,5),
+    created_at timestamp with time zone DEFAULT now(),
+    updated_at timestamp with time zone,
+    CONSTRAINT uniq_stat UNIQUE (node_id, date, network, station, location, channel, country),
+    CONSTRAINT fk_nodes FOREIGN KEY (node_id) REFERENCES public.nodes(id),
+    CONSTRAINT fk_network FOREIGN KEY (node_id, network) REFERENCES public.networks(node_id, name))
+    PARTITION BY RANGE (date);
+
+    CREATE INDEX dataselect_stats_network_idx ON public.dataselect_stats (network text_pattern_ops, date);
+    CREATE INDEX dataselect_stats_station_idx ON public.dataselect_stats (station text_pattern_ops, date);
+    CREATE INDEX dataselect_stats_channel_idx ON public.dataselect_stats (channel text_pattern_ops, date);
+
+    CREATE TRIGGER dataselect_stats_trigger
+    BEFORE INSERT ON public.dataselect_stats
+    FOR EACH ROW
+    EXECUTE FUNCTION insert_network_if_not_exists();
+
+    SELECT public.create_dataselect_stats_partition(month)
+    FROM (SELECT DISTINCT date_trunc('month', date)::date AS month FROM public.dataselect_stats_unpartitioned WHERE date IS NOT NULL) m;
+    SELECT public.create_dataselect_stats_partition(month::date)
+    FROM generate_series(date_trunc('month', now()), date_trunc('month', now()) + interval '3 months', interval '1 month') AS month;
+
+    INSERT INTO public.dataselect_stats SELECT * FROM public.dataselect_stats_unpartitioned WHERE date IS NOT NULL;
+    """ + copy_grants('dataselect_stats_unpartitioned', 'dataselect_stats') + """
+    DROP TABLE public.dataselect_stats_unpartitioned;
+    """,
+    """
+    ALTER TABLE public.dataselect_stats RENAME TO dataselect_stats_partitioned;
+    ALTER TABLE public.dataselect_stats_partitioned RENAME CONSTRAINT uniq_stat TO uniq_stat_partitioned;
+    DROP TRIGGER dataselect_stats_trigger ON public.dataselect_stats_partitioned;
+    DROP INDEX public.dataselect_stats_network_idx, public.dataselect_stats_station_idx, public.dataselect_stats_channel_idx;
+
+    CREATE TABLE public.dataselect_stats (
+    node_id integer,
+    date date,
+    network character varying(6),
+    station character varying(5),
+    location character varying(2),
+    channel character varying(3),
+    country character varying(2),
+    bytes bigint,
+    nb_reqs integer,
+    nb_successful_reqs integer,
+    nb_failed_reqs integer,
+    clients public.hll(11,5),
+    created_at timestamp with time zone DEFAULT now(),
+    updated_at timestamp with time zone,
+    CONSTRAINT uniq_stat UNIQUE (node_id, date, network, station, location, channel, country),
+    CONSTRAINT fk_nodes FOREIGN KEY (node_id) REFERENCES public.nodes(id),
+    CONSTRAINT fk_network FOREIGN KEY (node_id, network) REFERENCES public.networks(node_id, name));
+
+    CREATE INDEX dataselect_stats_network_idx ON public.dataselect_stats (network text_pattern_ops, date);
+    CREATE INDEX dataselect_stats_station_idx ON public.dataselect_stats (station text_pattern_ops, date);
+    CREATE INDEX dataselect_stats_channel_idx ON public.dataselect_stats (channel text_pattern_ops, date);
+
+    CREATE TRIGGER dataselect_stats_trigger
+    BEFORE INSERT ON public.dataselect_stats
+    FOR EACH ROW
+    EXECUTE FUNCTION insert_network_if_not_exists();
+
+    INSERT INTO public.dataselect_stats SELECT * FROM public.dataselect_stats_partitioned;
+    """ + copy_grants('dataselect_stats_partitioned', 'dataselect_stats') + """
+    DROP TABLE public.dataselect_stats_partitioned;
+    """)
+]
@@ -0,0 +1,34 @@
+"""
+Add ingestion jobs
+One row per payload accepted asynchronously by the webservice, whose body waits in its spool directory
+until an ingestion worker claims the job with SELECT ... FOR UPDATE SKIP LOCKED
+"""
+
+from yoyo import step
+
+__depends__ = {'20261017_05_Pq6mD-partition-dataselect-stats'}
+
+steps = [
+    step("""
+    CREATE TABLE public.ingest_jobs (
+    id bigserial PRIMARY KEY,
+    node_id integer NOT NULL,
+    operation text NOT NULL CHECK (operation IN ('POST', 'PUT')),
+    path text NOT NULL,
+    size bigint,
+    status text NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    message text,
+    attempts integer NOT NULL DEFAULT 0,
+    created_at timestamp with time zone DEFAULT now(),
+    started_at timestamp with time zone,
+    finished_at timestamp with time zone,
+    CONSTRAINT fk_nodes
+      FOREIGN KEY(node_id)
+      REFERENCES public.nodes(id));
+    """,
+    "DROP TABLE public.ingest_jobs"),
+    step("""
+    CREATE INDEX ingest_jobs_pending_idx ON public.ingest_jobs (node_id, id) WHERE status IN ('queued', 'running');
+    """,
+    "DROP INDEX public.ingest_jobs_pending_idx"),
+]
@@ -0,0 +1,16 @@
+"""
+Widen payloads hash
+The hash becomes a 128-bit fingerprint of the statistics of the payload, the sum modulo 2^128 of the
+128-bit mmh3 hashes of their canonical forms, which does not fit a bigint
+Former 32-bit hashes are kept as they are, and no longer match resubmitted payloads
+"""
+
+from yoyo import step
+
+__depends__ = {'20261017_06_Hq2wB-add-ingest-jobs'}
+
+steps = [
+    step("ALTER TABLE public.payloads ALTER COLUMN hash TYPE numeric(39, 0)",
+         # fingerprints do not fit back, they are dropped
+         "ALTER TABLE public.payloads ALTER COLUMN hash TYPE bigint USING CASE WHEN hash BETWEEN -9223372036854775808 AND 9223372036854775807 THEN hash::bigint END")
+]
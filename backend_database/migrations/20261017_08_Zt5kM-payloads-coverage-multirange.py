@@ -0,0 +1,44 @@
+"""
+Store payloads coverage as a multirange of days
+payloads.coverage becomes a datemultirange, with a GiST index on node_id and coverage, so that the webservice
+finds the payloads of a node overlapping the coverage of a new payload with one indexed lookup
+The coverage view generates the days of the union of the coverages of each node instead of unnesting every array
+Needs postgresql 14 and the btree_gist extension
+"""
+
+from yoyo import step
+
+__depends__ = {'20261017_07_Vn8cR-widen-payloads-hash'}
+
+steps = [
+    step("CREATE EXTENSION IF NOT EXISTS btree_gist"),
+    step("DROP VIEW coverage",
+         "CREATE OR REPLACE VIEW coverage AS SELECT a.name AS node, unnest(b.stats) AS stat_day FROM (SELECT nodes.id,nodes.name FROM nodes) a LEFT JOIN (SELECT node_id, array_agg(splitup) as stats FROM (select node_id, unnest(coverage) splitup FROM payloads ) splitup group by 1) b ON a.id=b.node_id;"),
+    step("""
+    ALTER TABLE public.payloads ADD COLUMN coverage_days datemultirange;
+    UPDATE public.payloads p SET coverage_days = (
+        SELECT coalesce(range_agg(daterange(d, d, '[]')), '{}') FROM unnest(p.coverage) AS d
+    );
+    ALTER TABLE public.payloads DROP COLUMN coverage;
+    ALTER TABLE public.payloads RENAME COLUMN coverage_days TO coverage;
+    """,
+    """
+    ALTER TABLE public.payloads ADD COLUMN coverage_days date[];
+    UPDATE public.payloads p SET coverage_days = (
+        SELECT array_agg(d::date ORDER BY d) FROM unnest(p.coverage) AS r, generate_series(lower(r), upper(r) - 1, interval '1 day') AS d
+    );
+    ALTER TABLE public.payloads DROP COLUMN coverage;
+    ALTER TABLE public.payloads RENAME COLUMN coverage_days TO coverage;
+    """),
+    step("CREATE INDEX payloads_coverage_idx ON public.payloads USING gist (node_id, coverage)",
+         "DROP INDEX public.payloads_coverage_idx"),
+    step("""
+    CREATE OR REPLACE VIEW coverage AS
+    SELECT n.name AS node, d::date AS stat_day
+    FROM nodes n
+    LEFT JOIN (SELECT node_id, range_agg(coverage) AS days FROM payloads GROUP BY node_id) c ON c.node_id = n.id
+    LEFT JOIN LATERAL unnest(c.days) AS r ON true
+    LEFT JOIN LATERAL generate_series(lower(r), upper(r) - 1, interval '1 day') AS d ON true;
+    """,
+    "DROP VIEW coverage"),
+]
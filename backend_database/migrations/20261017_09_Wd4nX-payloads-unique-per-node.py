@@ -0,0 +1,19 @@
+"""
+Make payloads unique per node
+A payload is a duplicate only if the same node already submitted it: two nodes may submit identical statistics
+"""
+
+from yoyo import step
+
+__depends__ = {'20261017_08_Zt5kM-payloads-coverage-multirange'}
+
+steps = [
+    step("""
+    ALTER TABLE public.payloads DROP CONSTRAINT uniq_payload;
+    ALTER TABLE public.payloads ADD CONSTRAINT uniq_payload UNIQUE (node_id, hash);
+    """,
+    """
+    ALTER TABLE public.payloads DROP CONSTRAINT uniq_payload;
+    ALTER TABLE public.payloads ADD CONSTRAINT uniq_payload UNIQUE (hash);
+    """)
+]
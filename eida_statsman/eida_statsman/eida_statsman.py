@@ -9,7 +9,7 @@ import smtplib
 from email.message import EmailMessage
 import ssl
 import click
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from .model import Node, Token, Network
 
@@ -166,6 +166,36 @@ def networks_policy(ctx, nodeid, netname, policy):
     ctx.obj['session'].commit()
 
 
+@click.group()
+@click.pass_context
+def partitions(ctx):
+    click.echo("Statistics partitions management")
+
+@click.command(name='list')
+@click.pass_context
+def partitions_list(ctx):
+    click.echo("Listing partitions of dataselect_stats")
+    for (name, bounds) in ctx.obj['session'].execute(text("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'public.dataselect_stats'::regclass ORDER BY c.relname""")):
+        click.echo(f"{name}: {bounds}")
+
+@click.command(name='create', help="Create the monthly partitions of dataselect_stats from the given month (default current month) up to some months ahead.")
+@click.pass_context
+@click.option('--start', '-s', help="First month (YYYY-MM)", type=click.DateTime(formats=["%Y-%m"]))
+@click.option('--months-ahead', '-m', help="Number of months to create after the first one", type=int, default=3, show_default=True)
+def partitions_create(ctx, start, months_ahead):
+    first = (start or datetime.now()).date().replace(day=1)
+    months = [date(first.year + (first.month - 1 + i) // 12, (first.month - 1 + i) % 12 + 1, 1) for i in range(months_ahead + 1)]
+    if ctx.obj['noop']:
+        click.echo(f"Would create partitions of months {', '.join(str(m)[:7] for m in months)}")
+        return
+    for month in months:
+        name = ctx.obj['session'].execute(text("SELECT public.create_dataselect_stats_partition(:month)"), {'month': month}).scalar()
+        click.echo(f"Partition {name} ready")
+    ctx.obj['session'].commit()
+
+
 @click.group()
 @click.pass_context
 def tokens(ctx):
@@ -252,12 +282,15 @@ nodes.add_command(nodes_policy)
 networks.add_command(networks_list)
 networks.add_command(networks_group)
 networks.add_command(networks_policy)
+partitions.add_command(partitions_list)
+partitions.add_command(partitions_create)
 tokens.add_command(tokens_list)
 tokens.add_command(tokens_add)
 tokens.add_command(tokens_rev)
 tokens.add_command(tokens_mv)
 cli.add_command(nodes)
 cli.add_command(networks)
+cli.add_command(partitions)
 cli.add_command(tokens)
 
 if __name__ == '__main__':
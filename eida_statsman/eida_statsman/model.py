@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-from sqlalchemy import Column, Sequence, String, Date, Integer, ForeignKey, BigInteger, DateTime, Boolean
+from sqlalchemy import Column, Sequence, String, Date, Integer, ForeignKey, DateTime, Boolean, Numeric
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import func
@@ -63,5 +63,5 @@ class Payload(Base):
     __tablename__ = 'payloads'
     id = Column(Integer, Sequence('payloads_id_seq'), primary_key=True)
     node_id = Column(Integer, ForeignKey('nodes.id'))
-    stats_hash = Column(BigInteger) # For storing mmh3 hash
+    stats_hash = Column(Numeric(39, 0)) # For storing the 128-bit fingerprint of the statistics
     created_at = Column(DateTime())
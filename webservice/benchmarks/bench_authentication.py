@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the per-request token verification cost of /dataselect/restricted
+
+Before: GPG context created for every request, then signature verified
+After, cold: shared GPG context, signature verified (first request with a token file)
+After, warm: token found in the verified-token cache
+Tokens are signed with a throwaway key of a temporary keyring, so that the benchmark does not need the EAS key
+
+Usage: PYTHONPATH=. python benchmarks/bench_authentication.py [iterations]
+"""
+
+import json
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import gnupg
+from webob import Request
+from ws_eidastats import helper_functions
+from ws_eidastats.helper_functions import check_authentication, token_cache
+
+
+def signed_token(gnupghome):
+    """
+    Returns a token file signed like the ones of the EIDA authentication system
+    """
+    gpg = gnupg.GPG(gnupghome=gnupghome)
+    key = gpg.gen_key(gpg.gen_key_input(key_type='RSA', key_length=2048, name_email='bench@example.org', no_protection=True))
+    token = {'valid_until': (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%S.%fZ'), 'cn': 'Bench',
+             'memberof': '/epos/alparray;/epos', 'sn': 'Mark', 'mail': 'bench@example.org', 'expiration': '1d'}
+    return str(gpg.sign(json.dumps(token), keyid=key.fingerprint)).encode('utf-8')
+
+
+def check_authentication_before(request):
+    """
+    Verifies the token the way check_authentication did before the shared context and the token cache
+    """
+    gpg = gnupg.GPG(gnupghome=helper_functions.GNUPGHOME)
+    if gpg.verify(request.body.decode()):
+        token = helper_functions.TOKEN_RE.search(str(request.body)).groupdict()["token"]
+        return dict([i for i in kv.split(":", 1)] for kv in token.replace('"', "").replace(" ", "").split(","))
+    return {'Failed_message': 'Invalid token or no token file provided'}
+
+
+def timed(label, function, iterations):
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    elapsed = (time.perf_counter() - t0) / iterations
+    print(f"{label:<40} {elapsed * 1e3:10.3f} ms/request")
+    return elapsed
+
+
+def cold(request):
+    token_cache.clear()
+    return check_authentication(request)
+
+
+def main(iterations):
+    gnupghome = tempfile.mkdtemp()
+    try:
+        body = signed_token(gnupghome)
+        helper_functions.GNUPGHOME = gnupghome
+        request = Request.blank('/dataselect/restricted', method='POST', body=body)
+        assert 'memberof' in check_authentication_before(request) and 'memberof' in cold(request)
+
+        print(f"Token verification, {iterations} iterations")
+        before = timed('before: new GPG context', lambda: check_authentication_before(request), iterations)
+        after_cold = timed('after: shared context, cold token cache', lambda: cold(request), iterations)
+        after_warm = timed('after: warm token cache', lambda: check_authentication(request), iterations * 100)
+        print(f"{'speedup, cold token cache':<40} {before / after_cold:10.1f} x")
+        print(f"{'speedup, warm token cache':<40} {before / after_warm:10.1f} x")
+    finally:
+        shutil.rmtree(gnupghome, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the coverage overlap lookup of incoming payloads, with 10 years of daily payloads per node
+
+Before: coverage as date[] without index, overlapping days found with && and unnest over the payloads of the node
+After: coverage as datemultirange with a GiST index on (node_id, coverage), overlapping days found with OVERLAP_SQL
+Both tables are temporary, the temporary payloads table shadowing the real one so that OVERLAP_SQL runs as is.
+The database needs postgresql 14 and the btree_gist extension (see the payloads coverage migration).
+
+Usage: DBURI=postgresql://... PYTHONPATH=. python benchmarks/bench_coverage.py [nodes] [iterations]
+"""
+
+import random
+import sys
+import time
+from datetime import date, timedelta
+from sqlalchemy.sql import text
+from ws_eidastats.helper_functions import Session
+from ws_eidastats.ingest import OVERLAP_SQL, coverage_runs, multirange
+
+
+YEARS = 10
+
+SETUP_SQL = """
+CREATE TEMPORARY TABLE payloads_before AS
+SELECT n AS node_id, ARRAY[date '2014-01-01' + d] AS coverage
+FROM generate_series(1, %(nodes)s) AS n, generate_series(0, %(days)s - 1) AS d;
+ANALYZE payloads_before;
+CREATE TEMPORARY TABLE payloads AS
+SELECT row_number() OVER () AS id, node_id, datemultirange(daterange(coverage[1], coverage[1], '[]')) AS coverage
+FROM payloads_before;
+CREATE INDEX ON payloads USING gist (node_id, coverage);
+ANALYZE payloads;
+"""
+
+BEFORE_SQL = text("""
+        SELECT DISTINCT d
+        FROM payloads_before p, unnest(p.coverage) AS d
+        WHERE p.node_id = :node_id AND p.coverage && CAST(:days AS date[]) AND d = ANY(CAST(:days AS date[]))
+        ORDER BY 1
+        """)
+
+
+def timed(session, sql, values, iterations):
+    t0 = time.perf_counter()
+    for v in values[:iterations]:
+        result = session.execute(sql, v).all()
+    return ((time.perf_counter() - t0) / iterations, result)
+
+
+def main(nodes, iterations):
+    session = Session()
+    try:
+        connection = session.connection()
+    except Exception as e:
+        print(f"Benchmark skipped, database not reachable: {e}")
+        return
+    days = 365 * YEARS
+    print(f"Creating {nodes} nodes x {days} daily payloads")
+    connection.exec_driver_sql(SETUP_SQL, {'nodes': nodes, 'days': days})
+    print(f"{'new payload coverage':<24} {'before (ms)':>12} {'after (ms)':>12}")
+    for (label, length, offset) in [('one day, overlapping', 1, 0), ('one month, overlapping', 30, 0),
+                                    ('one month, new', 30, days), ('one year, overlapping', 365, 0)]:
+        requests = []
+        for _ in range(iterations):
+            first = date(2014, 1, 1) + timedelta(days=random.randrange(days - length) + offset)
+            covered = [first + timedelta(days=d) for d in range(length)]
+            requests.append((random.randint(1, nodes), covered))
+        before = [{'node_id': n, 'days': covered} for (n, covered) in requests]
+        after = [{'node_id': n, 'coverage': multirange(coverage_runs(covered)), 'id': 0} for (n, covered) in requests]
+        (t_before, r_before) = timed(session, BEFORE_SQL, before, iterations)
+        (t_after, r_after) = timed(session, OVERLAP_SQL, after, iterations)
+        assert coverage_runs(row[0] for row in r_before) == [tuple(row) for row in r_after]
+        print(f"{label:<24} {t_before * 1e3:12.2f} {t_after * 1e3:12.2f}")
+    session.rollback()
+    session.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50, int(sys.argv[2]) if len(sys.argv) > 2 else 200)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark of the statistics ingestion, in rows/s
+
+Before: one INSERT ... ON CONFLICT per statistic, sent with executemany, as add_stat did before the ingest engine
+After: statistics streamed with COPY into the staging table, then merged with a single INSERT ... SELECT ... ON CONFLICT
+Each variant inserts the statistics, then adds them again, as a node posting twice the same months would do.
+Everything runs in a transaction rolled back at the end, with a throwaway BENCH node.
+
+Usage: DBURI=postgresql://... PYTHONPATH=. python benchmarks/bench_ingest.py [rows]
+"""
+
+import sys
+import time
+from sqlalchemy.sql import text
+from ws_eidastats.helper_functions import Session
+from ws_eidastats.ingest import stage_statistics, merge_statistics
+
+
+NODE_SQL = text("INSERT INTO nodes (name, restriction_policy) VALUES ('BENCH', false) RETURNING id")
+PARTITION_SQL = text("SELECT public.create_dataselect_stats_partition(CAST(:date AS date))")
+CLEAR_SQL = text("DELETE FROM dataselect_stats WHERE node_id = :node_id")
+HLL_SQL = text("SELECT hll_add(hll_empty(11, 5), hll_hash_integer(1))::text")
+
+BEFORE_SQL = text("""
+        INSERT INTO dataselect_stats
+        (
+          node_id, date, network, station, location, channel, country,
+          bytes, nb_reqs, nb_successful_reqs, nb_failed_reqs, clients
+        )
+        VALUES (:node_id, :date, :network, :station, :location, :channel, :country,
+        :bytes, :nb_reqs, :nb_successful_reqs, :nb_failed_reqs, :clients)
+        ON CONFLICT ON CONSTRAINT uniq_stat DO UPDATE SET
+        bytes = EXCLUDED.bytes + dataselect_stats.bytes,
+        nb_reqs = EXCLUDED.nb_reqs + dataselect_stats.nb_reqs,
+        nb_successful_reqs = EXCLUDED.nb_successful_reqs + dataselect_stats.nb_successful_reqs,
+        nb_failed_reqs = EXCLUDED.nb_failed_reqs + dataselect_stats.nb_failed_reqs,
+        clients = EXCLUDED.clients || dataselect_stats.clients,
+        updated_at = now()
+        """)
+
+
+def statistics(rows, hll):
+    """
+    Returns synthetic normalized rows of a month, in the column order of the staging table
+    """
+    return [('2020-01-01', f"N{i % 50:02}", f"ST{i // 50 % 1000:03}", '00', ('HHZ', 'HHN', 'HHE', 'BHZ')[i // 50000 % 4],
+             ('FR', 'GR', 'IT', '')[i % 4], 1000 + i, 3, 2, 1, hll) for i in range(rows)]
+
+
+def before(session, node_id, rows):
+    keys = ['date', 'network', 'station', 'location', 'channel', 'country', 'bytes', 'nb_reqs', 'nb_successful_reqs',
+            'nb_failed_reqs', 'clients']
+    session.execute(BEFORE_SQL, [dict(zip(keys, row), node_id=node_id) for row in rows])
+
+
+def after(session, node_id, rows):
+    stage_statistics(session, rows)
+    merge_statistics(session, node_id, 'POST')
+    # the staging table is dropped on commit, which the benchmark never does
+    session.execute(text("DROP TABLE dataselect_stats_staging"))
+
+
+def timed(label, function, session, node_id, rows):
+    session.execute(CLEAR_SQL, {'node_id': node_id})
+    results = []
+    for step in ('insert', 'update'):
+        t0 = time.perf_counter()
+        function(session, node_id, rows)
+        elapsed = time.perf_counter() - t0
+        results.append(len(rows) / elapsed)
+        print(f"{label:<10} {step:<8} {elapsed:10.2f} s {len(rows) / elapsed:12.0f} rows/s")
+    return results
+
+
+def main(rows):
+    session = Session()
+    try:
+        session.connection()
+    except Exception as e:
+        print(f"Benchmark skipped, database not reachable: {e}")
+        return
+    try:
+        node_id = session.execute(NODE_SQL).scalar()
+        session.execute(PARTITION_SQL, {'date': '2020-01-01'})
+        data = statistics(rows, session.execute(HLL_SQL).scalar())
+        print(f"Ingesting {rows} statistics twice")
+        old = timed('before', before, session, node_id, data)
+        new = timed('after', after, session, node_id, data)
+        for (step, o, n) in zip(('insert', 'update'), old, new):
+            print(f"{'speedup':<10} {step:<8} {n / o:10.1f} x")
+    finally:
+        session.rollback()
+        session.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the stream identification filters against a large synthetic statistics table
+
+Before: every filter value matched with LIKE ANY, as the views did before the pattern compiler
+After: exact codes matched with = ANY, prefixes with range scans and general patterns with ranged LIKE
+Patterns with a leading wildcard are still matched with LIKE ANY, so that the unanchored cases measure the sequential
+scan they cost, which only the date range of the request bounds through partition pruning
+The synthetic table is a temporary copy of the dataselect_stats columns with text_pattern_ops indexes
+
+Usage: DBURI=postgresql://... PYTHONPATH=. python benchmarks/bench_patterns.py [rows] [iterations]
+"""
+
+import sys
+import time
+from ws_eidastats.helper_functions import Session
+from ws_eidastats.query_compiler import pattern, pattern_condition, pattern_params, pattern_values
+
+
+CASES = [('exact', 'channel', ['HHZ']), ('prefix', 'channel', ['HH%']), ('general', 'channel', ['H_Z']),
+         ('unanchored', 'channel', ['%HZ']), ('unanchored', 'channel', ['_HZ', '%Z']),
+         ('exact', 'station', ['ST042', 'ST777']), ('prefix', 'station', ['ST04%']), ('unanchored', 'station', ['%042'])]
+
+SETUP_SQL = """
+CREATE TEMPORARY TABLE s AS
+SELECT date '2020-01-01' + (i %% 48) * interval '1 month' AS date,
+    'N' || lpad((i %% 50)::text, 2, '0') AS network,
+    'ST' || lpad((i %% 1000)::text, 3, '0') AS station,
+    '00' AS location,
+    (ARRAY['HH', 'BH', 'EH', 'LH', 'SH'])[1 + i %% 5] || (ARRAY['Z', 'N', 'E'])[1 + (i / 5) %% 3] AS channel,
+    i %% 1000 AS nb_reqs
+FROM generate_series(1, %(rows)s) AS i;
+CREATE INDEX ON s (station text_pattern_ops, date);
+CREATE INDEX ON s (channel text_pattern_ops, date);
+ANALYZE s;
+"""
+
+
+def statement(condition, params):
+    sql = f"SELECT count(*), sum(nb_reqs) FROM s WHERE {condition}"
+    for (param, typ) in sorted(params, key=lambda x: -len(x[0])):
+        sql = sql.replace(f':{param}', f'CAST(%({param})s AS {typ})')
+    return sql
+
+
+def timed(connection, sql, values, iterations):
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        connection.exec_driver_sql(sql, values).all()
+    return (time.perf_counter() - t0) / iterations
+
+
+def main(rows, iterations):
+    session = Session()
+    try:
+        connection = session.connection()
+    except Exception as e:
+        print(f"Benchmark skipped, database not reachable: {e}")
+        return
+    print(f"Creating synthetic table of {rows} rows")
+    connection.exec_driver_sql(SETUP_SQL, {'rows': rows})
+    print(f"{'case':<12} {'filter':<10} {'values':<20} {'before (ms)':>12} {'after (ms)':>12}")
+    for (case, name, values) in CASES:
+        before = statement(f"s.{name} LIKE ANY(:{name})", [(name, 'text[]')])
+        p = pattern(values)
+        after = statement(pattern_condition(name, p), pattern_params(name, p))
+        t_before = timed(connection, before, {name: values}, iterations)
+        t_after = timed(connection, after, pattern_values(name, values), iterations)
+        print(f"{case:<12} {name:<10} {','.join(values):<20} {t_before * 1e3:12.2f} {t_after * 1e3:12.2f}")
+    session.rollback()
+    session.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000000, int(sys.argv[2]) if len(sys.argv) > 2 else 20)
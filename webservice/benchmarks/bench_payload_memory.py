@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Peak memory of reading a gzip compressed /submit payload, up to the CSV fed to COPY
+
+Before: body decompressed and loaded at once with json.loads, then normalized into a full list of rows
+After: body decompressed and parsed incrementally, statistics checked, normalized, fingerprinted and serialized in batches
+The database is not involved: the CSV produced for COPY is read and dropped as COPY would consume it.
+
+Usage: PYTHONPATH=. python benchmarks/bench_payload_memory.py [statistics]
+"""
+
+import gzip
+import io
+import json
+import sys
+import time
+import tracemalloc
+import mmh3
+from webob import Request
+from ws_eidastats.ingest import CsvRows, Fingerprint, normalized_rows
+from ws_eidastats.payload import PayloadReader, body_stream
+
+
+def payload(count):
+    stats = ({'month': f"2023-{i % 12 + 1:02}-01", 'network': f"N{i % 50:02}", 'station': f"ST{i % 1000:03}",
+              'location': '00', 'channel': 'HHZ', 'country': 'FR', 'bytes': i, 'nb_requests': 3,
+              'nb_successful_requests': 2, 'nb_unsuccessful_requests': 1,
+              'clients': f"\\x{mmh3.hash128(str(i)):032x}"} for i in range(count))
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(b'{"generated_at": "2023-06-01", "version": "1.0", "days_coverage": ["2023-05-01"], "stats": [')
+        for (i, stat) in enumerate(stats):
+            f.write((', ' if i else '').encode() + json.dumps(stat).encode())
+        f.write(b']}')
+    return out.getvalue()
+
+
+def consume(rows):
+    source = CsvRows(rows)
+    while source.read(1 << 16):
+        pass
+    return source.count
+
+
+def before(body):
+    data = json.loads(gzip.decompress(body))
+    mmh3.hash(str(data['stats']))
+    return consume(list(normalized_rows(data['stats'])))
+
+
+def after(body):
+    request = Request.blank('/submit', method='POST', body=body, headers={'Content-Encoding': 'gzip'})
+    data = PayloadReader(body_stream(request)).payload
+    return consume(Fingerprint().rows(normalized_rows(data['stats'])))
+
+
+def measured(label, function, body):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    count = function(body)
+    elapsed = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{label:<8} {count:10} statistics {elapsed:8.2f} s {peak / 2**20:10.1f} MiB peak")
+    return peak
+
+
+def main(count):
+    body = payload(count)
+    print(f"Payload of {count} statistics, {len(body) / 2**20:.1f} MiB compressed")
+    old = measured('before', before, body)
+    new = measured('after', after, body)
+    print(f"{'ratio':<8} {old / new:10.1f} x less memory")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
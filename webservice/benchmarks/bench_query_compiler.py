@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the per-request statement build and plan overhead of the dataselect endpoints
+
+Build: SQLAlchemy statement built and compiled for every request (before), against the cached
+statement of the request shape (after)
+Plan: statement parsed and planned at every execution (before), against the prepared statement
+of the connection (after), on a time window without statistics so that execution time is negligible
+The plan benchmark is skipped if the database given by DBURI is not reachable
+
+Usage: DBURI=postgresql://... PYTHONPATH=. python benchmarks/bench_query_compiler.py [iterations]
+"""
+
+import sys
+import time
+from sqlalchemy import or_, and_, not_, case, false, cast, BigInteger, literal_column
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.sql import func
+from ws_eidastats.model import Node, DataselectStat, Network
+from ws_eidastats.helper_functions import Session
+from ws_eidastats.query_compiler import shape, compile_shape, bound_values, execute
+
+
+PARAMS = {'start': '2999-01-01', 'end': '2999-12-01', 'network': ['G%', 'FR'], 'station': ['A%'], 'channel': ['HH_'],
+          'country': ['FR', 'GR'], 'level': 'channel', 'details': ['month', 'country']}
+MEMBEROF = ['/epos/alparray']
+
+
+def orm_statement(param_value_dict):
+    """
+    Builds the statement the way the views did before the query compiler
+    """
+    stats = DataselectStat
+    sqlreq = OrmSession().query(stats).join(Node).with_entities()
+    sqlreq = sqlreq.join(Network, and_(Network.node_id == stats.node_id, Network.name == stats.network))
+    hidden = and_(func.coalesce(Node.restriction_policy != Network.inverted_policy, false()),
+                  not_(func.coalesce(Network.eas_group.in_(MEMBEROF), false())))
+    columns = [(Node.name, 'name', 'Other'), (stats.network, 'network', 'Other'), (stats.station, 'station', '*'),
+               (stats.location, 'location', '*'), (stats.channel, 'channel', '*')]
+    columns = [(case((hidden, literal_column(f"'{other}'")), else_=col), label) for (col, label, other) in columns]
+    sqlreq = sqlreq.add_columns(stats.date)
+    for (col, label) in columns:
+        sqlreq = sqlreq.add_columns(col.label(label))
+    sqlreq = sqlreq.add_columns(stats.country)
+    sqlreq = sqlreq.add_columns(cast(func.sum(stats.nb_reqs), BigInteger).label('nb_reqs'),
+                cast(func.sum(stats.nb_successful_reqs), BigInteger).label('nb_successful_reqs'),
+                func.sum(stats.bytes).label('bytes'),
+                literal_column('ceil(hll_cardinality(hll_union_agg(dataselect_stats.clients)))::bigint').label('clients_cardinality'))
+    sqlreq = sqlreq.filter(stats.date >= param_value_dict['start'])
+    sqlreq = sqlreq.filter(stats.date <= param_value_dict['end'])
+    for (key, col) in [('network', stats.network), ('station', stats.station), ('channel', stats.channel)]:
+        multiOR = or_(False)
+        for value in param_value_dict[key]:
+            multiOR = or_(multiOR, col.like(value))
+        sqlreq = sqlreq.filter(multiOR)
+    sqlreq = sqlreq.filter(stats.country.in_(param_value_dict['country']))
+    for (col, _) in columns:
+        sqlreq = sqlreq.group_by(col)
+    sqlreq = sqlreq.group_by(stats.date, stats.country).order_by(stats.date)
+    return sqlreq.statement.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True})
+
+
+def compiled_statement(param_value_dict):
+    """
+    Builds the statement with the query compiler
+    """
+    query = compile_shape(shape(param_value_dict, hidden='restricted'))
+    return query, bound_values(query, param_value_dict, memberof=MEMBEROF)
+
+
+def timed(label, function, iterations):
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    elapsed = (time.perf_counter() - t0) / iterations
+    print(f"{label:<40} {elapsed * 1e6:10.1f} us/request")
+    return elapsed
+
+
+def main(iterations):
+    print(f"Statement build, {iterations} iterations")
+    before = timed('before: SQLAlchemy build and compile', lambda: orm_statement(PARAMS), iterations)
+    after = timed('after: cached shape', lambda: compiled_statement(PARAMS), iterations)
+    print(f"{'speedup':<40} {before / after:10.1f} x")
+
+    session = Session()
+    try:
+        connection = session.connection()
+    except Exception as e:
+        print(f"Plan benchmark skipped, database not reachable: {e}")
+        return
+    (query, values) = compiled_statement(PARAMS)
+    sql = str(orm_statement(PARAMS))
+    print(f"\nStatement plan and execution on an empty time window, {iterations} iterations")
+    before = timed('before: parsed and planned every time', lambda: connection.exec_driver_sql(sql.replace('%', '%%')).all(), iterations)
+    after = timed('after: prepared statement', lambda: execute(session, query, values).all(), iterations)
+    print(f"{'speedup':<40} {before / after:10.1f} x")
+    session.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
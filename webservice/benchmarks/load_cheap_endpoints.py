@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Local load test of the tail latency of cheap endpoints under concurrent heavy queries
+
+Keeps a number of clients running slow aggregations of all networks over ten years, while probing /nodes and
+/_health sequentially, then prints latency percentiles of the probes
+Heavy queries must succeed: the run fails if any of them is not answered with 200
+Run it against the WSGI server and the ASGI entry point to compare them, with the result cache disabled so that
+heavy queries are run every time, for instance:
+    EIDASTATS_CACHE_SIZE=0 waitress-serve --threads 8 --call ws_eidastats:main        (or gunicorn --paste development.ini)
+    EIDASTATS_CACHE_SIZE=0 uvicorn ws_eidastats.asgi:app --port 6544
+
+Usage: python benchmarks/load_cheap_endpoints.py URL [heavy clients] [probes]
+"""
+
+import sys
+import threading
+import time
+import urllib.request
+from urllib.error import URLError, HTTPError
+
+# public requests may not go below network level
+HEAVY = '/dataselect/public?start=2015-01&end=2025-12&level=network&details=month,country'
+CHEAP = ['/nodes', '/_health']
+
+
+def get(url):
+    """
+    Returns the latency and the status of a GET of the given url, None if it got no response
+    """
+    t0 = time.perf_counter()
+    status = None
+    try:
+        with urllib.request.urlopen(url, timeout=600) as response:
+            status = response.status
+            while response.read(65536):
+                pass
+    except HTTPError as e:
+        status = e.code
+        print(f"{url}: {e}")
+    except URLError as e:
+        print(f"{url}: {e}")
+    return (time.perf_counter() - t0, status)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def main(base_url, heavy_clients, probes):
+    stop = threading.Event()
+    heavy_latencies = []
+    heavy_statuses = []
+
+    def heavy_client():
+        while not stop.is_set():
+            (latency, status) = get(base_url + HEAVY)
+            heavy_latencies.append(latency)
+            heavy_statuses.append(status)
+
+    threads = [threading.Thread(target=heavy_client, daemon=True) for _ in range(heavy_clients)]
+    for thread in threads:
+        thread.start()
+    # let the heavy queries occupy the server
+    time.sleep(2)
+
+    latencies = {path: [] for path in CHEAP}
+    for i in range(probes):
+        path = CHEAP[i % len(CHEAP)]
+        latencies[path].append(get(base_url + path)[0])
+        time.sleep(0.05)
+    stop.set()
+    assert heavy_statuses and all(status == 200 for status in heavy_statuses), \
+        f"heavy requests must succeed, got statuses {sorted(set(heavy_statuses), key=str)}"
+
+    print(f"{heavy_clients} concurrent heavy clients, {len(heavy_latencies)} heavy requests completed during the probes")
+    print(f"{'endpoint':<12} {'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10} {'max (ms)':>10}")
+    for (path, values) in latencies.items():
+        print(f"{path:<12} " + ' '.join(f"{percentile(values, p) * 1e3:10.1f}" for p in [50, 95, 99, 100]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1].rstrip('/'), int(sys.argv[2]) if len(sys.argv) > 2 else 32, int(sys.argv[3]) if len(sys.argv) > 3 else 200)
@@ -16,16 +16,39 @@ dev_requires = [
     'webtest',
 ]
 
+# Optional asynchronous read path, see ws_eidastats.asgi
+asgi_requires = [
+    'sqlalchemy[asyncio]',
+    'psycopg',
+    'uvicorn',
+]
+
+# Optional arrow and parquet output formats
+arrow_requires = [
+    'pyarrow',
+]
+
+# Optional zstd response compression
+zstd_requires = [
+    'zstandard',
+]
+
 setup(
     name='ws_eidastats',
     packages=['ws_eidastats'],
     install_requires=requires,
     extras_require={
         'dev': dev_requires,
+        'asgi': asgi_requires,
+        'arrow': arrow_requires,
+        'zstd': zstd_requires,
     },
     entry_points={
         'paste.app_factory': [
             'main = ws_eidastats:main'
         ],
+        'console_scripts': [
+            'eidastats_ingest_worker = ws_eidastats.ingest_worker:main'
+        ],
     },
 )
@@ -30,6 +30,13 @@ CREATE EXTENSION IF NOT EXISTS hll WITH SCHEMA public;
 COMMENT ON EXTENSION hll IS 'type for storing hyperloglog data';
 
 
+--
+-- Name: btree_gist; Type: EXTENSION; Schema: -; Owner: -
+--
+
+CREATE EXTENSION IF NOT EXISTS btree_gist WITH SCHEMA public;
+
+
 SET default_tablespace = '';
 
 SET default_table_access_method = heap;
@@ -40,7 +47,7 @@ SET default_table_access_method = heap;
 
 CREATE TABLE public.dataselect_stats (
     node_id integer,
-    date date,
+    date date NOT NULL,
     network character varying(6),
     station character varying(5),
     location character varying(2),
@@ -53,11 +60,108 @@ CREATE TABLE public.dataselect_stats (
     clients public.hll,
     created_at timestamp with time zone DEFAULT now(),
     updated_at timestamp with time zone
-);
+) PARTITION BY RANGE (date);
 
 
 ALTER TABLE public.dataselect_stats OWNER TO postgres;
 
+--
+-- Name: create_dataselect_stats_partition; Type: FUNCTION; Schema: public; Owner: postgres
+--
+
+CREATE FUNCTION public.create_dataselect_stats_partition(month date) RETURNS text
+    LANGUAGE plpgsql SECURITY DEFINER
+    SET search_path TO public, pg_temp
+    AS $$
+DECLARE
+    first_day date := date_trunc('month', month);
+    partition text := 'dataselect_stats_' || to_char(first_day, 'YYYY_MM');
+BEGIN
+    IF to_regclass('public.' || partition) IS NULL THEN
+        EXECUTE format('CREATE TABLE public.%I PARTITION OF public.dataselect_stats FOR VALUES FROM (%L) TO (%L)',
+                       partition, first_day, (first_day + interval '1 month')::date);
+    END IF;
+    RETURN partition;
+END;
+$$;
+
+--
+-- Name: dataselect_stats_monthly; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.dataselect_stats_monthly (
+    node_id integer NOT NULL,
+    date date NOT NULL,
+    network character varying(6) NOT NULL,
+    country character varying(2) NOT NULL,
+    bytes bigint,
+    nb_reqs bigint,
+    nb_successful_reqs bigint,
+    nb_failed_reqs bigint,
+    clients public.hll,
+    updated_at timestamp with time zone DEFAULT now()
+);
+
+
+ALTER TABLE public.dataselect_stats_monthly OWNER TO postgres;
+
+--
+-- Name: stats_watermarks; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE SEQUENCE public.stats_watermarks_version_seq;
+
+CREATE TABLE public.stats_watermarks (
+    node_id integer NOT NULL,
+    date date NOT NULL,
+    version bigint DEFAULT nextval('public.stats_watermarks_version_seq') NOT NULL,
+    updated_at timestamp with time zone DEFAULT now()
+);
+
+
+ALTER TABLE public.stats_watermarks OWNER TO postgres;
+
+--
+-- Name: payloads; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.payloads (
+    id serial PRIMARY KEY,
+    node_id integer,
+    hash numeric(39,0),
+    generated_at timestamp with time zone,
+    version character varying(32),
+    first_stat_at timestamp with time zone,
+    last_stat_at timestamp with time zone,
+    created_at timestamp with time zone DEFAULT now(),
+    coverage datemultirange,
+    CONSTRAINT uniq_payload UNIQUE (node_id, hash)
+);
+
+
+ALTER TABLE public.payloads OWNER TO postgres;
+
+--
+-- Name: ingest_jobs; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.ingest_jobs (
+    id bigserial PRIMARY KEY,
+    node_id integer NOT NULL,
+    operation text NOT NULL CHECK (operation IN ('POST', 'PUT')),
+    path text NOT NULL,
+    size bigint,
+    status text DEFAULT 'queued' NOT NULL CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    message text,
+    attempts integer DEFAULT 0 NOT NULL,
+    created_at timestamp with time zone DEFAULT now(),
+    started_at timestamp with time zone,
+    finished_at timestamp with time zone
+);
+
+
+ALTER TABLE public.ingest_jobs OWNER TO postgres;
+
 --
 -- Name: nodes; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -102,6 +206,32 @@ CREATE TABLE public.networks (
 
 ALTER TABLE public.networks OWNER TO postgres;
 
+--
+-- Name: restriction_policy_version; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.restriction_policy_version (
+    version bigint NOT NULL,
+    updated_at timestamp with time zone DEFAULT now()
+);
+
+ALTER TABLE public.restriction_policy_version OWNER TO postgres;
+
+INSERT INTO public.restriction_policy_version (version) VALUES (0);
+
+CREATE FUNCTION public.bump_restriction_policy_version() RETURNS trigger
+    LANGUAGE plpgsql SECURITY DEFINER
+    AS $$
+BEGIN
+    UPDATE public.restriction_policy_version SET version = version + 1, updated_at = now();
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER nodes_policy_version_trigger AFTER INSERT OR DELETE OR UPDATE ON public.nodes FOR EACH STATEMENT EXECUTE FUNCTION public.bump_restriction_policy_version();
+
+CREATE TRIGGER networks_policy_version_trigger AFTER INSERT OR DELETE OR UPDATE ON public.networks FOR EACH STATEMENT EXECUTE FUNCTION public.bump_restriction_policy_version();
+
 --
 -- Name: nodes nodes_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -120,19 +250,40 @@ ALTER TABLE ONLY public.networks
 -- Name: dataselect_stats fk_nodes; Type: FK CONSTRAINT; Schema: public; Owner: postgres
 --
 
-ALTER TABLE ONLY public.dataselect_stats
+ALTER TABLE public.dataselect_stats
     ADD CONSTRAINT fk_nodes FOREIGN KEY (node_id) REFERENCES public.nodes(id);
 
 --
 -- Name: dataselect_stats fk_networks; Type: FK CONSTRAINT; Schema: public; Owner: postgres
 --
 
-ALTER TABLE ONLY public.dataselect_stats
+ALTER TABLE public.dataselect_stats
     ADD CONSTRAINT fk_networks FOREIGN KEY (node_id, network) REFERENCES public.networks(node_id, name);
 
-ALTER TABLE ONLY public.dataselect_stats
+ALTER TABLE public.dataselect_stats
     ADD CONSTRAINT uniq_stat UNIQUE (node_id,date,network,station,location,channel,country);
 
+ALTER TABLE ONLY public.dataselect_stats_monthly
+    ADD CONSTRAINT dataselect_stats_monthly_pkey PRIMARY KEY (node_id, date, network, country);
+
+ALTER TABLE ONLY public.dataselect_stats_monthly
+    ADD CONSTRAINT fk_networks FOREIGN KEY (node_id, network) REFERENCES public.networks(node_id, name);
+
+ALTER TABLE ONLY public.stats_watermarks
+    ADD CONSTRAINT stats_watermarks_pkey PRIMARY KEY (node_id, date);
+
+CREATE INDEX dataselect_stats_network_idx ON public.dataselect_stats (network text_pattern_ops, date);
+
+CREATE INDEX dataselect_stats_station_idx ON public.dataselect_stats (station text_pattern_ops, date);
+
+CREATE INDEX dataselect_stats_channel_idx ON public.dataselect_stats (channel text_pattern_ops, date);
+
+CREATE INDEX dataselect_stats_monthly_network_idx ON public.dataselect_stats_monthly (network text_pattern_ops, date);
+
+CREATE INDEX payloads_coverage_idx ON public.payloads USING gist (node_id, coverage);
+
+CREATE INDEX ingest_jobs_pending_idx ON public.ingest_jobs (node_id, id) WHERE status IN ('queued', 'running');
+
 --
 -- Name: tokens fk_nodes; Type: FK CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 
 import pytest
+import socket
+import time
 from webtest import TestApp
 from pytest_postgresql import factories
-from ws_eidastats import main, views_main, model
+from datetime import datetime, timedelta, timezone
+from webob import Request
+from ws_eidastats import main, helper_functions
+from ws_eidastats.query_compiler import shape, compile_shape, bound_values
 
 
 postgresql_my_proc = factories.postgresql_noproc(host="localhost", port="5432", password="password")
 postgres_with_schema = factories.postgresql('postgresql_my_proc', dbname="test", load=['./tests/eidastats_schema.sql'])
 
+
+def postgres_available():
+    try:
+        socket.create_connection(("localhost", 5432), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
 '''
 def test_postgres(postgres_with_schema):
     """
@@ -112,9 +125,182 @@ def test_no_token(app):
 
 def test_method_not_allowed(app):
     """
-    Check GET method not allowed
+    Check methods not allowed on known routes are answered with 405 and the allowed methods
     """
 
     response = app.get('/dataselect/restricted?start=2021-05&country=GR', status=405)
 
-    assert 'Not Allowed' in str(response.body)
+    assert 'Not Allowed' in str(response.body) and response.headers['Allow'] == 'POST'
+    response = app.post('/dataselect/public?start=2021-05', status=405)
+    assert response.headers['Allow'] == 'GET'
+    app.get('/nonexistent', status=404)
+
+
+def test_top_parameters(app):
+    """
+    Check top requests follow the public method with GET and the restricted method with POST
+    """
+
+    response = app.get('/dataselect/top?start=2024-01&by=stg', status=400)
+    assert "parameter 'by'" in str(response.body)
+    app.get('/dataselect/top?start=2024-01&n=0', status=400)
+    app.get('/dataselect/top?start=2024-01&level=station', status=400)
+    app.get('/dataselect/top?start=2024-01&limit=10', status=400)
+    response = app.post('/dataselect/top?start=2024-01&level=station&network=FR&by=nb_reqs', status=401)
+    assert 'no token' in str(response.body)
+
+
+def test_batch_malformed_body(app):
+    """
+    Check batch request whose body is not an object of named parameter sets
+    """
+
+    response = app.post_json('/dataselect/batch', {'queries': [{'start': '2023-01'}]}, status=400)
+    assert 'queries' in str(response.body)
+    response = app.post_json('/dataselect/batch', {'queries': {'total': {'start': 2023}}}, status=400)
+    response = app.post('/dataselect/batch', 'not json', status=400)
+
+
+def test_not_modified():
+    """
+    Check conditional requests are answered with 304 when validators match
+    """
+
+    last_modified = datetime(2023, 5, 1, 12, 0, 0, 500000, tzinfo=timezone.utc)
+    request = Request.blank('/nodes', headers={'If-None-Match': '"nodes-3"'})
+    assert helper_functions.not_modified(request, 'nodes-3', last_modified).status_code == 304
+    assert helper_functions.not_modified(request, 'nodes-4', last_modified) is None
+    request = Request.blank('/nodes', headers={'If-Modified-Since': 'Mon, 01 May 2023 12:00:00 GMT'})
+    assert helper_functions.not_modified(request, 'nodes-3', last_modified).status_code == 304
+    assert helper_functions.not_modified(request, 'nodes-3', last_modified + timedelta(seconds=1)) is None
+
+
+def test_node_catalog():
+    """
+    Check the node catalog is only reloaded once older than its time to live
+    """
+
+    catalog = helper_functions.NodeCatalog(ttl=60)
+    sessions = []
+    def refresh(session):
+        sessions.append(session)
+        catalog._nodes = {'RESIF': False, 'NOA': True}
+        catalog._loaded_at = time.monotonic()
+    catalog.refresh = refresh
+    assert sorted(catalog.names('s1')) == ['NOA', 'RESIF'] and catalog.names('s2') and sessions == ['s1']
+    catalog._loaded_at -= 61
+    assert 'NOA' in catalog.names('s3') and sessions == ['s1', 's3']
+    catalog.invalidate()
+    assert catalog.names('s4') and sessions == ['s1', 's3', 's4']
+
+
+def test_token_cache():
+    """
+    Check verified tokens are answered from the token cache until they expire, within its size bound
+    """
+
+    cache = helper_functions.TokenCache(max_entries=2)
+    now = datetime.now()
+    cache.put('a', {'memberof': '/epos'}, now + timedelta(hours=1))
+    cache.put('b', {'memberof': '/epos'}, now - timedelta(seconds=1))
+    assert cache.get('a') == {'memberof': '/epos'} and cache.get('b') is None
+    cache.get('a')['memberof'] = 'changed'
+    cache.put('c', {}, now + timedelta(hours=1))
+    cache.put('d', {}, now + timedelta(hours=1))
+    assert cache.get('a') is None and cache.get('c') == {} and cache.get('d') == {}
+
+    request = Request.blank('/dataselect/restricted', method='POST', body=b'signed token file')
+    helper_functions.token_cache.put(helper_functions.token_cache.digest(request.body), {'memberof': '/epos'}, now + timedelta(hours=1))
+    assert helper_functions.check_authentication(request) == {'memberof': '/epos'}
+    helper_functions.token_cache.clear()
+
+
+def test_cursor():
+    """
+    Check pagination cursors hold the ordering keys of the last result of a page
+    """
+
+    keys = ['2023-01-01', 'GFZ', 'GE', 'APE', '', 'HHZ', 'GR']
+    assert helper_functions.decode_cursor(helper_functions.encode_cursor(keys)) == keys
+    with pytest.raises(Exception):
+        helper_functions.decode_cursor('not a cursor')
+
+
+def test_limit_parameters():
+    """
+    Check pages are bounded and cursors only accepted along with a limit
+    """
+
+    cursor = helper_functions.encode_cursor(['2023-01-01', 'GFZ'])
+    def parameters(query_string):
+        request = Request.blank('/dataselect/restricted', method='POST', query_string=query_string)
+        return helper_functions.check_request_parameters(request, one_network=False)
+
+    assert parameters(f"start=2023-01&limit={helper_functions.LIMIT_MAX}&cursor={cursor}")['limit'] == helper_functions.LIMIT_MAX
+    for query_string in [f"start=2023-01&limit={helper_functions.LIMIT_MAX + 1}", "start=2023-01&limit=0", f"start=2023-01&cursor={cursor}"]:
+        with pytest.raises(ValueError):
+            parameters(query_string)
+
+
+def test_public_plan_stream(monkeypatch):
+    """
+    Check network-level public results are streamed, node-level ones use the prepared statement
+    """
+
+    from ws_eidastats import views_main
+    from ws_eidastats.watermarks import Watermark
+    monkeypatch.setattr(views_main.restriction_policies, 'refresh', lambda session: None)
+    monkeypatch.setattr(views_main, 'stats_watermark', lambda *args: Watermark(frozenset([1]), 1, None))
+    monkeypatch.setattr(views_main.result_cache, 'max_bytes', 0)
+    def plan(query_string):
+        request = Request.blank('/dataselect/public', query_string=query_string)
+        request.dbsession = None
+        return views_main.plan_public(request)
+
+    assert plan('start=2023-01&level=network&details=month,country').stream
+    assert not plan('start=2023-01&level=node&details=month').stream
+    assert not plan('start=2023-01').stream
+
+
+@pytest.mark.skipif(not postgres_available(), reason="No PostgreSQL server")
+def test_partition_pruning(postgres_with_schema):
+    """
+    Check statistics queries only scan the partitions of the requested months
+    """
+
+    with postgres_with_schema.cursor() as cur:
+        cur.execute("SELECT public.create_dataselect_stats_partition(d::date) FROM generate_series('2023-01-01', '2023-06-01', interval '1 month') AS d")
+        cur.execute("SELECT public.create_dataselect_stats_partition('2023-02-17')")
+        assert cur.fetchone()[0] == 'dataselect_stats_2023_02'
+        param_value_dict = {'start': '2023-02-01', 'end': '2023-03-01', 'level': 'channel', 'details': ['month']}
+        query = compile_shape(shape(param_value_dict))
+        cur.execute("EXPLAIN " + query.stream_sql, bound_values(query, param_value_dict))
+        plan = '\n'.join(row[0] for row in cur.fetchall())
+        assert 'dataselect_stats_2023_02' in plan and 'dataselect_stats_2023_03' in plan
+        assert all(f'dataselect_stats_2023_0{m}' not in plan for m in [1, 4, 5, 6])
+
+
+@pytest.mark.skipif(not postgres_available(), reason="No PostgreSQL server")
+def test_pagination_null_keys(postgres_with_schema):
+    """
+    Check pages go through NULL grouping values, such as countries of legacy statistics, grouped with empty strings
+    """
+
+    with postgres_with_schema.cursor() as cur:
+        cur.execute("SELECT public.create_dataselect_stats_partition('2023-01-01')")
+        cur.execute("INSERT INTO nodes (id, name) VALUES (1, 'NOA')")
+        cur.execute("INSERT INTO networks (node_id, name) VALUES (1, 'FR'), (1, 'GR')")
+        cur.execute("""INSERT INTO dataselect_stats (node_id, date, network, station, location, channel, country, bytes)
+                       VALUES (1, '2023-01-01', 'FR', 'A', '', 'HHZ', NULL, 1), (1, '2023-01-01', 'FR', 'B', '', 'HHZ', '', 2),
+                              (1, '2023-01-01', 'FR', 'C', '', 'HHZ', 'FR', 4), (1, '2023-01-01', 'GR', 'A', '', 'HHZ', NULL, 8)""")
+        items = []
+        param_value_dict = {'start': '2023-01-01', 'level': 'network', 'details': ['country'], 'limit': 1}
+        for _ in range(10):
+            query = compile_shape(shape(param_value_dict))
+            cur.execute(query.stream_sql, bound_values(query, param_value_dict))
+            rows = cur.fetchall()
+            items += rows[:1]
+            if len(rows) <= 1:
+                break
+            param_value_dict['cursor'] = list(rows[0][:3])
+        assert [(network, country, int(bytes)) for (_, network, country, _, _, bytes, _) in items] == [('FR', '', 3), ('FR', 'FR', 4), ('GR', '', 8)]
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import asyncio
+from ws_eidastats.asgi import app, make_request
+
+
+def call(method, path, query_string=b'', headers=None, body=b''):
+    """
+    Runs the ASGI application on one request and returns the status, headers and body of the response
+    """
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': headers or []}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return (sent[0]['status'], dict(sent[0]['headers']), b''.join(m.get('body', b'') for m in sent[1:]))
+
+
+def test_make_request():
+    """
+    Check ASGI scopes are converted to the requests expected by the views helpers
+    """
+
+    request = make_request({'method': 'GET', 'path': '/dataselect/public', 'query_string': b'start=2023-01&country=GR,FR',
+                            'headers': [(b'if-none-match', b'"abc"'), (b'accept', b'text/csv')]}, b'')
+    assert request.GET.getall('country') == ['GR,FR']
+    assert request.headers['Accept'] == 'text/csv'
+    assert 'abc' in request.if_none_match
+
+
+def test_routes():
+    """
+    Check unknown routes, disallowed methods and invalid parameters are answered without database
+    """
+
+    assert call('GET', '/nonexistent')[0] == 404
+    (status, headers, body) = call('POST', '/dataselect/public')
+    assert status == 405 and headers[b'allow'] == b'GET'
+    (status, headers, body) = call('PUT', '/dataselect/top')
+    assert status == 405 and headers[b'allow'] == b'GET, POST'
+    (status, headers, body) = call('GET', '/dataselect/public', b'start=2023-01&nonexistent=1')
+    assert status == 400 and b'Invalid parameter' in body
+    (status, headers, body) = call('GET', '/dataselect/restricted')
+    assert status == 405 and headers[b'allow'] == b'POST'
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import gzip
+from pyramid.request import Request
+from ws_eidastats.compression import Compression, compression
+from ws_eidastats.result_cache import ResultCache, Scope
+from ws_eidastats import views_main
+
+
+RESULTS = [{'date': '2023-01', 'node': 'GFZ', 'network': 'GE', 'station': 'APE', 'location': '', 'channel': 'HHZ', 'country': 'GR',
+            'bytes': 1024, 'nb_reqs': 3, 'nb_successful_reqs': 2, 'clients': 2}] * 500
+
+
+def test_negotiate():
+    """
+    Check the encoding is negotiated from the Accept-Encoding header, in the configured order for equal qualities
+    """
+
+    gz = Compression(encodings=['gzip'])
+    assert gz.negotiate(Request.blank('/')) is None
+    assert gz.negotiate(Request.blank('/', headers={'Accept-Encoding': 'gzip, deflate'})) == 'gzip'
+    assert gz.negotiate(Request.blank('/', headers={'Accept-Encoding': 'br'})) is None
+    assert gz.negotiate(Request.blank('/', headers={'Accept-Encoding': 'gzip;q=0'})) is None
+    assert Compression(encodings=[]).negotiate(Request.blank('/', headers={'Accept-Encoding': 'gzip'})) is None
+
+
+def test_encode_chunk_by_chunk():
+    """
+    Check streamed gzip bodies decompress to the original chunks
+    """
+
+    chunks = [b'date,node\n', b'2023-01,GFZ\n' * 1000, b'2023-02,NOA\n']
+    assert gzip.decompress(b''.join(Compression(encodings=['gzip']).encode(iter(chunks), 'gzip'))) == b''.join(chunks)
+    (read, rest, exhausted) = compression.peek(iter(chunks), 20)
+    assert (read, exhausted) == (chunks[:2], False) and list(rest) == chunks[2:]
+
+
+def test_results_response_threshold_and_cache(monkeypatch):
+    """
+    Check small bodies are left uncompressed, and large compressed bodies are cached whole
+    """
+
+    cache = ResultCache()
+    monkeypatch.setattr(views_main, 'result_cache', cache)
+    request = Request.blank('/dataselect/public?start=2023-01')
+    scope = Scope(None, '2023-01', None)
+    param_value_dict = {'start': '2023-01-01', 'details': []}
+
+    response = views_main.results_response(request, param_value_dict, iter(RESULTS[:1]), cache_entry=('items', 1, scope),
+                    encoding='gzip', encoded_cache_entry=('gzip', 1, scope))
+    body = b''.join(response.app_iter)
+    assert response.content_encoding is None and body.startswith(b'# version')
+    assert cache.get('items', 1) is not None and cache.get('gzip', 1) is None
+
+    response = views_main.results_response(request, param_value_dict, iter(RESULTS), cache_entry=('items', 2, scope),
+                    encoding='gzip', encoded_cache_entry=('gzip', 2, scope))
+    body = b''.join(response.app_iter)
+    assert response.content_encoding == 'gzip' and 'Accept-Encoding' in response.vary
+    assert gzip.decompress(body).count(b'\n2023-01,GFZ,GE,APE') == len(RESULTS)
+    assert cache.get('gzip', 2) == body and cache.get('items', 2) is None
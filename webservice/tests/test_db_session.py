@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pyramid.response import Response
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+from webob import Request
+from webtest import TestApp
+from ws_eidastats import main, helper_functions
+from ws_eidastats.db_session import instrument, request_session, session_tween_factory, STATS_KEY
+
+
+@pytest.fixture
+def small_pool(tmp_path):
+    """
+    Binds sessions to a database whose pool holds 2 connections without overflow, on a schema-less SQLite file
+    so that every view fails after acquiring its connection
+    """
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'stress.db'}", poolclass=QueuePool, pool_size=2, max_overflow=0,
+                           pool_timeout=5, connect_args={'check_same_thread': False})
+    instrument(engine)
+    helper_functions.Session.configure(bind=engine)
+    yield engine.pool
+    helper_functions.Session.configure(bind=helper_functions.engine)
+    engine.dispose()
+
+
+def test_concurrent_failures(small_pool):
+    """
+    Check sessions of failing requests are returned to the pool, so that concurrent failures do not exhaust it
+    """
+
+    app = TestApp(main({}))
+    paths = ['/_health', '/nodes', '/networks', '/node_restriction_policy?node=NOA', '/network_restriction_policy?node=NOA&network=FR']
+
+    def get(i):
+        return app.get(paths[i % len(paths)], status=500)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        responses = list(executor.map(get, range(400)))
+    # requests that could not get a connection within the pool timeout have no pool statistics
+    assert all('db-wait' in r.headers.get('Server-Timing', '') for r in responses)
+    assert small_pool.checkedout() == 0
+
+
+def test_concurrent_dataselect(small_pool):
+    """
+    Check dataselect requests, refreshing the restriction policies and the node catalog, hold one connection at a time
+    """
+
+    connection = small_pool.connect()
+    connection.executescript("""
+        CREATE TABLE nodes (id integer PRIMARY KEY, name text, restriction_policy boolean, eas_group text);
+        CREATE TABLE networks (node_id integer, name text, inverted_policy boolean, eas_group text);
+        CREATE TABLE restriction_policy_version (version integer, updated_at timestamp);
+        INSERT INTO nodes VALUES (1, 'NOA', false, 'noa');
+        INSERT INTO networks VALUES (1, 'FR', false, NULL);
+        INSERT INTO restriction_policy_version VALUES (1, NULL);
+        """)
+    connection.close()
+    token = b'signed token file'
+    helper_functions.token_cache.put(helper_functions.token_cache.digest(token), {'memberof': '/epos'}, datetime.now() + timedelta(hours=1))
+
+    # connections checked out by each thread, and the most a thread held at once
+    held = threading.local()
+    most = []
+
+    @event.listens_for(small_pool, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        held.count = getattr(held, 'count', 0) + 1
+        most.append(held.count)
+
+    @event.listens_for(small_pool, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        held.count = getattr(held, 'count', 1) - 1
+
+    app = TestApp(main({}))
+
+    def get(i):
+        if i % 2:
+            return app.post('/dataselect/restricted?start=2023-01&node=NOA&network=FR', token,
+                            content_type='application/octet-stream', status=500)
+        return app.get('/dataselect/public?start=2023-01&node=NOA&network=FR', status=500)
+
+    try:
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            responses = list(executor.map(get, range(200)))
+    finally:
+        helper_functions.token_cache.clear()
+    # every request got its connection, and used no other
+    assert all('db-wait' in r.headers.get('Server-Timing', '') for r in responses)
+    assert max(most) == 1 and small_pool.checkedout() == 0
+
+
+def test_streamed_body(small_pool):
+    """
+    Check the session of a streamed response is only closed once the body is closed
+    """
+
+    def handler(request):
+        request_session(request)
+        return Response(app_iter=(chunk for chunk in [b'a', b'b']))
+
+    request = Request.blank('/')
+    response = session_tween_factory(handler, None)(request)
+    assert small_pool.checkedout() == 1 and request.environ[STATS_KEY].checked_out == 1
+    assert b''.join(response.app_iter) == b'ab'
+    response.app_iter.close()
+    assert small_pool.checkedout() == 0
+
+    def failing(request):
+        request_session(request)
+        raise RuntimeError('view failed')
+
+    with pytest.raises(RuntimeError):
+        session_tween_factory(failing, None)(Request.blank('/'))
+    assert small_pool.checkedout() == 0
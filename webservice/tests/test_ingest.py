@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import csv
+import gzip
+from datetime import date
+import io
+import json
+import mmh3
+import os
+import pytest
+from pytest_postgresql import factories
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from webob import Request
+from ws_eidastats.ingest import CsvRows, Fingerprint, normalized_rows, ingest, coverage_runs, multirange, DuplicatePayload, OverlappingPayload
+from ws_eidastats.ingest_queue import IngestQueue, QueueFull, PayloadTooLarge
+from ws_eidastats.payload import PayloadReader, PayloadError, body_stream, decoded_stream, READ_SIZE
+from test_app import postgres_available
+
+
+postgresql_ingest_proc = factories.postgresql_noproc(host="localhost", port="5432", password="password")
+postgres_ingest = factories.postgresql('postgresql_ingest_proc', dbname="test_ingest", load=['./tests/eidastats_schema.sql'])
+
+
+def statistic(**fixed):
+    stat = {'month': '2023-05-01', 'network': 'FR', 'station': 'CIEL', 'location': '00', 'channel': 'HHZ', 'country': 'GR',
+            'bytes': 100, 'nb_requests': 3, 'nb_successful_requests': 2, 'nb_unsuccessful_requests': 1, 'clients': None}
+    stat.update(fixed)
+    return stat
+
+
+def test_normalized_rows():
+    """
+    Check missing values of statistics are fixed before staging
+    """
+
+    rows = list(normalized_rows([statistic(country=None, nb_unsuccessful_requests=None, nb_requests=None)]))
+    assert rows == [('2023-05-01', 'FR', 'CIEL', '00', 'HHZ', '', 100, 2, 2, 0, None)]
+
+
+def test_csv_rows():
+    """
+    Check staged rows are serialized as CSV in batches, keeping empty strings apart from NULL values
+    """
+
+    rows = [('2023-05-01', 'FR', 'CIEL', '', 'HHZ', '', i, 1, 1, 0, None) for i in range(2500)] + [('2023-05-01', 'F,R', 'A"B', '', '', '', 0, 0, 0, 0, '\\x128b7f')]
+    source = CsvRows(rows)
+    chunks = list(iter(lambda: source.read(8192), ''))
+    assert source.count == 2501 and len(chunks) > 1
+    lines = ''.join(chunks).splitlines()
+    assert lines[0] == '2023-05-01,FR,CIEL,,HHZ,,0,1,1,0,\\N'
+    assert next(csv.reader(io.StringIO(lines[-1]))) == ['2023-05-01', 'F,R', 'A"B', '', '', '', '0', '0', '0', '0', '\\x128b7f']
+
+    def failing():
+        yield rows[0]
+        raise PayloadError("Malformed payload")
+
+    source = CsvRows(failing())
+    with pytest.raises(PayloadError):
+        source.read(8192)
+    assert isinstance(source.error, PayloadError)
+
+
+class CountingStream(io.BytesIO):
+    """
+    Body keeping track of the number of bytes read from it
+    """
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.count = getattr(self, 'count', 0) + len(data)
+        return data
+
+
+def test_spool_size(tmp_path):
+    """
+    Check payloads are spooled up to the maximum size, larger ones leaving no file behind
+    """
+
+    queue = IngestQueue(directory=str(tmp_path), max_bytes=3 * READ_SIZE)
+    path = queue.spool(1, io.BytesIO(b'x' * 3 * READ_SIZE))
+    assert os.path.getsize(path) == 3 * READ_SIZE
+    with pytest.raises(PayloadTooLarge):
+        queue.spool(1, io.BytesIO(b'x' * (3 * READ_SIZE + 1)))
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+
+
+def test_payload_reader():
+    """
+    Check payloads are read incrementally, compressed or not, whatever the position of their metadata
+    """
+
+    stats = [statistic(station=f"S{i}", bytes=i * 0.5, clients=f"\\x{mmh3.hash128(str(i)):032x}") for i in range(20000)]
+    stats[0]['extra'] = {'a': [1, None, {'b': 'c'}]}
+    body = json.dumps({'stats': stats, 'generated_at': '2023-06-01', 'version': '1.0', 'days_coverage': ['2023-05-01']}).encode()
+    for (data, headers) in [(body, {}), (gzip.compress(body), {}), (gzip.compress(body), {'Content-Encoding': 'gzip'})]:
+        stream = CountingStream(data)
+        request = Request.blank('/submit', method='POST', headers=headers)
+        request.body_file = stream
+        payload = PayloadReader(body_stream(request)).payload
+        assert next(payload['stats']) == stats[0] and stream.count <= 2 * READ_SIZE + 2 < len(data)
+        assert 'version' not in payload
+        assert list(payload['stats']) == stats[1:] and payload['version'] == '1.0'
+
+
+def test_decoded_stream(tmp_path):
+    """
+    Check spooled bodies are decompressed from their magic number
+    """
+
+    body = json.dumps({'stats': [statistic()]}).encode()
+    for (name, data) in [('plain', body), ('gzip', gzip.compress(body))]:
+        (tmp_path / name).write_bytes(data)
+        with open(tmp_path / name, 'rb') as f:
+            assert list(PayloadReader(decoded_stream(f)).payload['stats']) == [statistic()]
+
+
+def test_payload_errors():
+    """
+    Check malformed payloads are reported once met
+    """
+
+    for body in [b'{"stats": [{"month": "2023-05-01"', b'not json', b'{"stats": {}}', b'{"version": "1.0"}',
+                 b'{"stats": [{"network": "FR", "clients": null}]}', b'[]', gzip.compress(b'{"stats": [')[:-4]]:
+        request = Request.blank('/submit', method='POST', body=body)
+        with pytest.raises(PayloadError):
+            list(PayloadReader(body_stream(request)).payload['stats'])
+
+
+def test_fingerprint():
+    """
+    Check fingerprints depend on the statistics, whatever their order and the order of their keys
+    """
+
+    def fingerprint(stats):
+        f = Fingerprint()
+        assert len(list(f.rows(normalized_rows(stats)))) == len(stats)
+        return f.value
+
+    stats = [statistic(station=f"S{i}", country='é') for i in range(3)]
+    reordered = [dict(reversed(list(s.items()))) for s in reversed(stats)]
+    assert fingerprint(stats) == fingerprint(reordered) and 2**64 < fingerprint(stats) < 2**128
+    assert fingerprint([statistic(country=None)]) == fingerprint([statistic(country='')])
+    assert fingerprint(stats) != fingerprint(stats[:2] + [statistic(station='S2', country='é', bytes=101)])
+    assert fingerprint(stats) != fingerprint(stats + stats[:1]) and fingerprint([]) == 0
+
+
+def test_coverage():
+    """
+    Check payload coverages are stored as runs of consecutive days, and overlaps reported by runs
+    """
+
+    days = [date(2023, 5, d) for d in (3, 1, 2, 2, 5, 31)] + [date(2023, 6, 1)]
+    runs = coverage_runs(days)
+    assert runs == [(date(2023, 5, 1), date(2023, 5, 3)), (date(2023, 5, 5), date(2023, 5, 5)), (date(2023, 5, 31), date(2023, 6, 1))]
+    assert multirange(runs) == '{[2023-05-01,2023-05-03],[2023-05-05,2023-05-05],[2023-05-31,2023-06-01]}'
+    assert multirange([]) == '{}'
+    assert "2023-05-01/2023-05-03, 2023-05-05, 2023-05-31/2023-06-01" in str(OverlappingPayload(runs))
+
+
+@pytest.mark.skipif(not postgres_available(), reason="No PostgreSQL server")
+def test_ingest(postgres_ingest):
+    """
+    Check POST adds counters and PUT overwrites them, duplicate payloads being refused
+    """
+
+    info = postgres_ingest.info
+    engine = create_engine(f"postgresql://{info.user}:password@{info.host}:{info.port}/{info.dbname}")
+    with Session(engine) as session:
+        node_id = session.execute(text("INSERT INTO nodes (name, restriction_policy) VALUES ('TEST', false) RETURNING id")).scalar()
+        hll = session.execute(text("SELECT hll_add(hll_empty(11, 5), hll_hash_integer(1))::text")).scalar()
+        session.commit()
+
+        def submission(version, days):
+            # payloads are told apart by their statistics
+            return {'generated_at': '2023-06-01', 'version': version, 'days_coverage': days,
+                    'stats': [statistic(clients=hll, nb_requests=int(version[2:]) + 3), statistic(clients=hll, channel='HHN')]}
+
+        ingest(session, node_id, submission('1.0', ['2023-05-01']), 'POST')
+        with pytest.raises(DuplicatePayload):
+            ingest(session, node_id, submission('1.0', ['2023-05-02']), 'POST')
+        # payloads are only duplicates of payloads of the same node
+        other_id = session.execute(text("INSERT INTO nodes (name, restriction_policy) VALUES ('OTHER', false) RETURNING id")).scalar()
+        session.commit()
+        ingest(session, other_id, submission('1.0', ['2023-05-01']), 'POST')
+        assert session.execute(text("SELECT count(*) FROM payloads WHERE node_id = :id"), {'id': other_id}).scalar() == 1
+        # statistics of the other node are left out of the following checks
+        session.execute(text("DELETE FROM dataselect_stats WHERE node_id = :id"), {'id': other_id})
+        session.execute(text("DELETE FROM dataselect_stats_monthly WHERE node_id = :id"), {'id': other_id})
+        session.commit()
+        ingest(session, node_id, submission('1.1', ['2023-05-02']), 'POST')
+        assert session.execute(text("SELECT sum(bytes), count(*) FROM dataselect_stats")).one() == (400, 2)
+        assert session.execute(text("SELECT bytes FROM dataselect_stats_monthly")).scalar() == 400
+        with pytest.raises(OverlappingPayload) as err:
+            ingest(session, node_id, submission('1.2', ['2023-05-03', '2023-05-01', '2023-05-02', '2023-05-05']), 'POST')
+        assert err.value.days == [(date(2023, 5, 1), date(2023, 5, 2))]
+        ingest(session, node_id, submission('1.2', ['2023-05-01']), 'PUT')
+        assert session.execute(text("SELECT sum(bytes), count(*) FROM dataselect_stats")).one() == (200, 2)
+        # the last statistic of a key wins for PUT
+        ingest(session, node_id, {'generated_at': '2023-06-01', 'version': '1.3', 'days_coverage': ['2023-05-01'],
+                                  'stats': [statistic(clients=hll, bytes=7), statistic(clients=hll, bytes=5)]}, 'PUT')
+        assert session.execute(text("SELECT bytes FROM dataselect_stats WHERE channel = 'HHZ'")).scalar() == 5
+        assert session.execute(text("SELECT count(*) FROM payloads")).scalar() == 5
+    engine.dispose()
+
+
+@pytest.mark.skipif(not postgres_available(), reason="No PostgreSQL server")
+def test_ingest_queue(postgres_ingest, tmp_path):
+    """
+    Check jobs are claimed in turn by node, one at a time for each node, and the queue refuses jobs once full
+    """
+
+    info = postgres_ingest.info
+    engine = create_engine(f"postgresql://{info.user}:password@{info.host}:{info.port}/{info.dbname}")
+    queue = IngestQueue(directory=str(tmp_path), max_jobs=3, max_node_jobs=2)
+    with Session(engine) as session:
+        (a, b, c) = session.execute(text("INSERT INTO nodes (name, restriction_policy) VALUES ('A', false), ('B', false), ('C', false) RETURNING id")).scalars()
+        session.commit()
+
+        def body(version, stats=None):
+            return io.BytesIO(gzip.compress(json.dumps({'generated_at': '2023-06-01', 'version': version, 'days_coverage': ['2023-05-01'],
+                                                        'stats': [statistic()] if stats is None else stats}).encode()))
+
+        a1 = queue.enqueue(session, a, 'POST', body('1.0'))
+        a2 = queue.enqueue(session, a, 'POST', body('1.1', stats=[{'month': '2023-05-01'}]))
+        with pytest.raises(QueueFull):
+            queue.enqueue(session, a, 'POST', body('1.2'))
+        b1 = queue.enqueue(session, b, 'PUT', body('1.0'))
+        with pytest.raises(QueueFull):
+            queue.enqueue(session, c, 'POST', body('1.0'))
+
+        job = queue.claim(session)
+        assert job.id == a1 and queue.claim(session).id == b1 and queue.claim(session) is None
+        assert queue.status(session, a, a1)['status'] == 'running' and queue.status(session, b, a1) is None
+        queue.process(session, job)
+        assert queue.status(session, a, a1)['status'] == 'done' and not os.path.exists(job.path)
+        job = queue.claim(session)
+        assert job.id == a2
+        queue.process(session, job)
+        assert queue.status(session, a, a2)['status'] == 'failed' and queue.status(session, a, a2)['message'] == "Malformed payload"
+        assert session.execute(text("SELECT sum(bytes) FROM dataselect_stats")).scalar() == 100
+    engine.dispose()
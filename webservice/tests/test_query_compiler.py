@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+from ws_eidastats.query_compiler import shape, compile_shape, compile_batch, bound_values, stats_table, classify
+from ws_eidastats.restriction_policies import RestrictionPolicyMap, Policy
+
+
+def test_rollup_routing():
+    """
+    Check requests that need neither station, location nor channel are routed to the monthly rollup table
+    """
+
+    assert stats_table({'level': 'network', 'details': ['month', 'country']}) == 'dataselect_stats_monthly'
+    assert stats_table({'details': []}) == 'dataselect_stats_monthly'
+    assert stats_table({'level': 'station', 'details': []}) == 'dataselect_stats'
+    assert stats_table({'level': 'node', 'channel': ['HH%'], 'details': []}) == 'dataselect_stats'
+
+
+def test_shape_cache():
+    """
+    Check requests differing only by filter values share their compiled statement
+    """
+
+    first = compile_shape(shape({'start': '2023-01-01', 'node': ['GFZ'], 'level': 'node', 'details': ['month']}))
+    second = compile_shape(shape({'start': '2021-05-01', 'node': ['NOA', 'RESIF'], 'level': 'node', 'details': ['month']}))
+    other = compile_shape(shape({'start': '2021-05-01', 'level': 'node', 'details': ['month']}))
+    assert first is second
+    assert first.name != other.name
+    assert 'n.name = ANY($2)' in first.prepare_sql
+    assert first.execute_sql == f"EXECUTE {first.name} (%(start)s, %(node)s)"
+
+
+def test_ordering_keys_and_other_bucket():
+    """
+    Check pagination keys follow the grouping columns and restricted networks are mapped to 'Other' items
+    """
+
+    param_value_dict = {'start': '2023-01-01', 'network': ['G%'], 'level': 'station', 'details': ['month', 'country'],
+                        'cursor': ['2023-01-01', 'GFZ', 'GE', 'APE', 'GR'], 'limit': 10}
+    query = compile_shape(shape(param_value_dict, hidden='restricted'))
+    assert [label for (label, _) in query.keys] == ['date', 'name', 'network', 'station', 'country']
+    assert query.stream_sql.count("THEN 'Other'") == 4 and query.stream_sql.count("THEN '*'") == 2
+    assert 's.network ~>=~ CAST(%(network_lo0)s AS text) AND s.network ~<~ CAST(%(network_hi0)s AS text)' in query.stream_sql
+    values = bound_values(query, param_value_dict, memberof=['group'])
+    assert set(values) == {name for (name, _) in query.params}
+    assert values['limit'] == 11 and values['k3'] == 'APE'
+
+    # NULL grouping values are paginated as empty strings
+    assert "(coalesce(s.country, ''))" not in query.stream_sql and "coalesce(s.country, '') AS country" in query.stream_sql
+    assert "coalesce(CASE WHEN" in query.stream_sql and "s.date, coalesce(CASE" in query.stream_sql
+
+    query = compile_shape(shape({'start': '2023-01-01', 'network': ['GE'], 'level': 'node', 'details': []}, hidden='public'))
+    assert 'Other' not in query.stream_sql
+    assert 's.network = ANY(CAST(%(network)s AS text[]))' in query.stream_sql
+
+
+def test_top():
+    """
+    Check rankings are computed in the database, clients by their estimated cardinality
+    """
+
+    param_value_dict = {'start': '2024-01-01', 'end': '2024-12-01', 'level': 'network', 'details': [], 'by': 'clients', 'n': 20}
+    query = compile_shape(shape(param_value_dict, hidden='public'))
+    assert query.stream_sql.endswith("ORDER BY clients_cardinality DESC NULLS LAST, 1, 2\nLIMIT CAST(%(top)s AS bigint)")
+    assert 'hll_union_agg(s.clients) AS clients' not in query.stream_sql
+    values = bound_values(query, param_value_dict)
+    assert set(values) == {name for (name, _) in query.params} and values['top'] == 20
+
+
+def test_pattern_classes():
+    """
+    Check exact codes, prefixes and general patterns compile to index-usable conditions
+    """
+
+    assert classify(['FR', 'CIEL', 'HH%', 'H_Z', '%Z', '_H%']) ==\
+        (['FR', 'CIEL'], [('HH', None), ('H', 'H_Z')], ['%Z', '_H%'])
+    param_value_dict = {'start': '2023-01-01', 'channel': ['HHZ', 'BH%', 'H_Z', '%Z'], 'level': 'channel', 'details': []}
+    query = compile_shape(shape(param_value_dict))
+    assert "(s.channel = ANY($2) OR (s.channel ~>=~ $3 AND s.channel ~<~ $4)"\
+        " OR (s.channel ~>=~ $5 AND s.channel ~<~ $6 AND s.channel LIKE $7) OR s.channel LIKE ANY($8))" in query.prepare_sql
+    values = bound_values(query, param_value_dict)
+    assert set(values) == {name for (name, _) in query.params}
+    assert (values['channel'], values['channel_lo0'], values['channel_hi0']) == (['HHZ'], 'BH', 'BI')
+    assert (values['channel_like1'], values['channel_any']) == ('H_Z', ['%Z'])
+
+    query = compile_shape(shape({'start': '2023-01-01', 'network': ['FR'], 'details': []}))
+    assert 's.network = ANY($2)' in query.prepare_sql and 'LIKE' not in query.prepare_sql
+
+
+def test_policy_match():
+    """
+    Check network patterns are matched against the restriction policies of a node
+    """
+
+    policies = RestrictionPolicyMap()
+    policies._policies = {('RESIF', 'FR'): Policy('no', None), ('RESIF', 'FO'): Policy('yes', 'g'), ('NOA', 'FR'): Policy('yes', 'g')}
+    assert policies.match('RESIF', 'FR') == [Policy('no', None)]
+    assert len(policies.match('RESIF', 'F%')) == 2
+    assert policies.match('RESIF', 'F_') == policies.match('RESIF', 'F%')
+    assert policies.match('NOA', 'G%') == []
+
+
+def test_compile_batch():
+    """
+    Check requests differing in level and details are answered by one statement with a grouping set each
+    """
+
+    requests = [{'start': '2023-01-01', 'details': []},
+                {'start': '2023-01-01', 'level': 'node', 'details': ['month']},
+                {'start': '2023-01-01', 'level': 'network', 'details': ['month', 'country']},
+                {'start': '2023-01-01', 'details': []}]
+    (query, sets) = compile_batch(tuple(shape(r, hidden='public') for r in requests))
+    assert 'FROM dataselect_stats_monthly s' in query.stream_sql and query.prepare_sql.count('$1') == 1
+    # node level keeps node names, network level hides them in 'Other' for restricted networks
+    assert [label for (label, _) in query.keys] == ['c0', 'c1', 'c2', 'c3', 'c4']
+    assert sets == [(31, ()), (0b00111, (0, 1)), (0b01000, (0, 2, 3, 4)), (31, ())]
+    assert query.stream_sql.count('()') == 1
+    assert set(bound_values(query, requests[0])) == {name for (name, _) in query.params}
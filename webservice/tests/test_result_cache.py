@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import json
+import pickle
+from ws_eidastats.result_cache import ResultCache, Scope, Entry
+
+
+SCOPE = Scope(frozenset([1, 2]), '2023-01', '2023-06')
+
+
+def test_key_normalized():
+    """
+    Check equivalent request parameters share their cache key
+    """
+
+    assert ResultCache.key({'start': '2023-01-01', 'country': ['GR', 'FR'], 'details': []}, 'csv') ==\
+        ResultCache.key({'details': [], 'country': ['FR', 'GR'], 'start': '2023-01-01'}, 'csv')
+    assert ResultCache.key({'start': '2023-01-01'}, 'csv') != ResultCache.key({'start': '2023-01-01'}, 'json')
+
+
+def test_lru_byte_accounting():
+    """
+    Check least recently used entries are evicted once the cache exceeds its size in bytes
+    """
+
+    cache = ResultCache(max_bytes=30, max_entry_bytes=20)
+    cache.put('a', 1, SCOPE, b'x' * 10)
+    cache.put('b', 1, SCOPE, b'x' * 10)
+    assert cache.get('a', 1) == b'x' * 10
+    cache.put('c', 1, SCOPE, b'x' * 15)
+    assert cache.get('b', 1) is None
+    assert cache.get('a', 1) is not None and cache.get('c', 1) is not None
+    cache.put('d', 1, SCOPE, b'x' * 21)
+    assert cache.get('d', 1) is None
+
+
+def test_version_and_invalidation():
+    """
+    Check entries are only served at their watermark version and dropped when their node and months are touched
+    """
+
+    cache = ResultCache()
+    cache.put('a', 5, SCOPE, b'body')
+    assert cache.get('a', 6) is None
+    assert cache.get('a', 5) == b'body'
+    cache.invalidate(3, ['2023-02-01'])
+    cache.invalidate(1, ['2022-12-01', '2023-07-01'])
+    assert cache.get('a', 5) == b'body'
+    cache.invalidate(2, ['2023-06-01'])
+    assert cache.get('a', 5) is None
+
+
+def test_fill():
+    """
+    Check streamed chunks are cached once fully consumed
+    """
+
+    cache = ResultCache(max_entry_bytes=5)
+    assert list(cache.fill('a', 1, SCOPE, iter([b'ab', b'cd']))) == [b'ab', b'cd']
+    assert cache.get('a', 1) == b'abcd'
+    assert list(cache.fill('b', 1, SCOPE, iter([b'abc', b'def']))) == [b'abc', b'def']
+    assert cache.get('b', 1) is None
+
+
+def test_file_tier(tmp_path):
+    """
+    Check entries cached by a worker are served by another worker sharing the cache directory
+    """
+
+    ResultCache(directory=str(tmp_path)).put('a', 1, SCOPE, b'body')
+    other = ResultCache(directory=str(tmp_path))
+    assert other.get('a', 2) is None
+    assert other.get('a', 1) == b'body'
+    assert other._entries['a'].scope == SCOPE
+
+
+def test_file_tier_validation(tmp_path):
+    """
+    Check cache files are plain bodies behind a JSON header, and not served unless the header matches
+    """
+
+    cache = ResultCache(directory=str(tmp_path))
+    cache.put('a', 1, SCOPE, b'line\nbody')
+    (header, body) = (tmp_path / 'a.cache').read_bytes().split(b'\n', 1)
+    assert json.loads(header)['version'] == 1 and body == b'line\nbody'
+    (tmp_path / 'b.cache').write_bytes((tmp_path / 'a.cache').read_bytes())
+    (tmp_path / 'c.cache').write_bytes(header + b'\ntruncated')
+    (tmp_path / 'd.cache').write_bytes(pickle.dumps(Entry(1, SCOPE, b'body')))
+    other = ResultCache(directory=str(tmp_path))
+    assert other.get('a', 1) == b'line\nbody'
+    assert all(other.get(key, 1) is None for key in ['b', 'c', 'd'])
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import pytest
+from datetime import date
+from pyramid.request import Request
+from ws_eidastats.serializers import chunked, json_head, json_items, JSON_TAIL, stream_arrow, period_start, hll_bytes
+from ws_eidastats.views_main import results_response
+
+
+RESULTS = [
+    {'date': '2023-01', 'node': 'GFZ', 'network': 'GE', 'station': '*', 'location': '*', 'channel': '*', 'country': 'GR',
+        'bytes': 1024, 'nb_reqs': 3, 'nb_successful_reqs': 2, 'clients': 2},
+    {'date': '2023-02', 'node': 'Other', 'network': 'Other', 'station': '*', 'location': '*', 'channel': '*', 'country': '*',
+        'bytes': 0, 'nb_reqs': 1, 'nb_successful_reqs': 0, 'clients': 1},
+]
+
+
+def response_body(param_value_dict, results, metadata=None):
+    """
+    Returns the body of the response serving the given result items of a request for start=2023-01
+    """
+    request = Request.blank('/dataselect/public', query_string='start=2023-01')
+    return b''.join(results_response(request, param_value_dict, iter(results), metadata=metadata).app_iter).decode('utf-8')
+
+
+def test_stream_json_identical_to_json_dumps():
+    """
+    Check streamed JSON body, whatever the chunk size, is identical to the whole document dumped at once
+    """
+
+    expected = json.dumps({'version': '1.0.0', 'request_parameters': 'start=2023-01', 'results': RESULTS}, default=str)
+    for chunk_size in [1, 2, 1000]:
+        body = b''.join(chunked([json_head('start=2023-01')] + list(json_items(iter(RESULTS))) + [JSON_TAIL], chunk_size))
+        assert body.decode('utf-8') == expected
+    assert response_body({'format': 'json'}, RESULTS) == expected
+    assert json.loads(response_body({'format': 'json'}, [], metadata={'next_cursor': None})) ==\
+        {'version': '1.0.0', 'request_parameters': 'start=2023-01', 'next_cursor': None, 'results': []}
+
+
+def test_stream_csv():
+    """
+    Check streamed CSV body has metadata, header and one line per result item
+    """
+
+    body = response_body({}, RESULTS, metadata={'next_cursor': 'abc', 'ignored': None})
+    assert body.split('\n') == [
+        '# version: 1.0.0',
+        '# request_parameters: start=2023-01',
+        '# next_cursor: abc',
+        'date,node,network,station,location,channel,country,bytes,nb_reqs,nb_successful_reqs,clients',
+        '2023-01,GFZ,GE,*,*,*,GR,1024,3,2,2',
+        '2023-02,Other,Other,*,*,*,*,0,1,0,1',
+    ]
+
+    body = response_body({'format': 'csv', 'hllvalues': 'true'}, [])
+    assert body.split('\n')[-1] == 'date,node,network,station,location,channel,country,bytes,nb_reqs,nb_successful_reqs,clients,hll_clients'
+
+
+def test_arrow_values():
+    """
+    Check periods are converted to their first day and HLLs to raw bytes
+    """
+
+    assert period_start('2023-02') == date(2023, 2, 1)
+    assert period_start('2023') == date(2023, 1, 1)
+    assert period_start('*') is None
+    assert hll_bytes('\\x128b7f') == hll_bytes('128b7f') == hll_bytes(memoryview(b'\x12\x8b\x7f')) == b'\x12\x8b\x7f'
+
+
+def test_stream_arrow():
+    """
+    Check Arrow and Parquet bodies, whatever the chunk size, read back as typed tables with metadata
+    """
+
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    results = [dict(r, hll_clients='\\x128b7f') for r in RESULTS]
+    for chunk_size in [1, 1000]:
+        body = b''.join(stream_arrow('start=2023-01', iter(results), hllvalues=True, metadata={'next_cursor': 'abc'}, chunk_size=chunk_size))
+        table = pyarrow.ipc.open_stream(body).read_all()
+        assert table.num_rows == 2
+        assert table.schema.field('bytes').type == pyarrow.int64() and table.schema.field('hll_clients').type == pyarrow.binary()
+        assert table.column('date').to_pylist() == [date(2023, 1, 1), date(2023, 2, 1)]
+        assert table.schema.metadata[b'next_cursor'] == b'abc'
+    body = b''.join(stream_arrow('start=2023-01', iter(RESULTS), parquet=True, chunk_size=1))
+    table = pyarrow.parquet.read_table(io.BytesIO(body))
+    assert table.column('nb_reqs').to_pylist() == [3, 1]
+    assert table.schema.metadata[b'request_parameters'] == b'start=2023-01'
@@ -40,12 +40,17 @@ def main(global_config, **settings):
     config.pyramid_openapi3_add_explorer(route=prefix+"/")
     config.registry.settings["pyramid_openapi3.enable_request_validation"] = False
     config.registry.settings["pyramid_openapi3.enable_response_validation"] = False
+    config.add_request_method('ws_eidastats.db_session.request_session', 'dbsession', reify=True)
+    config.add_tween('ws_eidastats.db_session.session_tween_factory')
     config.add_route('health', prefix+'/_health')
     config.add_route('nodes', prefix+'/nodes')
     config.add_route('networks', prefix+'/networks')
     config.add_route('dataselectrestricted', prefix+'/dataselect/restricted')
     config.add_route('dataselectpublic', prefix+'/dataselect/public')
+    config.add_route('dataselecttop', prefix+'/dataselect/top')
+    config.add_route('dataselectbatch', prefix+'/dataselect/batch')
     config.add_route('submitstat', prefix+'/submit')
+    config.add_route('submitjob', prefix+'/submit/jobs/{id}')
     config.add_route('isrestricted', prefix+'/_isRestricted')
     config.add_route('noderestriction', prefix+'/node_restriction_policy')
     config.add_route('networkrestriction', prefix+'/network_restriction_policy')
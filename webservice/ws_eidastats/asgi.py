@@ -0,0 +1,320 @@
+"""
+Optional ASGI entry point serving the read endpoints with an asynchronous PostgreSQL driver
+
+Slow aggregations only hold a connection of the async engine while they are awaited, so cheap
+requests are not queued behind them as they are behind busy worker threads of the WSGI server.
+Parameters, authentication, restriction policies, validators and result cache are handled by the
+planning functions of the WSGI views, run in threads as they only involve cheap lookups.
+
+Requires the 'asgi' extra (SQLAlchemy asyncio support and psycopg 3), run with any ASGI server:
+    uvicorn ws_eidastats.asgi:app --port 6544
+The batch, submission and restriction policy endpoints are only served by the WSGI application
+"""
+
+import asyncio
+import io
+import os
+from pyramid.request import Request
+from pyramid.response import Response
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from ws_eidastats.helper_functions import log, dbURI, Session, not_modified, set_validators, nodes_json, networks_json
+from ws_eidastats.result_cache import result_cache
+from ws_eidastats.serializers import csv_head, csv_items, json_head, json_items, JSON_TAIL, CHUNK_SIZE
+from ws_eidastats.serializers import ArrowWriter, ARROW_FORMATS, ARROW_CONTENT_TYPES
+from ws_eidastats.views_main import plan_public, plan_restricted, page, results_items, encoded, test_database, method_not_allowed
+from ws_eidastats.compression import compression
+from ws_eidastats.watermarks import POLICY_WATERMARK_SQL
+
+
+def async_uri(uri):
+    """
+    Returns the given database URI with the psycopg 3 driver, which supports asyncio
+    """
+    return 'postgresql+psycopg://' + uri.split('://', 1)[1]
+
+
+engine = create_async_engine(os.getenv('ASYNC_DBURI', async_uri(dbURI)), pool_size=10, max_overflow=20)
+
+NODES_SQL = text("SELECT name, restriction_policy FROM nodes")
+NETWORKS_SQL = text("""
+        SELECT n.name, n.restriction_policy, w.inverted_policy, w.name
+        FROM networks w JOIN nodes n ON n.id = w.node_id
+        """)
+
+
+def make_request(scope, body):
+    """
+    Returns the pyramid request of the given ASGI HTTP scope and body, as expected by the WSGI views helpers
+    """
+
+    (server_name, server_port) = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for (name, value) in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ['CONTENT_TYPE', 'CONTENT_LENGTH']:
+            key = 'HTTP_' + key
+        value = value.decode('latin-1')
+        environ[key] = environ[key] + ',' + value if key in environ and key != 'CONTENT_LENGTH' else value
+    return Request(environ)
+
+
+async def item_chunks(batches, param_value_dict):
+    """
+    Yields the serialized result items of the given batches of rows, one chunk per batch
+    """
+
+    as_json = param_value_dict.get('format') == 'json'
+    first = True
+    async for rows in batches:
+        items = list(results_items(rows, param_value_dict))
+        if not items:
+            continue
+        chunk = ''.join(json_items(items) if as_json else csv_items(items))
+        # items of a json chunk are separated, the chunks themselves need a separator too
+        yield ((', ' if as_json and not first else '') + chunk).encode('utf-8')
+        first = False
+
+
+async def arrow_chunks(batches, request, param_value_dict, metadata):
+    """
+    Yields the Arrow IPC stream, or Parquet file, of the result items of the given batches of rows
+    """
+
+    writer = ArrowWriter(request.query_string, param_value_dict.get('hllvalues') == 'true', metadata, param_value_dict['format'] == 'parquet')
+    async for rows in batches:
+        data = writer.write(list(results_items(rows, param_value_dict)))
+        if data:
+            yield data
+    yield writer.close()
+
+
+async def slices(rows):
+    """
+    Yields the given rows in batches of CHUNK_SIZE
+    """
+
+    for i in range(0, len(rows), CHUNK_SIZE):
+        yield rows[i:i + CHUNK_SIZE]
+
+
+def with_session(view, request):
+    """
+    Runs the given view or planning function of the WSGI application with a session of its own,
+    as the session tween of the WSGI application would provide, closed once it returns
+    """
+
+    request.dbsession = Session()
+    try:
+        return view(request)
+    finally:
+        request.dbsession.close()
+
+
+async def dataselect(request, planner):
+    """
+    Plans the request with the given planning function of the WSGI views and runs its query with the async engine
+    Returns the response and the asynchronous iterable of its body, None if the response holds its body
+    """
+
+    plan = await asyncio.to_thread(with_session, planner, request)
+    if isinstance(plan, Response):
+        return (plan, None)
+    param_value_dict = plan.param_value_dict
+    connection = None
+    try:
+        connection = await engine.connect()
+        metadata = None
+        if plan.stream:
+            result = await connection.stream(text(plan.query.text_sql), plan.values)
+            batches = result.partitions(CHUNK_SIZE)
+        else:
+            rows = (await connection.execute(text(plan.query.text_sql), plan.values)).all()
+            if 'limit' in param_value_dict:
+                (rows, metadata) = page(rows, param_value_dict, plan.query)
+            batches = slices(rows)
+    except Exception as e:
+        log.error(str(e))
+        if connection is not None:
+            await connection.close()
+        return (Response("<h1>500 Internal Server Error</h1><p>Database connection error or invalid SQL statement passed to database</p>", status_code=500), None)
+
+    if param_value_dict.get('format') in ARROW_FORMATS:
+        response = Response(app_iter=[], content_type=ARROW_CONTENT_TYPES[param_value_dict['format']])
+        if plan.etag is not None:
+            set_validators(response, plan.etag, plan.last_modified)
+        return (response, closing(arrow_chunks(batches, request, param_value_dict, metadata), connection))
+
+    if param_value_dict.get('format') == 'json':
+        (head, tail, content_type) = (json_head(request.query_string, metadata).encode('utf-8'), JSON_TAIL.encode('utf-8'), 'application/json')
+    else:
+        head = csv_head(request.query_string, param_value_dict.get('hllvalues') == 'true', metadata).encode('utf-8')
+        (tail, content_type) = (b'', 'text/csv')
+    items = item_chunks(batches, param_value_dict)
+    encoding = plan.encoding
+    if encoding is not None:
+        try:
+            (read, items, exhausted) = await compression.apeek(items, compression.threshold - len(head) - len(tail))
+        except Exception as e:
+            log.error(str(e))
+            await connection.close()
+            return (Response("<h1>500 Internal Server Error</h1><p>Database connection error or invalid SQL statement passed to database</p>", status_code=500), None)
+        if compression.below_threshold(read, exhausted, len(head) + len(tail)):
+            encoding = None
+        items = chained(read, items)
+    if plan.cache_entry is not None and encoding is None:
+        items = result_cache.afill(*plan.cache_entry, items)
+
+    body = chained([head], items, [tail])
+    if encoding is not None:
+        body = compression.aencode(body, encoding)
+        if plan.encoded_cache_entry is not None:
+            body = result_cache.afill(*plan.encoded_cache_entry, body)
+    response = encoded(Response(app_iter=[], content_type=content_type, charset='utf-8'), encoding)
+    if plan.etag is not None:
+        set_validators(response, plan.etag, plan.last_modified)
+    return (response, closing(body, connection))
+
+
+async def chained(*parts):
+    """
+    Yields the non-empty chunks of the given lists and asynchronous iterables of chunks, in order
+    """
+
+    for part in parts:
+        if isinstance(part, list):
+            for chunk in part:
+                if chunk:
+                    yield chunk
+        else:
+            async for chunk in part:
+                yield chunk
+
+
+async def closing(chunks, connection):
+    """
+    Yields the given chunks and closes the connection once they are consumed or the response is aborted
+    """
+
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await connection.close()
+
+
+async def public(request):
+    return await dataselect(request, plan_public)
+
+
+async def restricted(request):
+    return await dataselect(request, plan_restricted)
+
+
+async def top(request):
+    return await dataselect(request, plan_restricted if request.method == 'POST' else plan_public)
+
+
+async def listing(request, name, sql, to_json):
+    """
+    Returns the response of the /nodes or /networks listing, following the restriction policy version
+    """
+
+    try:
+        async with engine.connect() as connection:
+            (version, updated_at) = (await connection.execute(POLICY_WATERMARK_SQL)).first()
+            etag = f"{name}-{version}"
+            response = not_modified(request, etag, updated_at)
+            if response is not None:
+                return (response, None)
+            rows = (await connection.execute(sql)).all()
+    except Exception as e:
+        log.error(str(e))
+        return (Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500), None)
+    return (set_validators(Response(json=to_json(rows), content_type='application/json'), etag, updated_at), None)
+
+
+async def nodes(request):
+    return await listing(request, 'nodes', NODES_SQL, nodes_json)
+
+
+async def networks(request):
+    return await listing(request, 'networks', NETWORKS_SQL, networks_json)
+
+
+async def health(request):
+    return (await asyncio.to_thread(with_session, test_database, request), None)
+
+
+PREFIX = os.getenv('EIDASTATS_API_PATH', '')
+# route path: (allowed methods, None for any, handler)
+ROUTES = {
+    PREFIX + '/_health': (['GET'], health),
+    PREFIX + '/nodes': (['GET'], nodes),
+    PREFIX + '/networks': (['GET'], networks),
+    PREFIX + '/dataselect/public': (['GET'], public),
+    PREFIX + '/dataselect/restricted': (None, restricted),
+    PREFIX + '/dataselect/top': (['GET', 'POST'], top),
+}
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_response(send, response, body=None):
+    headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for (k, v) in response.headerlist]
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    if body is None:
+        for chunk in response.app_iter:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    else:
+        async for chunk in body:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def app(scope, receive, send):
+    """
+    ASGI application
+    """
+
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    request = make_request(scope, await read_body(receive))
+    log.info(f"{request.method} {request.url}")
+    (methods, handler) = ROUTES.get(scope['path'], ([], None))
+    if handler is None:
+        (response, body) = (Response("<h1>404 Not Found</h1>", status_code=404), None)
+    elif methods is not None and request.method not in methods:
+        (response, body) = (method_not_allowed(methods), None)
+    else:
+        (response, body) = await handler(request)
+    await send_response(send, response, body)
@@ -0,0 +1,106 @@
+import os
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+from ws_eidastats.helper_functions import log
+
+
+class Compression:
+    """
+    Streaming compression of response bodies, negotiated with the Accept-Encoding header of the request
+    Bodies are compressed chunk by chunk as they are serialized, except bodies that end below the size threshold
+    zstd is only offered if the zstandard package is installed
+    """
+
+    def __init__(self, encodings=('zstd', 'gzip'), threshold=4096, gzip_level=6, zstd_level=3):
+        self.encodings = [e for e in encodings if e == 'gzip' or (e == 'zstd' and zstandard is not None)]
+        self.threshold = threshold
+        self.gzip_level = gzip_level
+        self.zstd_level = zstd_level
+
+    @property
+    def enabled(self):
+        return len(self.encodings) > 0
+
+    def negotiate(self, request):
+        """
+        Returns the preferred encoding accepted by the request, None if the body must not be compressed
+        Encodings of equal quality are preferred in the configured order
+        """
+        if not self.enabled or 'Accept-Encoding' not in request.headers:
+            return None
+        offers = request.accept_encoding.acceptable_offers(self.encodings)
+        return offers[0][0] if offers else None
+
+    def compressor(self, encoding):
+        if encoding == 'zstd':
+            return zstandard.ZstdCompressor(level=self.zstd_level).compressobj()
+        # gzip container, as expected by 'Content-Encoding: gzip'
+        return zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+
+    def peek(self, chunks, size):
+        """
+        Reads chunks until size bytes are read or chunks are exhausted
+        Returns the chunks read, the iterator of the remaining chunks and whether chunks are exhausted
+        """
+        chunks = iter(chunks)
+        read = []
+        total = 0
+        for chunk in chunks:
+            read.append(chunk)
+            total += len(chunk)
+            if total >= size:
+                return (read, chunks, False)
+        return (read, chunks, True)
+
+    async def apeek(self, chunks, size):
+        """
+        Same as peek, for asynchronous iterators of chunks
+        """
+        read = []
+        total = 0
+        async for chunk in chunks:
+            read.append(chunk)
+            total += len(chunk)
+            if total >= size:
+                return (read, chunks, False)
+        return (read, chunks, True)
+
+    def below_threshold(self, read, exhausted, extra=0):
+        """
+        Tells whether a body, whose chunks read so far and exhaustion are given, is too small to be compressed
+        extra is the size of the parts of the body not in the chunks
+        """
+        return exhausted and sum(len(c) for c in read) + extra < self.threshold
+
+    def encode(self, chunks, encoding):
+        """
+        Yields the given chunks compressed with the given encoding
+        """
+        log.debug(f"Compressing response body with {encoding}")
+        compressor = self.compressor(encoding)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    async def aencode(self, chunks, encoding):
+        """
+        Same as encode, for asynchronous iterables of chunks
+        """
+        compressor = self.compressor(encoding)
+        async for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+compression = Compression(
+    encodings=[e.strip() for e in os.getenv('EIDASTATS_COMPRESSION', 'zstd,gzip').split(',') if e.strip()],
+    threshold=int(os.getenv('EIDASTATS_COMPRESSION_THRESHOLD', 4096)),
+    gzip_level=int(os.getenv('EIDASTATS_GZIP_LEVEL', 6)),
+    zstd_level=int(os.getenv('EIDASTATS_ZSTD_LEVEL', 3)))
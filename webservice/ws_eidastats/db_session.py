@@ -0,0 +1,129 @@
+"""
+Request-scoped database sessions
+
+Views get their session from request.dbsession, created on first use with its connection checked out
+from the pool right away, and always closed by the session tween: once the view returns for in-memory
+bodies, once the WSGI server closes the body for streamed ones, and when the view raises.
+The pool statistics of each request that used the database are logged and returned in the
+Server-Timing header: connections checked out and overflow when the connection was acquired,
+time waited for a pooled connection and time spent opening a new one.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import event
+from ws_eidastats.helper_functions import log, Session, engine
+
+
+SESSION_KEY = 'ws_eidastats.session'
+STATS_KEY = 'ws_eidastats.pool_stats'
+
+# checked_out and overflow are the numbers of connections checked out and beyond the pool size once the connection
+# of the request is acquired, None if the pool does not tell; wait and connect are durations in milliseconds
+PoolStats = namedtuple('PoolStats', ['checked_out', 'overflow', 'wait', 'connect'])
+
+# time spent opening new connections by the current thread
+_connect = threading.local()
+
+
+def instrument(engine):
+    """
+    Measures the time spent opening new connections of the given engine
+    """
+
+    @event.listens_for(engine, 'do_connect')
+    def before_connect(dialect, connection_record, cargs, cparams):
+        _connect.started = time.perf_counter()
+
+    @event.listens_for(engine.pool, 'connect')
+    def after_connect(dbapi_connection, connection_record):
+        started = getattr(_connect, 'started', None)
+        if started is not None:
+            _connect.elapsed = getattr(_connect, 'elapsed', 0.0) + time.perf_counter() - started
+            _connect.started = None
+
+
+instrument(engine)
+
+
+def request_session(request):
+    """
+    Returns the session of the request, created with its connection on first use
+    Registered as the reified request.dbsession property
+    """
+
+    session = Session()
+    _connect.elapsed = 0.0
+    started = time.perf_counter()
+    try:
+        session.connection()
+    except Exception:
+        session.close()
+        raise
+    elapsed = time.perf_counter() - started
+    pool = session.get_bind().pool
+    checked_out = pool.checkedout() if hasattr(pool, 'checkedout') else None
+    overflow = pool.overflow() if hasattr(pool, 'overflow') else None
+    request.environ[SESSION_KEY] = session
+    request.environ[STATS_KEY] = PoolStats(checked_out, overflow, (elapsed - _connect.elapsed) * 1000, _connect.elapsed * 1000)
+    return session
+
+
+class ClosingAppIter:
+    """
+    Body iterable calling the given callback once closed by the WSGI server, after closing the given body
+    """
+
+    def __init__(self, app_iter, callback):
+        self.app_iter = app_iter
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.callback()
+
+
+def close_session(request):
+    """
+    Closes the session of the request if it was created, which rolls back any uncommitted transaction
+    and returns its connection to the pool
+    """
+
+    session = request.environ.pop(SESSION_KEY, None)
+    if session is not None:
+        session.close()
+
+
+def session_tween_factory(handler, registry):
+    """
+    Tween closing the session of each request and reporting its pool statistics
+    """
+
+    def session_tween(request):
+        try:
+            response = handler(request)
+        except BaseException:
+            close_session(request)
+            raise
+        if SESSION_KEY not in request.environ:
+            return response
+
+        stats = request.environ[STATS_KEY]
+        log.info(f"Pool: {stats.checked_out} checked out, {stats.overflow} overflow, "
+                 f"waited {stats.wait:.1f} ms, connected in {stats.connect:.1f} ms")
+        response.headers['Server-Timing'] = f"db-wait;dur={stats.wait:.1f}, db-connect;dur={stats.connect:.1f}"
+        # streamed bodies still read from the session
+        if isinstance(response.app_iter, (list, tuple)):
+            close_session(request)
+        else:
+            response.app_iter = ClosingAppIter(response.app_iter, lambda: close_session(request))
+        return response
+
+    return session_tween
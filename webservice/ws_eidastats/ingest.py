@@ -0,0 +1,380 @@
+"""
+Ingestion of the statistics payloads submitted by the nodes
+
+Statistics are normalized, streamed into a temporary staging table with COPY, then merged into
+dataselect_stats with a single INSERT ... SELECT ... ON CONFLICT, in the transaction that registers
+the payload, along with the monthly rollup and the change watermarks of the touched months.
+Statistics may be read lazily, see ws_eidastats.payload: they are then checked, hashed, normalized
+and serialized COPY_BATCH at a time, so that memory does not grow with the size of the payload.
+"""
+
+import csv
+import io
+from datetime import datetime, timedelta
+import mmh3
+from sqlalchemy import exc
+from sqlalchemy.sql import text
+from ws_eidastats.helper_functions import log
+from ws_eidastats.payload import PayloadError, check_metadata
+from ws_eidastats.result_cache import result_cache
+from ws_eidastats.watermarks import bump_watermarks
+from ws_eidastats.partitions import ensure_partitions, known_partitions
+
+
+class DuplicatePayload(Exception):
+    "Raised when a payload has already been registered"
+    pass
+
+
+class OverlappingPayload(Exception):
+    "Raised when the coverage of a payload overlaps payloads already registered for its node, with the (first, last) runs of conflicting days"
+
+    def __init__(self, days):
+        super().__init__(days)
+        self.days = days
+
+    def __str__(self):
+        days = ', '.join(str(first) if first == last else f"{first}/{last}" for (first, last) in self.days)
+        return f"Coverage overlaps statistics already submitted by this node for days {days}. Refusing to merge"
+
+
+PAYLOAD_SQL = text("""
+        INSERT INTO payloads (node_id, hash, version, generated_at, coverage)
+        VALUES (:n, :h, :v, :g, CAST(:c AS datemultirange))
+        RETURNING id
+        """)
+
+# payloads of a node are registered one at a time, so that concurrent overlapping payloads are caught
+PAYLOAD_LOCK_SQL = text("SELECT pg_advisory_xact_lock(hashtext('payloads'), :node_id)")
+
+# days of the coverage also covered by other payloads of the node, found with the GiST index on (node_id, coverage)
+OVERLAP_SQL = text("""
+        SELECT lower(r), upper(r) - 1
+        FROM (
+          SELECT range_agg(coverage * CAST(:coverage AS datemultirange)) AS days
+          FROM payloads
+          WHERE node_id = :node_id AND coverage && CAST(:coverage AS datemultirange) AND id <> :id
+        ) o, unnest(o.days) AS r
+        ORDER BY 1
+        """)
+
+# columns of the staged statistics, in COPY order
+STAGING_COLUMNS = ['date', 'network', 'station', 'location', 'channel', 'country',
+                   'bytes', 'nb_reqs', 'nb_successful_reqs', 'nb_failed_reqs', 'clients']
+# seq numbers the staged rows in payload order
+STAGING_SQL = text("""
+        CREATE TEMPORARY TABLE dataselect_stats_staging (
+        seq bigint GENERATED ALWAYS AS IDENTITY,
+        date date,
+        network text,
+        station text,
+        location text,
+        channel text,
+        country text,
+        bytes bigint,
+        nb_reqs bigint,
+        nb_successful_reqs bigint,
+        nb_failed_reqs bigint,
+        clients public.hll
+        ) ON COMMIT DROP
+        """)
+# NULL is spelled \N so that empty strings, such as normalized countries, are not read as NULL
+COPY_SQL = f"COPY dataselect_stats_staging ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+# staged statistics of the same key are reduced to one row first, as a row can only be updated once by a statement
+MERGE_INSERT = """
+        INSERT INTO dataselect_stats
+        (
+          node_id, date, network, station, location, channel, country,
+          bytes, nb_reqs, nb_successful_reqs, nb_failed_reqs, clients
+        )
+        """
+MERGE_SQL = {
+    # POST adds counters and unions client HLLs, also those of the same key within the payload
+    'POST': text(MERGE_INSERT + """
+        SELECT :node_id, date, network, station, location, channel, country,
+        sum(bytes), sum(nb_reqs), sum(nb_successful_reqs), sum(nb_failed_reqs), hll_union_agg(clients)
+        FROM dataselect_stats_staging
+        GROUP BY date, network, station, location, channel, country
+        ON CONFLICT ON CONSTRAINT uniq_stat DO UPDATE SET
+        bytes = EXCLUDED.bytes + dataselect_stats.bytes,
+        nb_reqs = EXCLUDED.nb_reqs + dataselect_stats.nb_reqs,
+        nb_successful_reqs = EXCLUDED.nb_successful_reqs + dataselect_stats.nb_successful_reqs,
+        nb_failed_reqs = EXCLUDED.nb_failed_reqs + dataselect_stats.nb_failed_reqs,
+        clients = EXCLUDED.clients || dataselect_stats.clients,
+        updated_at = now()
+        """),
+    # PUT overwrites them, with the last statistic of the same key within the payload
+    'PUT': text(MERGE_INSERT + """
+        SELECT DISTINCT ON (date, network, station, location, channel, country)
+        :node_id, date, network, station, location, channel, country,
+        bytes, nb_reqs, nb_successful_reqs, nb_failed_reqs, clients
+        FROM dataselect_stats_staging
+        ORDER BY date, network, station, location, channel, country, seq DESC
+        ON CONFLICT ON CONSTRAINT uniq_stat DO UPDATE SET
+        bytes = EXCLUDED.bytes,
+        nb_reqs = EXCLUDED.nb_reqs,
+        nb_successful_reqs = EXCLUDED.nb_successful_reqs,
+        nb_failed_reqs = EXCLUDED.nb_failed_reqs,
+        clients = EXCLUDED.clients,
+        created_at = now()
+        """),
+}
+
+MONTHS_SQL = text("SELECT DISTINCT date FROM dataselect_stats_staging")
+KEYS_SQL = text("SELECT DISTINCT date, network, country FROM dataselect_stats_staging ORDER BY 1, 2, 3")
+
+# recompute the monthly rollup of the (date, network, country) keys touched by a submission,
+# from the statistics table, so that the rollup stays exact for both POST and PUT
+ROLLUP_SQL = text("""
+        INSERT INTO dataselect_stats_monthly
+        (
+          node_id, date, network, country,
+          bytes, nb_reqs, nb_successful_reqs, nb_failed_reqs, clients
+        )
+        SELECT s.node_id, s.date, s.network, coalesce(s.country, ''),
+        sum(s.bytes), sum(s.nb_reqs), sum(s.nb_successful_reqs), sum(s.nb_failed_reqs), hll_union_agg(s.clients)
+        FROM dataselect_stats s
+        JOIN unnest(CAST(:dates AS date[]), CAST(:networks AS text[]), CAST(:countries AS text[])) AS k(date, network, country)
+        ON s.date = k.date AND s.network = k.network AND coalesce(s.country, '') = k.country
+        WHERE s.node_id = :node_id
+        GROUP BY s.node_id, s.date, s.network, coalesce(s.country, '')
+        ON CONFLICT (node_id, date, network, country) DO UPDATE SET
+        bytes = EXCLUDED.bytes,
+        nb_reqs = EXCLUDED.nb_reqs,
+        nb_successful_reqs = EXCLUDED.nb_successful_reqs,
+        nb_failed_reqs = EXCLUDED.nb_failed_reqs,
+        clients = EXCLUDED.clients,
+        updated_at = now()
+        """)
+
+# number of rows serialized at once for COPY
+COPY_BATCH = 1000
+
+
+class Fingerprint:
+    """
+    Order-independent 128-bit fingerprint of statistics, fed with their normalized rows one at a time
+    Each row is hashed with the 128-bit mmh3 of its canonical form, the repr of the row tuple, and hashes are
+    summed modulo 2^128, so that the fingerprint depends neither on the order of the statistics nor on their keys
+    """
+
+    MODULUS = 2**128
+
+    def __init__(self):
+        self._sum = 0
+
+    @property
+    def value(self):
+        return self._sum % self.MODULUS
+
+    def update(self, row):
+        self._sum += mmh3.hash128(repr(tuple(row)).encode('utf-8'), signed=False)
+
+    def rows(self, rows):
+        """
+        Yields the given rows, feeding the fingerprint with them
+        """
+        for row in rows:
+            self.update(row)
+            yield row
+
+
+def normalized_rows(statistics):
+    """
+    Yields the statistics of a payload as tuples of STAGING_COLUMNS values, with missing values fixed
+    """
+    for item in statistics:
+        if 'country' not in item.keys() or item['country'] is None or len(item['country']) != 2:
+            item['country'] = ''
+        # if unsuccessful requests in Null, set it to 0
+        if 'nb_unsuccessful_requests' not in item.keys() or item['nb_unsuccessful_requests'] is None:
+            item['nb_unsuccessful_requests'] = 0
+        # if successful requests is Null, set it to nb_requests+nb_unsuccessful_requests
+        if 'nb_requests' not in item.keys() or item['nb_requests'] is None:
+            item['nb_requests'] = item['nb_successful_requests'] + item['nb_unsuccessful_requests']
+        yield (item['month'], item['network'], item['station'], item['location'], item['channel'], item['country'],
+               item['bytes'], item['nb_requests'], item['nb_successful_requests'], item['nb_unsuccessful_requests'], item['clients'])
+
+
+class CsvRows:
+    """
+    File-like object reading the given rows as CSV, serialized batch by batch as COPY reads them
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.count = 0
+        self._buffer = ''
+        self._exhausted = False
+        # error raised by the rows, which drivers report as a failed COPY
+        self.error = None
+
+    def _fill(self):
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        for row in self.rows:
+            writer.writerow(['\\N' if v is None else v for v in row])
+            self.count += 1
+            if self.count % COPY_BATCH == 0:
+                break
+        else:
+            self._exhausted = True
+        self._buffer += out.getvalue()
+
+    def read(self, size=-1):
+        while not self._exhausted and (size < 0 or len(self._buffer) < size):
+            try:
+                self._fill()
+            except Exception as err:
+                self.error = err
+                raise
+        if size < 0:
+            (data, self._buffer) = (self._buffer, '')
+        else:
+            (data, self._buffer) = (self._buffer[:size], self._buffer[size:])
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def stage_statistics(session, rows):
+    """
+    Streams the given normalized rows into the staging table of the transaction with COPY
+    Returns the number of staged rows
+    """
+    session.execute(STAGING_SQL)
+    source = CsvRows(rows)
+    cursor = session.connection().connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            # psycopg2
+            cursor.copy_expert(COPY_SQL, source)
+        else:
+            # psycopg 3
+            with cursor.copy(COPY_SQL) as copy:
+                for data in iter(lambda: source.read(1 << 16), ''):
+                    copy.write(data)
+    except Exception:
+        if source.error is not None:
+            raise source.error
+        raise
+    finally:
+        cursor.close()
+    return source.count
+
+
+def merge_statistics(session, node_id, operation='POST'):
+    """
+    Merges the staged statistics into dataselect_stats with the semantics of the operation, POST or PUT
+    Returns the sorted (date, network, country) keys of the staged statistics
+    """
+    session.execute(MERGE_SQL[operation], {'node_id': node_id})
+    return [tuple(row) for row in session.execute(KEYS_SQL)]
+
+
+def coverage_runs(days):
+    """
+    Returns the runs of consecutive days of the given days, as sorted (first, last) tuples
+    """
+    runs = []
+    for day in sorted(set(days)):
+        if runs and day == runs[-1][1] + timedelta(days=1):
+            runs[-1] = (runs[-1][0], day)
+        else:
+            runs.append((day, day))
+    return runs
+
+
+def multirange(runs):
+    """
+    Returns the datemultirange literal of the given runs of days
+    """
+    return '{' + ','.join(f"[{first},{last}]" for (first, last) in runs) + '}'
+
+
+def register_payload(session, node_id, payload, fingerprint, operation='POST'):
+    """
+    Registers the payload, with the given fingerprint of its statistics, in the transaction of the session
+    Raises DuplicatePayload if it is already registered, PayloadError if its coverage is not a list of days,
+    and for POST, which adds to existing statistics, OverlappingPayload if its coverage overlaps other payloads of the node
+    """
+    try:
+        coverage = multirange(coverage_runs(datetime.strptime(v, '%Y-%m-%d').date() for v in payload['days_coverage']))
+    except (TypeError, ValueError) as err:
+        session.rollback()
+        log.error(err)
+        raise PayloadError("Malformed payload")
+    log.debug(coverage)
+    try:
+        session.execute(PAYLOAD_LOCK_SQL, {'node_id': node_id})
+        payload_id = session.execute(PAYLOAD_SQL, {'n':node_id, 'h':fingerprint, 'v':payload['version'],
+                                                   'g':payload['generated_at'], 'c':coverage}).scalar()
+        overlap = [] if operation != 'POST' else \
+            [tuple(row) for row in session.execute(OVERLAP_SQL, {'node_id': node_id, 'coverage': coverage, 'id': payload_id})]
+    except exc.DBAPIError as err:
+        session.rollback()
+        log.error("Postgresql error %s registering payload", err.orig.pgcode)
+        log.error(err.orig.pgerror)
+        if err.orig.pgcode == '23505':
+            log.error("Duplicate payload")
+            raise DuplicatePayload
+        raise err
+    if overlap:
+        session.rollback()
+        log.error(f"Payload coverage overlaps {len(overlap)} ranges of days already covered")
+        raise OverlappingPayload(overlap)
+
+
+def ingest(session, node_id, payload, operation='POST'):
+    """
+    Registers the payload and insert or update its statistics in one transaction
+    params:
+    - payload is a payload whose stats, a list or an iterator, map to the table dataselect_stats schema but
+      without the node_id; its other members are only looked at once the statistics have been read
+    - operation is the method POST of PUT
+    Note: If statistics with a new network are to be inserted, an SQL trigger function takes care of inserting
+    the appropriate necessary record at networks table first
+    The monthly rollup of the touched (month, network, country) and the change watermarks of the touched months
+    are updated in the same transaction, then the cached results covering these months are dropped
+    Missing monthly partitions of dataselect_stats are created in the same transaction
+    The payload is registered once its statistics are staged, as their fingerprint is only known then,
+    so that duplicate payloads cost a full read and staging pass but no merge
+    Raises DuplicatePayload if the payload is already registered, OverlappingPayload if a POST payload covers
+    days already covered by the node, PayloadError if it is malformed
+    """
+    if operation not in MERGE_SQL:
+        log.error("Operation %s not supported (POST or PUT only)", operation)
+        raise ValueError(operation)
+
+    fingerprint = Fingerprint()
+    try:
+        count = stage_statistics(session, fingerprint.rows(normalized_rows(payload['stats'])))
+        if not check_metadata(payload):
+            raise PayloadError("Malformed payload")
+    except Exception:
+        session.rollback()
+        raise
+    # duplicate and overlapping payloads are refused once the statistics are staged, before they are merged:
+    # the fingerprint covers every statistic, which are staged as they are read so that memory stays bounded,
+    # and a digest of the raw body would only catch byte-identical resubmissions
+    register_payload(session, node_id, payload, fingerprint.value, operation)
+    log.info(f"Registering {count} statistics.")
+    try:
+        months = [row[0] for row in session.execute(MONTHS_SQL)]
+        # partitions are created in this transaction, as committing it would drop the staging table
+        partitions = ensure_partitions(session, months)
+        keys = merge_statistics(session, node_id, operation)
+        session.execute(ROLLUP_SQL, {'node_id': node_id, 'dates': [k[0] for k in keys],
+            'networks': [k[1] for k in keys], 'countries': [k[2] for k in keys]})
+        bump_watermarks(session, node_id, [k[0] for k in keys])
+        session.commit()
+    except exc.DBAPIError as err:
+        session.rollback()
+        log.error("Postgresql error %s registering statistic", err.orig.pgcode)
+        log.error(err.orig.pgerror)
+        raise err
+    known_partitions(partitions)
+    result_cache.invalidate(node_id, [k[0] for k in keys])
+    log.info("Statistics successfully registered")
@@ -0,0 +1,222 @@
+"""
+Durable queue of the payloads submitted asynchronously by the nodes
+
+Accepted bodies are copied as received to a spool directory and recorded in the ingest_jobs table, then drained
+by ingestion workers (see ws_eidastats.ingest_worker) claiming jobs with SELECT ... FOR UPDATE SKIP LOCKED.
+Only the oldest pending job of each node can be claimed, so that the payloads of a node are ingested one at a
+time and in order, and nodes are served in turn whatever the number of jobs each one queued.
+"""
+
+import os
+import tempfile
+from sqlalchemy import exc
+from sqlalchemy.sql import text
+from ws_eidastats.helper_functions import log
+from ws_eidastats.ingest import ingest, DuplicatePayload, OverlappingPayload
+from ws_eidastats.payload import PayloadReader, PayloadError, decoded_stream, READ_SIZE
+
+
+ENQUEUE_SQL = text("""
+        INSERT INTO ingest_jobs (node_id, operation, path, size)
+        VALUES (:node_id, :operation, :path, :size)
+        RETURNING id
+        """)
+
+# serializes the depth checks and inserts of concurrent submissions, so that the queue limits hold
+QUEUE_LOCK_SQL = text("SELECT pg_advisory_xact_lock(hashtext('ingest_jobs'))")
+
+DEPTH_SQL = text("""
+        SELECT count(*), count(*) FILTER (WHERE node_id = :node_id)
+        FROM ingest_jobs WHERE status IN ('queued', 'running')
+        """)
+
+STATUS_SQL = text("""
+        SELECT id, status, operation, size, attempts, message, created_at, started_at, finished_at
+        FROM ingest_jobs WHERE id = :id AND node_id = :node_id
+        """)
+
+# jobs left running for longer than the timeout belong to a dead worker and are claimed again
+CLAIM_SQL = text("""
+        UPDATE ingest_jobs SET status = 'running', started_at = now(), attempts = attempts + 1
+        WHERE id = (
+          SELECT id FROM ingest_jobs
+          WHERE id IN (
+            SELECT DISTINCT ON (node_id) id FROM ingest_jobs
+            WHERE status IN ('queued', 'running')
+            ORDER BY node_id, id
+          )
+          AND (status = 'queued' OR started_at < now() - make_interval(secs => :timeout))
+          ORDER BY id
+          LIMIT 1
+          FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, node_id, operation, path, attempts
+        """)
+
+FINISH_SQL = text("""
+        UPDATE ingest_jobs SET status = :status, message = :message, finished_at = now()
+        WHERE id = :id
+        """)
+
+REQUEUE_SQL = text("UPDATE ingest_jobs SET status = 'queued', message = :message WHERE id = :id")
+
+
+class QueueFull(Exception):
+    "Raised when the queue, or the share of the queue of a node, is full"
+    pass
+
+
+class PayloadTooLarge(Exception):
+    "Raised when a payload exceeds the maximum size of spooled payloads"
+    pass
+
+
+class IngestQueue:
+    """
+    Queue of ingestion jobs, whose payloads are spooled in the given directory
+    Asynchronous submission is disabled without a directory
+    params:
+    - max_jobs: maximum number of pending jobs
+    - max_node_jobs: maximum number of pending jobs of a node
+    - max_bytes: maximum size in bytes of a spooled payload, as received
+    - retry_after: seconds clients are told to wait when the queue is full
+    - timeout: seconds after which a running job is considered abandoned
+    - attempts: maximum number of times a job is claimed
+    """
+
+    def __init__(self, directory=None, max_jobs=100, max_node_jobs=10, max_bytes=256*2**20, retry_after=60, timeout=3600, attempts=3):
+        self.directory = directory
+        self.max_jobs = max_jobs
+        self.max_node_jobs = max_node_jobs
+        self.max_bytes = max_bytes
+        self.retry_after = retry_after
+        self.timeout = timeout
+        self.attempts = attempts
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def check_depth(self, session, node_id):
+        """
+        Raises QueueFull if there are too many pending jobs, overall or for the node
+        """
+        (depth, node_depth) = session.execute(DEPTH_SQL, {'node_id': node_id}).one()
+        if depth >= self.max_jobs or node_depth >= self.max_node_jobs:
+            log.warning(f"Ingestion queue full: {depth} pending jobs, {node_depth} of node {node_id}")
+            raise QueueFull
+
+    def spool(self, node_id, fileobj):
+        """
+        Copies the payload read from fileobj to a new file of the spool directory and returns its path
+        Raises PayloadTooLarge if the payload exceeds max_bytes, the file being removed
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.directory, prefix=f"payload-{node_id}-", delete=False) as spool:
+            try:
+                size = 0
+                for data in iter(lambda: fileobj.read(READ_SIZE), b''):
+                    size += len(data)
+                    if size > self.max_bytes:
+                        log.warning(f"Payload of node {node_id} exceeds {self.max_bytes} bytes")
+                        raise PayloadTooLarge
+                    spool.write(data)
+                spool.flush()
+                os.fsync(spool.fileno())
+            except BaseException:
+                os.unlink(spool.name)
+                raise
+        return spool.name
+
+    def enqueue(self, session, node_id, operation, fileobj):
+        """
+        Spools the payload read from fileobj and queues its ingestion
+        Returns the job id
+        Raises QueueFull if there are too many pending jobs, overall or for the node, PayloadTooLarge if the
+        payload exceeds max_bytes
+        The depth of the queue is checked before spooling the payload, then again along with the insert of the job
+        under a transaction-level advisory lock, so that concurrent submissions can not exceed the limits
+        """
+        self.check_depth(session, node_id)
+        session.rollback()
+        path = self.spool(node_id, fileobj)
+        try:
+            session.execute(QUEUE_LOCK_SQL)
+            self.check_depth(session, node_id)
+            job_id = session.execute(ENQUEUE_SQL, {'node_id': node_id, 'operation': operation, 'path': path,
+                                                   'size': os.path.getsize(path)}).scalar()
+            session.commit()
+        except BaseException:
+            session.rollback()
+            os.unlink(path)
+            raise
+        log.info(f"Payload of node {node_id} queued as job {job_id}")
+        return job_id
+
+    def status(self, session, node_id, job_id):
+        """
+        Returns the status of a job of the node as a dictionary, None if there is no such job
+        """
+        row = session.execute(STATUS_SQL, {'id': job_id, 'node_id': node_id}).first()
+        if row is None:
+            return None
+        status = dict(row._mapping)
+        for key in ('created_at', 'started_at', 'finished_at'):
+            if status[key] is not None:
+                status[key] = status[key].isoformat()
+        return status
+
+    def claim(self, session):
+        """
+        Marks the next job to ingest as running and returns it, None if there is none
+        """
+        job = session.execute(CLAIM_SQL, {'timeout': self.timeout}).first()
+        session.commit()
+        return job
+
+    def finish(self, session, job, status, message=None):
+        session.execute(FINISH_SQL, {'id': job.id, 'status': status, 'message': message})
+        session.commit()
+        if os.path.exists(job.path):
+            os.unlink(job.path)
+        log.info(f"Job {job.id} {status}" + (f": {message}" if message else ''))
+
+    def process(self, session, job):
+        """
+        Ingests the payload of the claimed job and records the outcome
+        Jobs failing on unexpected errors are queued again, until claimed too many times
+        """
+        if job.attempts > self.attempts:
+            return self.finish(session, job, 'failed', f"Abandoned after {job.attempts - 1} attempts")
+        try:
+            with open(job.path, 'rb') as body:
+                ingest(session, job.node_id, PayloadReader(decoded_stream(body)).payload, job.operation)
+        except (PayloadError, OverlappingPayload) as err:
+            return self.finish(session, job, 'failed', str(err))
+        except DuplicatePayload:
+            return self.finish(session, job, 'failed', "This statistic already exists on the server. Refusing to merge")
+        except FileNotFoundError:
+            return self.finish(session, job, 'failed', "Payload lost from the spool directory")
+        except Exception as err:
+            log.error(f"Job {job.id}: {err}")
+            session.rollback()
+            if job.attempts >= self.attempts:
+                return self.finish(session, job, 'failed', "Error on statistics ingestion")
+            try:
+                session.execute(REQUEUE_SQL, {'id': job.id, 'message': "Error on statistics ingestion, will be retried"})
+                session.commit()
+            except exc.DBAPIError:
+                # left running, the job is claimed again after the timeout
+                session.rollback()
+            return
+        self.finish(session, job, 'done')
+
+
+ingest_queue = IngestQueue(
+    directory=os.getenv('EIDASTATS_SPOOL_DIR'),
+    max_jobs=int(os.getenv('EIDASTATS_QUEUE_SIZE', 100)),
+    max_node_jobs=int(os.getenv('EIDASTATS_QUEUE_NODE_SIZE', 10)),
+    max_bytes=int(os.getenv('EIDASTATS_QUEUE_PAYLOAD_SIZE', 256))*2**20,
+    retry_after=int(os.getenv('EIDASTATS_QUEUE_RETRY_AFTER', 60)),
+    timeout=int(os.getenv('EIDASTATS_JOB_TIMEOUT', 3600)),
+    attempts=int(os.getenv('EIDASTATS_JOB_ATTEMPTS', 3)))
@@ -0,0 +1,63 @@
+"""
+Ingestion workers draining the queue of asynchronously submitted payloads, see ws_eidastats.ingest_queue
+
+Usage: DBURI=postgresql://... EIDASTATS_SPOOL_DIR=... python -m ws_eidastats.ingest_worker [--processes N] [--poll SECONDS]
+Workers finish the job at hand before stopping on SIGINT or SIGTERM.
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+from ws_eidastats.helper_functions import log, Session, engine
+from ws_eidastats.ingest_queue import ingest_queue
+
+
+def work(stopping, poll):
+    """
+    Claims and ingests jobs until stopping is set, waiting poll seconds when the queue is empty
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # connections of the pool must not be shared with the parent process
+    engine.dispose(close=False)
+    log.info(f"Ingestion worker {os.getpid()} started")
+    while not stopping.is_set():
+        try:
+            with Session() as session:
+                job = ingest_queue.claim(session)
+                if job is not None:
+                    log.info(f"Worker {os.getpid()} ingesting job {job.id} of node {job.node_id}")
+                    ingest_queue.process(session, job)
+        except Exception as e:
+            log.error(f"Worker {os.getpid()}: {e}")
+            job = None
+        if job is None:
+            stopping.wait(poll)
+    log.info(f"Ingestion worker {os.getpid()} stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest the statistics payloads queued by the webservice")
+    parser.add_argument('--processes', '-p', type=int, default=2, help="number of worker processes (default 2)")
+    parser.add_argument('--poll', type=float, default=5, help="seconds between polls of an empty queue (default 5)")
+    args = parser.parse_args(argv)
+    if not ingest_queue.enabled:
+        parser.error("EIDASTATS_SPOOL_DIR is not set")
+
+    stopping = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=work, args=(stopping, args.poll)) for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum, frame):
+        log.info("Stopping ingestion workers")
+        stopping.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -61,6 +61,26 @@ class DataselectStat(Base):
             'bytes': int(self.bytes), 'nb_reqs': self.nb_reqs, 'nb_successful_reqs': self.nb_successful_reqs, 'clients': ''}
 
 
+class DataselectStatMonthly(Base):
+    """
+    EIDA statistics rolled up by node, month, network and country
+    """
+
+    __tablename__ = 'dataselect_stats_monthly'
+    node_id = Column(Integer, ForeignKey('nodes.id'), primary_key=True)
+    date = Column(Date(), primary_key=True)
+    network = Column(String(6), primary_key=True)
+    country = Column(String(2), primary_key=True)
+    bytes = Column(BigInteger)
+    nb_reqs = Column(BigInteger)
+    nb_successful_reqs = Column(BigInteger)
+    nb_failed_reqs = Column(BigInteger)
+    clients = Column(String())
+    updated_at = Column(DateTime())
+    __table_args__ = (ForeignKeyConstraint([node_id, network],
+                                           ["networks.node_id", "networks.name"]), {})
+
+
 class Network(Base):
     """
     EIDA networks
@@ -0,0 +1,32 @@
+import threading
+from sqlalchemy.sql import text
+from ws_eidastats.helper_functions import log
+
+
+PARTITION_SQL = text("SELECT public.create_dataselect_stats_partition(d) FROM unnest(CAST(:dates AS date[])) AS d")
+
+# months known to have a partition, so that partitions are only looked up once per process
+_known_months = set()
+_lock = threading.Lock()
+
+
+def ensure_partitions(session, months):
+    """
+    Creates the missing dataselect_stats partitions of the given months in the transaction of the session
+    Creating a partition locks the whole dataselect_stats table until the end of the transaction, so partitions
+    are only looked up for months not seen by this process yet, most of them being created ahead of time
+    Returns the months looked up, to be marked as known with known_partitions once the transaction is committed
+    """
+    missing = sorted({str(m)[:7] + '-01' for m in months} - _known_months)
+    if missing:
+        log.debug(f"Ensuring dataselect_stats partitions of {missing}")
+        session.execute(PARTITION_SQL, {'dates': missing})
+    return missing
+
+
+def known_partitions(months):
+    """
+    Marks the partitions of the given months as existing
+    """
+    with _lock:
+        _known_months.update(months)
@@ -0,0 +1,168 @@
+"""
+Streaming reader of the statistics payloads submitted by the nodes
+
+Request bodies, gzip compressed or not, are decompressed and parsed incrementally, so that the statistics
+array is never held in memory: the statistics are handed out one by one while the body is read, and the
+other members of the payload are filled in as the parser meets them.
+"""
+
+import zlib
+import ijson
+from ws_eidastats.helper_functions import log
+
+
+# bytes read from the request body, and at most decompressed from it, at once
+READ_SIZE = 1 << 16
+GZIP_MAGIC = b'\x1f\x8b'
+METADATA = ['generated_at', 'version', 'days_coverage']
+SCALARS = {'null', 'boolean', 'integer', 'double', 'number', 'string'}
+
+
+class PayloadError(Exception):
+    "Raised when a payload can not be read, with the message returned to the client"
+    pass
+
+
+class GzipStream:
+    """
+    File-like object decompressing a gzip stream as it is read, whatever the compression ratio
+    """
+
+    def __init__(self, fileobj, head=b''):
+        self.fileobj = fileobj
+        self.pending = head
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        size = READ_SIZE if size is None or size < 0 else size
+        if size == 0:
+            return b''
+        while True:
+            if not self.pending:
+                self.pending = self.fileobj.read(READ_SIZE)
+                if not self.pending:
+                    return self.decompressor.flush()
+            data = self.decompressor.decompress(self.pending, size)
+            self.pending = self.decompressor.unconsumed_tail or self.decompressor.unused_data
+            if self.decompressor.eof:
+                # trailing bytes after the gzip member are ignored
+                self.pending = b''
+            if data or self.decompressor.eof:
+                return data
+
+
+class PrefixedStream:
+    """
+    File-like object reading the given head bytes before the rest of the given stream
+    """
+
+    def __init__(self, fileobj, head):
+        self.fileobj = fileobj
+        self.head = head
+
+    def read(self, size=-1):
+        if self.head and size != 0:
+            (data, self.head) = (self.head, b'')
+            return data
+        return self.fileobj.read(READ_SIZE if size is None or size < 0 else size)
+
+
+def decoded_stream(fileobj, gzip_encoded=False):
+    """
+    Returns the given body as a file-like object, decompressed on the fly if gzip encoded or starting
+    with the gzip magic number
+    """
+    head = fileobj.read(2)
+    if gzip_encoded or head == GZIP_MAGIC:
+        log.debug("Data is gzip encoded")
+        return GzipStream(fileobj, head)
+    return PrefixedStream(fileobj, head)
+
+
+def body_stream(request):
+    """
+    Returns the request body as a file-like object, decompressed on the fly if gzip encoded
+    Bodies are considered gzip encoded from the Content-Encoding or Transfer-Encoding headers or from their magic number
+    """
+    encodings = ','.join(request.headers.get(h, '') for h in ('Content-Encoding', 'Transfer-Encoding'))
+    return decoded_stream(request.body_file, 'gzip' in encodings.lower())
+
+
+def check_statistic(stat):
+    """
+    Checks the format of one statistic before trying to insert it
+    """
+    return isinstance(stat, dict) and 'month' in stat and 'clients' in stat and 'network' in stat
+
+
+def check_metadata(payload):
+    """
+    Checks the payload carries its metadata, once the statistics have been read
+    """
+    return all(k in payload for k in METADATA)
+
+
+class PayloadReader:
+    """
+    Incremental reader of a JSON payload
+    payload is the payload dictionary, whose 'stats' member is an iterator over the checked statistics
+    Members following the statistics in the body are only available once the statistics have been read
+    """
+
+    def __init__(self, stream):
+        self.events = ijson.parse(stream, buf_size=READ_SIZE, use_float=True)
+        self.payload = {}
+        self.payload['stats'] = self.statistics()
+
+    def statistics(self):
+        """
+        Yields the statistics of the payload, reading the whole body
+        Statistics are flat objects, built here from the parsing events, other values are built by an ObjectBuilder
+        Raises PayloadError if the body is not JSON or a statistic is malformed
+        """
+        (count, builder, found) = (0, None, False)
+        try:
+            for (prefix, event, value) in self.events:
+                if builder is None:
+                    if prefix == 'stats.item':
+                        if event == 'map_key':
+                            name = value
+                        elif event == 'start_map':
+                            item = {}
+                        elif event == 'end_map':
+                            if not check_statistic(item):
+                                raise PayloadError("Malformed payload")
+                            count += 1
+                            yield item
+                        else:
+                            raise PayloadError("Malformed payload")
+                        continue
+                    if event in SCALARS and prefix.startswith('stats.item.'):
+                        item[name] = value
+                        continue
+                    if prefix == '':
+                        if event == 'map_key':
+                            key = value
+                        elif event not in ('start_map', 'end_map'):
+                            raise PayloadError("Malformed payload")
+                        continue
+                    if prefix == 'stats':
+                        if event not in ('start_array', 'end_array'):
+                            raise PayloadError("Malformed payload")
+                        found = True
+                        continue
+                    # nested values of statistics and other members of the payload
+                    (builder, target) = (ijson.ObjectBuilder(), prefix)
+                builder.event(event, value)
+                if prefix == target and event in SCALARS | {'end_map', 'end_array'}:
+                    if target.startswith('stats.item.'):
+                        item[name] = builder.value
+                    else:
+                        self.payload[key] = builder.value
+                    builder = None
+        except (ijson.JSONError, zlib.error, UnicodeDecodeError) as err:
+            log.error(err)
+            raise PayloadError("Data can not be parsed as JSON format")
+        if not found:
+            raise PayloadError("Malformed payload")
+        log.debug(f"Read {count} statistics")
@@ -0,0 +1,379 @@
+import hashlib
+import re
+from collections import namedtuple
+from functools import lru_cache
+from ws_eidastats.helper_functions import log
+
+
+LEVELS = ['node', 'network', 'station', 'location', 'channel']
+# filters in the order they appear in the WHERE clause, with the type of their bound value
+FILTERS = [('start', 'date'), ('end', 'date'), ('node', 'text[]'), ('network', 'text[]'), ('station', 'text[]'),
+           ('location', 'text[]'), ('channel', 'text[]'), ('country', 'text[]')]
+# stream identification filters, whose values are FDSN-style patterns after '*' and '?' translation
+PATTERN_FILTERS = ['network', 'station', 'location', 'channel']
+# ranked column of each ranking of /dataselect/top, clients are ranked by their estimated cardinality
+TOP_COLUMNS = {'bytes': 'bytes', 'nb_reqs': 'nb_reqs', 'clients': 'clients_cardinality'}
+# effective restriction of a network, XOR of the node default policy and the network inverted policy
+RESTRICTED_NETWORK = "coalesce(n.restriction_policy <> w.inverted_policy, false)"
+
+# table is the statistics table to query, level and date ('month', 'year' or None) the requested details
+# filters are the names of the given filters, patterns the Pattern of each given stream identification filter
+# hidden is None, 'public' or 'restricted', the kind of restricted networks grouped in 'Other' items
+# cursor and limit tell whether the request is paginated, top is the ranking of a top request, None otherwise
+Shape = namedtuple('Shape', ['table', 'level', 'date', 'country', 'filters', 'patterns', 'hidden', 'hllvalues', 'cursor', 'limit', 'top'])
+
+# exact tells whether some values are exact codes, matched with = ANY
+# anchored tells for each value with a literal prefix whether it also needs LIKE, i.e. is not a plain prefix
+# prefixes are matched with a range scan on the literal prefix, usable by text_pattern_ops indexes
+# unanchored tells whether some values start with a wildcard, matched with LIKE ANY
+Pattern = namedtuple('Pattern', ['exact', 'anchored', 'unanchored'])
+
+# name is the name of the prepared statement, keys the (label, type) couples of the ordering keys
+# params are the (name, type) couples of the bound values, in positional order
+# text_sql is the statement with typed :name placeholders, for drivers used through text() such as the async one
+Query = namedtuple('Query', ['name', 'keys', 'params', 'prepare_sql', 'execute_sql', 'stream_sql', 'text_sql'])
+
+
+def stats_table(param_value_dict):
+    """
+    Returns the name of the table to query
+    Requests that need neither station, location nor channel are answered from the monthly rollup table
+    """
+
+    if param_value_dict.get('level') in ['station', 'location', 'channel'] or\
+            any(p in param_value_dict for p in ['station', 'location', 'channel']):
+        return 'dataselect_stats'
+    return 'dataselect_stats_monthly'
+
+
+def classify(values):
+    """
+    Splits the given patterns in exact codes, (prefix, pattern or None) couples of anchored patterns
+    and unanchored patterns
+    Pattern is None for plain prefixes like 'HH%', whose range scan is enough
+    """
+
+    exact = []
+    anchored = []
+    unanchored = []
+    for value in values:
+        wildcard = min((i for i in (value.find('%'), value.find('_')) if i >= 0), default=None)
+        if wildcard is None:
+            exact.append(value)
+        elif wildcard == 0:
+            unanchored.append(value)
+        elif wildcard == len(value) - 1 and value[-1] == '%':
+            anchored.append((value[:-1], None))
+        else:
+            anchored.append((value[:wildcard], value))
+    return (exact, anchored, unanchored)
+
+
+def pattern(values):
+    """
+    Returns the Pattern of the given filter values
+    """
+
+    (exact, anchored, unanchored) = classify(values)
+    return Pattern(bool(exact), tuple(like is not None for (_, like) in anchored), bool(unanchored))
+
+
+def pattern_condition(name, pattern):
+    """
+    Returns the SQL condition of the given stream identification filter
+    Byte-wise ~>=~ and ~<~ operators match LIKE prefix semantics whatever the collation of the database
+    """
+
+    terms = []
+    if pattern.exact:
+        terms.append(f"s.{name} = ANY(:{name})")
+    for (i, like) in enumerate(pattern.anchored):
+        term = f"s.{name} ~>=~ :{name}_lo{i} AND s.{name} ~<~ :{name}_hi{i}"
+        terms.append(f"({term} AND s.{name} LIKE :{name}_like{i})" if like else f"({term})")
+    if pattern.unanchored:
+        # no index serves a leading wildcard: stream codes of 2 to 5 characters give too few trigrams, if any,
+        # for a pg_trgm index to be worth its cost on every ingestion, so only partition pruning bounds the scan
+        terms.append(f"s.{name} LIKE ANY(:{name}_any)")
+    return terms[0] if len(terms) == 1 else f"({' OR '.join(terms)})"
+
+
+def pattern_params(name, pattern):
+    """
+    Returns the (name, type) couples of the bound values of the given stream identification filter
+    """
+
+    params = [(name, 'text[]')] if pattern.exact else []
+    for (i, like) in enumerate(pattern.anchored):
+        params += [(f'{name}_lo{i}', 'text'), (f'{name}_hi{i}', 'text')]
+        if like:
+            params.append((f'{name}_like{i}', 'text'))
+    if pattern.unanchored:
+        params.append((f'{name}_any', 'text[]'))
+    return params
+
+
+def pattern_values(name, values):
+    """
+    Returns the bound values of the given stream identification filter
+    The upper bound of a prefix range is the prefix with its last character incremented
+    """
+
+    (exact, anchored, unanchored) = classify(values)
+    bound = {name: exact} if exact else {}
+    for (i, (prefix, like)) in enumerate(anchored):
+        bound[f'{name}_lo{i}'] = prefix
+        bound[f'{name}_hi{i}'] = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        if like:
+            bound[f'{name}_like{i}'] = like
+    if unanchored:
+        bound[f'{name}_any'] = unanchored
+    return bound
+
+
+def shape(param_value_dict, hidden=None):
+    """
+    Returns the Shape of the statement answering the given request parameters
+    Requests with the same shape share their compiled statement
+    """
+
+    details = param_value_dict['details']
+    return Shape(
+        table=stats_table(param_value_dict),
+        level=param_value_dict.get('level'),
+        date='month' if 'month' in details else 'year' if 'year' in details else None,
+        country='country' in details,
+        filters=tuple(name for (name, _) in FILTERS if name in param_value_dict),
+        patterns=tuple((name, pattern(param_value_dict[name])) for name in PATTERN_FILTERS if name in param_value_dict),
+        hidden=hidden if param_value_dict.get('level') in ['network', 'station', 'location', 'channel'] else None,
+        hllvalues=param_value_dict.get('hllvalues') == 'true',
+        cursor='cursor' in param_value_dict,
+        limit='limit' in param_value_dict,
+        top=param_value_dict.get('by'))
+
+
+def ordering_keys(shape):
+    """
+    Returns the grouping columns of a statement in pagination order, as (expression, label, type) triples
+    Labels are the names of the columns in the result rows, text columns are never NULL
+    """
+
+    keys = []
+    if shape.date == 'month':
+        keys.append(('s.date', 'date', 'date'))
+    elif shape.date == 'year':
+        keys.append(('extract(year FROM s.date)', 'year', 'numeric'))
+    depth = LEVELS.index(shape.level) + 1 if shape.level else 0
+    columns = [('n.name', 'name', 'Other'), ('s.network', 'network', 'Other'), ('s.station', 'station', '*'),
+               ('s.location', 'location', '*'), ('s.channel', 'channel', '*')][:depth]
+    hidden = hidden_condition(shape.hidden)
+    for (col, label, other) in columns:
+        keys.append((f"CASE WHEN {hidden} THEN '{other}' ELSE {col} END" if hidden else col, label, 'text'))
+    if shape.country:
+        keys.append(('s.country', 'country', 'text'))
+    # NULL values, such as countries of legacy statistics, are grouped with empty strings as ingestion normalizes them,
+    # and a row comparison with a NULL member is NULL, which would skip rows or stall pagination
+    return [(f"coalesce({expr}, '')", label, typ) if typ == 'text' else (expr, label, typ) for (expr, label, typ) in keys]
+
+
+def hidden_condition(hidden):
+    """
+    Returns the SQL condition matching the networks to be grouped in 'Other' items
+    """
+
+    if hidden == 'public':
+        return RESTRICTED_NETWORK
+    elif hidden == 'restricted':
+        return f"{RESTRICTED_NETWORK} AND NOT coalesce(w.eas_group = ANY(:memberof), false)"
+    return None
+
+
+def filter_conditions(shape):
+    """
+    Returns the (name, type) couples of the bound values of the filters of the given shape and their SQL conditions
+    """
+
+    patterns = dict(shape.patterns)
+    params = []
+    for (name, typ) in FILTERS:
+        if name in patterns:
+            params += pattern_params(name, patterns[name])
+        elif name in shape.filters:
+            params.append((name, typ))
+    where = []
+    for name in shape.filters:
+        if name == 'start':
+            where.append("s.date >= :start")
+        elif name == 'end':
+            where.append("s.date <= :end")
+        elif name == 'node':
+            where.append("n.name = ANY(:node)")
+        elif name in patterns:
+            where.append(pattern_condition(name, patterns[name]))
+        else:
+            where.append(f"s.{name} = ANY(:{name})")
+    return (params, where)
+
+
+def aggregates(hllvalues):
+    """
+    Returns the select list of the aggregated counters
+    """
+
+    # counters of the rollup table are bigint, whose sum would be numeric
+    select = ["sum(s.nb_reqs)::bigint AS nb_reqs", "sum(s.nb_successful_reqs)::bigint AS nb_successful_reqs",
+              "sum(s.bytes) AS bytes", "ceil(hll_cardinality(hll_union_agg(s.clients)))::bigint AS clients_cardinality"]
+    # raw HLLs are only transferred if requested
+    if hllvalues:
+        select.append("hll_union_agg(s.clients) AS clients")
+    return select
+
+
+@lru_cache(maxsize=256)
+def compile_shape(shape):
+    """
+    Returns the Query of the given shape
+    The SQL template uses :name placeholders, rendered as $n for the prepared statement
+    and as typed pyformat or :name placeholders for the streamed and text statements
+    """
+
+    keys = ordering_keys(shape)
+    (params, where) = filter_conditions(shape)
+    if shape.hidden == 'restricted':
+        params.append(('memberof', 'text[]'))
+
+    select = [f"{expr} AS {label}" for (expr, label, _) in keys] + aggregates(shape.hllvalues)
+    sql = f"SELECT {', '.join(select)}\nFROM {shape.table} s JOIN nodes n ON n.id = s.node_id"
+    if shape.hidden:
+        sql += "\nJOIN networks w ON w.node_id = s.node_id AND w.name = s.network"
+
+    if shape.cursor:
+        # start after the cursor, a row comparison on the grouping columns
+        where.append(f"({', '.join(expr for (expr, _, _) in keys)}) > ({', '.join(f':k{i}' for i in range(len(keys)))})")
+        params += [(f'k{i}', typ) for (i, (_, _, typ)) in enumerate(keys)]
+    if where:
+        sql += "\nWHERE " + "\nAND ".join(where)
+
+    # group and order by position in the select list, so that expressions are not repeated
+    positions = ', '.join(str(i + 1) for i in range(len(keys)))
+    if keys:
+        sql += f"\nGROUP BY {positions}"
+    # order by date so that results can be streamed, by all grouping columns when paginating
+    # rankings are ordered by the ranked counter, then by grouping columns so that ties are deterministic
+    if shape.top:
+        sql += f"\nORDER BY {TOP_COLUMNS[shape.top]} DESC NULLS LAST" + (f", {positions}" if keys else "")
+        sql += "\nLIMIT :top"
+        params.append(('top', 'bigint'))
+    elif (shape.cursor or shape.limit) and keys:
+        sql += f"\nORDER BY {positions}"
+    elif shape.date:
+        sql += "\nORDER BY 1"
+    if shape.limit:
+        sql += "\nLIMIT :limit"
+        params.append(('limit', 'bigint'))
+
+    query = rendered(sql, params, [(label, typ) for (_, label, typ) in keys])
+    log.debug(f"Compiled statement {query.name} of shape {shape}")
+    return query
+
+
+@lru_cache(maxsize=64)
+def compile_batch(shapes):
+    """
+    Returns the Query answering all the given shapes in a single scan, and the grouping set of each shape
+    Shapes must share their filters and the bound values of their filters
+    Grouping columns are the union of the ordering keys of the shapes, labelled c0, c1...,
+    the grouping set of a shape is the (mask, positions) couple of its rows:
+    mask is the value of the grouping_mask column, a bit set for each grouping column not in the set,
+    positions the position of each ordering key of the shape among the grouping columns
+    """
+
+    # one scan of the most detailed table needed by the shapes
+    table = 'dataselect_stats' if any(s.table == 'dataselect_stats' for s in shapes) else shapes[0].table
+    columns = []
+    positions = []
+    for s in shapes:
+        for (expr, _, _) in ordering_keys(s):
+            if expr not in columns:
+                columns.append(expr)
+        positions.append(tuple(columns.index(expr) for (expr, _, _) in ordering_keys(s)))
+    # the first grouping column is the most significant bit of the mask
+    sets = [(sum(1 << (len(columns) - 1 - i) for i in range(len(columns)) if i not in p), p) for p in positions]
+    (params, where) = filter_conditions(shapes[0])
+
+    select = [f"{expr} AS c{i}" for (i, expr) in enumerate(columns)] + aggregates(any(s.hllvalues for s in shapes))
+    select.append(f"GROUPING({', '.join(columns)}) AS grouping_mask" if columns else "0 AS grouping_mask")
+    sql = f"SELECT {', '.join(select)}\nFROM {table} s JOIN nodes n ON n.id = s.node_id"
+    if any(s.hidden for s in shapes):
+        sql += "\nJOIN networks w ON w.node_id = s.node_id AND w.name = s.network"
+    if where:
+        sql += "\nWHERE " + "\nAND ".join(where)
+    if columns:
+        # identical grouping sets would give duplicate rows
+        grouping_sets = sorted(set(tuple(sorted(p)) for p in positions), key=lambda p: (len(p), p))
+        sql += "\nGROUP BY GROUPING SETS (" + ', '.join(f"({', '.join(columns[i] for i in p)})" for p in grouping_sets) + ")"
+
+    query = rendered(sql, params, [(f'c{i}', None) for i in range(len(columns))])
+    log.debug(f"Compiled statement {query.name} of {len(shapes)} shapes")
+    return (query, sets)
+
+
+def rendered(sql, params, keys):
+    """
+    Returns the Query of the given SQL template, bound values and ordering keys
+    """
+
+    name = 'dataselect_' + hashlib.sha1(sql.encode('utf-8')).hexdigest()[:16]
+    prepare_sql = sql
+    stream_sql = sql
+    for (i, (param, typ)) in sorted(enumerate(params), key=lambda x: -len(x[1][0])):
+        prepare_sql = prepare_sql.replace(f':{param}', f'${i + 1}')
+        stream_sql = stream_sql.replace(f':{param}', f'CAST(%({param})s AS {typ})')
+    types = dict(params)
+    text_sql = re.sub(r'(?<!:):(\w+)', lambda m: f"CAST(:{m[1]} AS {types[m[1]]})" if m[1] in types else m[0], sql)
+    return Query(
+        name=name,
+        keys=keys,
+        params=params,
+        prepare_sql=f"PREPARE {name} ({', '.join(typ for (_, typ) in params)}) AS {prepare_sql}" if params else f"PREPARE {name} AS {prepare_sql}",
+        execute_sql=f"EXECUTE {name} ({', '.join(f'%({param})s' for (param, _) in params)})" if params else f"EXECUTE {name}",
+        stream_sql=stream_sql,
+        text_sql=text_sql)
+
+
+def bound_values(query, param_value_dict, memberof=None):
+    """
+    Returns the values to bind to the given query
+    """
+
+    values = {name: param_value_dict[name] for (name, _) in FILTERS if name in param_value_dict and name not in PATTERN_FILTERS}
+    for name in PATTERN_FILTERS:
+        if name in param_value_dict:
+            values.update(pattern_values(name, param_value_dict[name]))
+    if memberof is not None:
+        values['memberof'] = memberof
+    for (i, value) in enumerate(param_value_dict.get('cursor', [])):
+        values[f'k{i}'] = value
+    if 'limit' in param_value_dict:
+        # fetch one more row to know whether there is a next page
+        values['limit'] = param_value_dict['limit'] + 1
+    if 'n' in param_value_dict:
+        values['top'] = param_value_dict['n']
+    return values
+
+
+def execute(session, query, values, stream=False):
+    """
+    Executes the query and returns its result
+    Streamed queries use a server-side cursor, others use a prepared statement of the connection,
+    prepared on first use and planned once for all the requests of the same shape
+    """
+
+    connection = session.connection()
+    if stream:
+        return connection.execution_options(stream_results=True).exec_driver_sql(query.stream_sql, values)
+    prepared = connection.connection.info.setdefault('prepared_statements', set())
+    if query.name not in prepared:
+        log.debug(f"Preparing statement {query.name}")
+        connection.exec_driver_sql(query.prepare_sql)
+        prepared.add(query.name)
+    return connection.exec_driver_sql(query.execute_sql, values)
@@ -0,0 +1,105 @@
+import re
+import threading
+from collections import namedtuple
+from ws_eidastats.model import Node, Network
+from ws_eidastats.helper_functions import log, node_catalog
+from ws_eidastats.watermarks import policy_watermark
+
+
+# restricted is one of 'yes', 'no' or 'not yet defined', as returned by the /_isRestricted method
+Policy = namedtuple('Policy', ['restricted', 'group'])
+
+
+class RestrictionPolicyMap:
+    """
+    In-memory map of the effective restriction policy of every network, keyed by (node name, network name)
+    The map is loaded in one query from networks joined to nodes and is reloaded whenever the
+    restriction_policy_version counter changes, i.e. after any insert/update/delete on nodes or networks
+    (statsman set_policy/set_group commands, new networks inserted by the ingestion trigger)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._policies = None
+        self._version = None
+        self._updated_at = None
+
+    @staticmethod
+    def _effective_policy(restriction_policy, inverted_policy, group):
+        if any(x is None for x in [restriction_policy, inverted_policy]):
+            return Policy('not yet defined', group)
+        elif int(restriction_policy)^int(inverted_policy):
+            return Policy('yes', group)
+        else:
+            return Policy('no', group)
+
+    def load(self, session):
+        """
+        Loads the whole map from database
+        """
+        log.debug('Loading restriction policy map')
+        (version, updated_at) = policy_watermark(session)
+        sqlreq = session.query(Network).join(Node).with_entities(Node.name, Network.name,
+                    Node.restriction_policy, Network.inverted_policy, Network.eas_group).all()
+        self._policies = {(node, net): self._effective_policy(dfl, inv, grp) for (node, net, dfl, inv, grp) in sqlreq}
+        # nodes only change along with the restriction policy version
+        node_catalog.load(session)
+        self._version = version
+        self._updated_at = updated_at
+        log.info(f"Loaded restriction policies of {len(self._policies)} networks (version {version})")
+
+    def refresh(self, session):
+        """
+        Reloads the map with the given session if it has never been loaded or if the policies changed in database
+        since last load
+        Costs one single-row query when the map is up to date
+        """
+        (version, _) = policy_watermark(session)
+        if self._policies is None or version != self._version:
+            with self._lock:
+                if self._policies is None or version != self._version:
+                    self.load(session)
+
+    @property
+    def version(self):
+        """
+        Returns the version of the loaded policies
+        """
+        return self._version
+
+    @property
+    def updated_at(self):
+        """
+        Returns the timestamp of the last change of the loaded policies
+        """
+        return self._updated_at
+
+    def invalidate(self):
+        """
+        Forces a reload at next refresh, the loaded policies being kept until then
+        """
+        with self._lock:
+            self._version = None
+
+    def get(self, node, network):
+        """
+        Returns the Policy of the given network of the given node
+        Returns None if there is no such network
+        The map must have been refreshed
+        """
+        return self._policies.get((node, network))
+
+    def match(self, node, network):
+        """
+        Returns the Policies of the networks of the given node matching the given network code or pattern
+        Patterns use '%' and '_' wildcards, as translated from '*' and '?' request parameters
+        The map must have been refreshed
+        """
+        if '%' not in network and '_' not in network:
+            policy = self.get(node, network)
+            return [] if policy is None else [policy]
+        regex = re.compile(''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in network))
+        return [policy for ((n, net), policy) in self._policies.items() if n == node and regex.fullmatch(net)]
+
+
+restriction_policies = RestrictionPolicyMap()
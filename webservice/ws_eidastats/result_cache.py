@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from ws_eidastats.helper_functions import log
+
+
+# nodes is the set of node ids covered by a cached answer, start and end its months ('YYYY-MM', None if unbounded)
+Scope = namedtuple('Scope', ['nodes', 'start', 'end'])
+Entry = namedtuple('Entry', ['version', 'scope', 'body'])
+
+# cache files hold a one-line JSON header describing the entry, followed by the raw body
+HEADER_MAX_BYTES = 2**16
+
+
+class ResultCache:
+    """
+    Cache of serialized result items of dataselect requests, keyed by normalized request parameters
+    First tier is an in-process LRU bounded by the total size in bytes of the cached bodies
+    Optional second tier is a directory shared by all workers of a deployment, bounded the same way
+    Each entry holds the watermark version of the nodes and months it covers: an entry is only
+    served while that version is unchanged, so that a submission by any worker invalidates it,
+    and entries are dropped at once by the worker that registers the submission
+    Cache files hold no serialized objects, only a JSON header and the body bytes, and are only
+    served if their header matches the key and the size of the body
+    """
+
+    def __init__(self, max_bytes=64*2**20, max_entry_bytes=None, directory=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 8
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(param_value_dict, *flags):
+        """
+        Returns the cache key of the given request parameters
+        Multivalue parameters are sorted so that equivalent requests share their key
+        """
+        normalized = {k: sorted(v) if isinstance(v, list) else v for (k, v) in param_value_dict.items()}
+        return hashlib.sha1(json.dumps([normalized, flags], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.cache')
+
+    def _store(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key).body)
+            self._entries[key] = entry
+            self._size += len(entry.body)
+            # evict least recently used entries
+            while self._size > self.max_bytes:
+                (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted.body)
+
+    def _read_file(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                header = json.loads(f.readline(HEADER_MAX_BYTES))
+                body = f.read()
+            if header.get('key') != key or header.get('size') != len(body) or not isinstance(header.get('version'), int):
+                raise ValueError('header does not match the entry')
+            nodes = header['nodes']
+            scope = Scope(None if nodes is None else frozenset(nodes), header['start'], header['end'])
+            return Entry(header['version'], scope, body)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning(f"Unreadable result cache file {self._path(key)}: {e}")
+            return None
+
+    def _write_file(self, key, entry):
+        try:
+            nodes = None if entry.scope.nodes is None else sorted(entry.scope.nodes)
+            header = {'key': key, 'version': entry.version, 'nodes': nodes, 'start': entry.scope.start,
+                      'end': entry.scope.end, 'size': len(entry.body)}
+            with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+                f.write(json.dumps(header).encode('utf-8') + b'\n')
+                f.write(entry.body)
+            os.replace(f.name, self._path(key))
+            # evict least recently written files
+            files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.cache')]
+            stats = sorted(((os.stat(p), p) for p in files), key=lambda x: x[0].st_mtime)
+            size = sum(s.st_size for (s, _) in stats)
+            for (s, p) in stats:
+                if size <= self.max_bytes:
+                    break
+                os.remove(p)
+                size -= s.st_size
+        except Exception as e:
+            log.warning(f"Could not write result cache file: {e}")
+
+    def get(self, key, version):
+        """
+        Returns the cached body for the given key if it was computed at the given watermark version
+        Returns None otherwise
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self.directory:
+            entry = self._read_file(key)
+            if entry is not None and entry.version == version:
+                self._store(key, entry)
+        if entry is None or entry.version != version:
+            return None
+        return entry.body
+
+    def put(self, key, version, scope, body):
+        """
+        Caches the body computed at the given watermark version for the given scope
+        Bodies larger than max_entry_bytes are not cached
+        """
+        if not self.enabled or len(body) > self.max_entry_bytes:
+            return
+        entry = Entry(version, scope, body)
+        self._store(key, entry)
+        if self.directory:
+            self._write_file(key, entry)
+
+    def fill(self, key, version, scope, chunks):
+        """
+        Yields the given body chunks and caches the whole body once all chunks have been consumed
+        """
+        body = []
+        size = 0
+        for chunk in chunks:
+            if body is not None:
+                size += len(chunk)
+                if size <= self.max_entry_bytes:
+                    body.append(chunk)
+                else:
+                    body = None
+            yield chunk
+        if body is not None:
+            self.put(key, version, scope, b''.join(body))
+
+    async def afill(self, key, version, scope, chunks):
+        """
+        Same as fill, for asynchronous iterables of body chunks
+        """
+        body = []
+        size = 0
+        async for chunk in chunks:
+            if body is not None:
+                size += len(chunk)
+                if size <= self.max_entry_bytes:
+                    body.append(chunk)
+                else:
+                    body = None
+            yield chunk
+        if body is not None:
+            self.put(key, version, scope, b''.join(body))
+
+    def invalidate(self, node_id, months):
+        """
+        Drops the in-process entries covering any of the given months of the given node
+        """
+        months = {str(m)[:7] for m in months}
+        with self._lock:
+            for (key, entry) in list(self._entries.items()):
+                scope = entry.scope
+                if scope.nodes is not None and node_id not in scope.nodes:
+                    continue
+                if any((scope.start is None or m >= scope.start) and (scope.end is None or m <= scope.end) for m in months):
+                    self._size -= len(self._entries.pop(key).body)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+result_cache = ResultCache(max_bytes=int(os.getenv('EIDASTATS_CACHE_SIZE', 64))*2**20, directory=os.getenv('EIDASTATS_CACHE_DIR'))
@@ -0,0 +1,185 @@
+import io
+import json
+from datetime import date
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+VERSION = '1.0.0'
+FIELDS = ['date', 'node', 'network', 'station', 'location', 'channel', 'country', 'bytes', 'nb_reqs', 'nb_successful_reqs', 'clients']
+# number of result items serialized together in one chunk of the response body
+CHUNK_SIZE = 1000
+
+
+def chunked(lines, chunk_size=CHUNK_SIZE):
+    """
+    Joins serialized items by chunks of chunk_size and yields them as utf-8 bytes
+    """
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+    if chunk:
+        yield ''.join(chunk).encode('utf-8')
+
+
+def csv_head(request_parameters, hllvalues=False, metadata=None):
+    """
+    Returns the CSV metadata and header
+    Additional metadata with a None value are left out
+    """
+    comments = ''.join(f"# {k}: {v}\n" for (k, v) in (metadata or {}).items() if v is not None)
+    return "# version: " + VERSION + "\n# request_parameters: " + request_parameters + "\n" + comments +\
+        ','.join(FIELDS + (['hll_clients'] if hllvalues else []))
+
+
+def csv_items(results):
+    """
+    Yields one CSV line per result item
+    """
+    for res in results:
+        yield '\n' + ','.join(str(v) for v in res.values())
+
+
+def json_head(request_parameters, metadata=None):
+    """
+    Returns the JSON metadata, up to the opening of the results list
+    """
+    extra = ''.join(', ' + json.dumps(k) + ': ' + json.dumps(v) for (k, v) in (metadata or {}).items())
+    return '{"version": ' + json.dumps(VERSION) + ', "request_parameters": ' + json.dumps(request_parameters) + extra + ', "results": ['
+
+
+def json_items(results):
+    """
+    Yields one serialized object per result item
+    """
+    separator = ''
+    for res in results:
+        yield separator + json.dumps(res, default=str)
+        separator = ', '
+
+
+JSON_TAIL = ']}'
+
+
+# binary formats, available if pyarrow is installed
+ARROW_FORMATS = ['arrow', 'parquet'] if pyarrow is not None else []
+ARROW_CONTENT_TYPES = {'arrow': 'application/vnd.apache.arrow.stream', 'parquet': 'application/vnd.apache.parquet'}
+# number of result items per parquet row group
+ROW_GROUP_SIZE = 64 * CHUNK_SIZE
+
+
+def period_start(value):
+    """
+    Returns the first day of a 'YYYY-MM' or 'YYYY' period, None for '*'
+    """
+    if value == '*':
+        return None
+    return date(int(value[:4]), int(value[5:7]) if len(value) > 4 else 1, 1)
+
+
+def hll_bytes(value):
+    """
+    Returns the raw bytes of an HLL, given as bytes or as hex text as returned by the database drivers
+    """
+    if value is None or isinstance(value, bytes):
+        return value
+    if isinstance(value, memoryview):
+        return bytes(value)
+    return bytes.fromhex(value[2:] if value.startswith('\\x') else value)
+
+
+class ArrowWriter:
+    """
+    Serializes result items as an Arrow IPC stream or a Parquet file, batch by batch
+    Counters are int64, dates are the first day of their period, raw HLLs are binary
+    Version, request parameters and additional metadata are stored in the schema metadata
+    """
+
+    def __init__(self, request_parameters, hllvalues=False, metadata=None, parquet=False):
+        fields = [pyarrow.field('date', pyarrow.date32())]
+        fields += [pyarrow.field(name, pyarrow.string()) for name in ['node', 'network', 'station', 'location', 'channel', 'country']]
+        fields += [pyarrow.field(name, pyarrow.int64()) for name in ['bytes', 'nb_reqs', 'nb_successful_reqs', 'clients']]
+        if hllvalues:
+            fields.append(pyarrow.field('hll_clients', pyarrow.binary()))
+        schema_metadata = {'version': VERSION, 'request_parameters': request_parameters}
+        schema_metadata.update({k: str(v) for (k, v) in (metadata or {}).items() if v is not None})
+        self.schema = pyarrow.schema(fields, metadata=schema_metadata)
+        self.hllvalues = hllvalues
+        self.parquet = parquet
+        self.pending = []
+        self.sink = io.BytesIO()
+        if parquet:
+            self.writer = pyarrow.parquet.ParquetWriter(self.sink, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+
+    def batch(self, items):
+        columns = [[period_start(res['date']) for res in items]]
+        columns += [[res[name] for res in items] for name in ['node', 'network', 'station', 'location', 'channel', 'country']]
+        columns += [[res[name] for res in items] for name in ['bytes', 'nb_reqs', 'nb_successful_reqs', 'clients']]
+        if self.hllvalues:
+            columns.append([hll_bytes(res['hll_clients']) for res in items])
+        return pyarrow.record_batch([pyarrow.array(c, type=f.type) for (c, f) in zip(columns, self.schema)], schema=self.schema)
+
+    def flush(self):
+        data = self.sink.getvalue()
+        self.sink.seek(0)
+        self.sink.truncate()
+        return data
+
+    def write(self, items):
+        """
+        Serializes the given result items and returns the bytes written so far
+        Parquet items are kept until a row group is complete
+        """
+        if self.parquet:
+            self.pending.extend(items)
+            if len(self.pending) >= ROW_GROUP_SIZE:
+                self.writer.write_batch(self.batch(self.pending))
+                self.pending = []
+        elif items:
+            self.writer.write_batch(self.batch(items))
+        return self.flush()
+
+    def close(self):
+        """
+        Returns the remaining bytes, up to the end of the stream or file
+        """
+        if self.pending:
+            self.writer.write_batch(self.batch(self.pending))
+            self.pending = []
+        self.writer.close()
+        return self.flush()
+
+
+def batched(results, chunk_size=CHUNK_SIZE):
+    """
+    Yields the result items by lists of chunk_size
+    """
+    batch = []
+    for res in results:
+        batch.append(res)
+        if len(batch) >= chunk_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stream_arrow(request_parameters, results, hllvalues=False, metadata=None, parquet=False, chunk_size=CHUNK_SIZE):
+    """
+    Yields the Arrow IPC stream, or Parquet file, of the result items as bytes chunks
+    """
+    writer = ArrowWriter(request_parameters, hllvalues, metadata, parquet)
+    for batch in batched(results, chunk_size):
+        data = writer.write(batch)
+        if data:
+            yield data
+    yield writer.close()
@@ -1,19 +1,28 @@
+from pyramid.request import Request
 from pyramid.response import Response
 from pyramid.view import view_config
 from pyramid.view import notfound_view_config
 import os
+import hashlib
 import json
+from collections import namedtuple
+from types import SimpleNamespace
+from urllib.parse import urlencode
+from itertools import chain
 import re
-import python_hll
-from python_hll.util import NumberUtil
-from python_hll.hll import HLL
-from ws_eidastats.model import Node, DataselectStat, Network
-from ws_eidastats.helper_functions import get_nodes, check_authentication, check_request_parameters, log, Session
+from ws_eidastats.serializers import chunked, csv_head, csv_items, json_head, json_items, JSON_TAIL, CHUNK_SIZE
+from ws_eidastats.serializers import stream_arrow, ARROW_FORMATS, ARROW_CONTENT_TYPES, VERSION
+from ws_eidastats.result_cache import result_cache, Scope
+from ws_eidastats.compression import compression
+from ws_eidastats.watermarks import stats_watermark
+from ws_eidastats.query_compiler import compile_shape, compile_batch, bound_values, execute, ordering_keys, FILTERS
+from ws_eidastats.query_compiler import shape as query_shape
+from ws_eidastats.model import Node, DataselectStat, DataselectStatMonthly, Network
+from ws_eidastats.helper_functions import node_catalog, check_authentication, check_request_parameters, log
+from ws_eidastats.helper_functions import not_modified, set_validators, encode_cursor
 from ws_eidastats.helper_functions import NoNetwork, Mandatory, BothMonthYear
-from ws_eidastats.views_restrictions import isRestricted
-from sqlalchemy import or_, text
-from sqlalchemy.sql import func, extract
-from sqlalchemy.sql.expression import literal_column
+from ws_eidastats.restriction_policies import restriction_policies
+from sqlalchemy import text
 
 
 @notfound_view_config(append_slash=True)
@@ -24,9 +33,42 @@ def notfound_view(request):
 
     log.info(f"{request.method} {request.url}")
 
+    # known routes called with a method none of their views accept
+    methods = allowed_methods(request)
+    if methods is not None and request.method not in methods:
+        return method_not_allowed(methods)
     return Response("<h1>404 Not Found</h1>", status_code=404)
 
 
+def allowed_methods(request):
+    """
+    Returns the methods accepted by the views of the route matched by the request
+    None if no route matched or any method is accepted
+    """
+
+    if request.matched_route is None:
+        return None
+    methods = []
+    for introspectable in request.registry.introspector.get_category('views'):
+        view = introspectable['introspectable']
+        if view['route_name'] != request.matched_route.name:
+            continue
+        if view['request_methods'] is None:
+            return None
+        methods += [view['request_methods']] if isinstance(view['request_methods'], str) else view['request_methods']
+    return sorted(set(methods)) or None
+
+
+def method_not_allowed(methods):
+    """
+    Returns the 405 response listing the given allowed methods
+    """
+
+    response = Response(f"<h1>405 Method Not Allowed</h1><p>Only {' or '.join(methods)} method allowed</p>", status_code=405)
+    response.allow = methods
+    return response
+
+
 @view_config(route_name='health', request_method='GET', openapi=True)
 def test_database(request):
     """
@@ -35,11 +77,11 @@ def test_database(request):
 
     log.info(f"{request.method} {request.url}")
 
-    tables_to_insert = [DataselectStat.__tablename__, "payloads"]
-    tables_to_update = [DataselectStat.__tablename__]
-    tables_to_select = [DataselectStat.__tablename__, Node.__tablename__, Network.__tablename__, "payloads", "tokens" ]
+    tables_to_insert = [DataselectStat.__tablename__, DataselectStatMonthly.__tablename__, "payloads"]
+    tables_to_update = [DataselectStat.__tablename__, DataselectStatMonthly.__tablename__]
+    tables_to_select = [DataselectStat.__tablename__, DataselectStatMonthly.__tablename__, Node.__tablename__, Network.__tablename__, "payloads", "tokens" ]
     try:
-        session = Session()
+        session = request.dbsession
         sqlreq = session.execute(text("select table_name, privilege_type from information_schema.role_table_grants where grantee= :value").params(value = session.bind.url.username))
         results = sqlreq.fetchall()
 
@@ -67,7 +109,6 @@ def test_database(request):
             raise Exception(f"User misses update permissions on one of the tables {tables_to_update}")
 
         # Check permission to select
-        session.close()
         return Response(text="The service is up and running and database is available!", content_type='text/plain')
 
     except Exception as e:
@@ -75,6 +116,148 @@ def test_database(request):
         return Response("<h1>500 Internal Server Error</h1><p>Database connection or schema error</p>", status_code=500)
 
 
+LEVELS = ['node', 'network', 'station', 'location', 'channel']
+
+
+def results_items(rows, param_value_dict):
+    """
+    Yields the result items, as dictionaries, from the rows of a dataselect query
+    Assigns '*' at aggregated parameters
+    """
+
+    depth = LEVELS.index(param_value_dict['level']) + 1 if 'level' in param_value_dict else 0
+    details = param_value_dict['details']
+    hllvalues = param_value_dict.get('hllvalues') == 'true'
+    for row in rows:
+        # without grouping, an empty selection gives a single row of NULL values
+        if row.nb_reqs is None:
+            continue
+        rowToDict = DataselectStat.to_dict_for_human(row)
+        rowToDict['date'] = str(row.date)[:-3] if 'month' in details else str(row.year)[:4] if 'year' in details else '*'
+        rowToDict['node'] = row.name if depth >= 1 else '*'
+        rowToDict['network'] = row.network if depth >= 2 else '*'
+        rowToDict['station'] = row.station if depth >= 3 else '*'
+        rowToDict['location'] = row.location if depth >= 4 else '*'
+        rowToDict['channel'] = row.channel if depth >= 5 else '*'
+        rowToDict['country'] = row.country if 'country' in details else '*'
+        rowToDict['clients'] = int(row.clients_cardinality)
+        # add hll_client field if hllvalues parameter is set to true
+        if hllvalues:
+            rowToDict['hll_clients'] = row.clients
+        yield rowToDict
+
+
+def results_response(request, param_value_dict, results=None, body=None, cache_entry=None, metadata=None,
+                     encoding=None, encoded_cache_entry=None):
+    """
+    Returns a response streaming the result items as json, csv, arrow or parquet with metadata, and additional metadata if given
+    Serialized result items are taken from body if given
+    Otherwise they are serialized from results, and cached if cache_entry (key, version, scope) is given
+    Json and csv bodies are compressed with the given encoding unless they are below the compression threshold,
+    compressed bodies are cached whole if encoded_cache_entry is given, instead of the serialized result items
+    """
+
+    if param_value_dict.get('format') in ARROW_FORMATS:
+        # binary formats embed the request parameters in their schema, their bodies are not cached
+        log.debug(f"Returning the results as {param_value_dict['format']}")
+        app_iter = stream_arrow(request.query_string, results, param_value_dict.get('hllvalues') == 'true',
+                        metadata, param_value_dict['format'] == 'parquet')
+        return Response(app_iter=app_iter, content_type=ARROW_CONTENT_TYPES[param_value_dict['format']])
+
+    if body is not None:
+        body_chunks = [body]
+    elif param_value_dict.get('format') == 'json':
+        body_chunks = chunked(json_items(results))
+    else:
+        body_chunks = chunked(csv_items(results))
+
+    if param_value_dict.get('format') == 'json':
+        log.debug('Returning the results as JSON')
+        (head, tail, content_type) = (json_head(request.query_string, metadata).encode('utf-8'), JSON_TAIL.encode('utf-8'), 'application/json')
+    else:
+        log.debug('Returning the results as CSV')
+        head = csv_head(request.query_string, param_value_dict.get('hllvalues') == 'true', metadata).encode('utf-8')
+        (tail, content_type) = (b'', 'text/csv')
+
+    if encoding is not None:
+        (read, body_chunks, exhausted) = compression.peek(body_chunks, compression.threshold - len(head) - len(tail))
+        if compression.below_threshold(read, exhausted, len(head) + len(tail)):
+            encoding = None
+        body_chunks = chain(read, body_chunks)
+    if body is None and cache_entry is not None and encoding is None:
+        body_chunks = result_cache.fill(*cache_entry, body_chunks)
+
+    app_iter = chain([head], body_chunks, [tail])
+    if encoding is not None:
+        app_iter = compression.encode(app_iter, encoding)
+        if encoded_cache_entry is not None:
+            app_iter = result_cache.fill(*encoded_cache_entry, app_iter)
+    response = Response(app_iter=app_iter, content_type=content_type, charset='utf-8')
+    return encoded(response, encoding)
+
+
+def encoded(response, encoding):
+    """
+    Sets the Content-Encoding and Vary headers of the response
+    Returns the response
+    """
+
+    if encoding is not None:
+        response.content_encoding = encoding
+    if compression.enabled:
+        response.vary = ('Accept-Encoding',)
+    return response
+
+
+# param_value_dict are the checked request parameters, query and values the compiled query and its bound values
+# stream tells whether rows are fetched with a server-side cursor, cache_entry is (key, version, scope) or None
+# etag and last_modified are the validators of the response, None if not given
+# encoding is the negotiated compression of the body, None if none, encoded_cache_entry the cache entry of the compressed body
+Plan = namedtuple('Plan', ['param_value_dict', 'query', 'values', 'stream', 'cache_entry', 'etag', 'last_modified',
+                           'encoding', 'encoded_cache_entry'])
+
+
+def page(rows, param_value_dict, query):
+    """
+    Returns the rows of a page, without the additional row fetched to know whether there is a next page,
+    and the page metadata holding the cursor of the next page
+    """
+
+    metadata = {'next_cursor': None}
+    if len(rows) > param_value_dict['limit']:
+        rows = rows[:param_value_dict['limit']]
+        last = [(getattr(rows[-1], label), label) for (label, _) in query.keys]
+        metadata['next_cursor'] = encode_cursor([str(v) if label == 'date' else int(v) if label == 'year' else v for (v, label) in last])
+    return (rows, metadata)
+
+
+def run_plan(request, plan):
+    """
+    Executes the query of the plan and returns the response streaming its results
+    The session of the request is closed by the session tween once the results are streamed
+    """
+
+    param_value_dict = plan.param_value_dict
+    try:
+        result = execute(request.dbsession, plan.query, plan.values, stream=plan.stream)
+        if 'limit' in param_value_dict:
+            (rows, metadata) = page(result.all(), param_value_dict, plan.query)
+            rows = iter(rows)
+        else:
+            metadata = None
+            rows = iter(result.yield_per(CHUNK_SIZE) if plan.stream else result)
+
+    except Exception as e:
+        log.error(str(e))
+        return Response("<h1>500 Internal Server Error</h1><p>Database connection error or invalid SQL statement passed to database</p>", status_code=500)
+
+    log.debug('Streaming the results')
+    results = results_items(rows, param_value_dict)
+    response = results_response(request, param_value_dict, results, cache_entry=plan.cache_entry, metadata=metadata,
+                    encoding=plan.encoding, encoded_cache_entry=plan.encoded_cache_entry)
+    return response if plan.etag is None else set_validators(response, plan.etag, plan.last_modified)
+
+
 @view_config(route_name='dataselectrestricted', openapi=True)
 def restricted(request):
     """
@@ -85,8 +268,18 @@ def restricted(request):
     """
 
     log.info(f"{request.method} {request.url}")
+    plan = plan_restricted(request)
+    return plan if isinstance(plan, Response) else run_plan(request, plan)
+
+
+def plan_restricted(request):
+    """
+    Checks authentication, authorization and parameters of a restricted request and compiles its query
+    Returns the Plan of the request, or the error response
+    """
+
     if request.method != 'POST':
-        return Response("<h1>405 Method Not Allowed</h1><p>Only POST method allowed</p>", status_code=405)
+        return method_not_allowed(['POST'])
 
     # check authentication
     # if authentication successful, return dictionary with token info
@@ -104,9 +297,7 @@ def restricted(request):
     # check authorization
     # different behavior depending on whether user is node operator or not
     try:
-        session = Session()
-        sqlreq = session.query(Node).with_entities(Node.eas_group).all()
-        session.close()
+        sqlreq = request.dbsession.query(Node).with_entities(Node.eas_group).all()
     except Exception as e:
         log.error(str(e))
         return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
@@ -145,31 +336,27 @@ def restricted(request):
 
     log.info('Checked parameters of request')
 
+    # make sure the in-memory restriction policies are up to date
+    try:
+        restriction_policies.refresh(request.dbsession)
+    except Exception as e:
+        log.error(str(e))
+        return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
+
     # if user is not operator and network is specified, check if either network is open or user has access to it at least in one node
     if not operator and 'network' in param_value_dict:
         access = False
         noEntry = True
-        nodes = param_value_dict.get('node')
-        # if no node is specified, get all available nodes from database
-        if nodes is None:
-            try:
-                nodes = [node['name'] for node in get_nodes(request, internalCall=True).json['nodes']]
-            except Exception as e:
-                raise Exception(e)
-        for n in nodes:
-            restricted = isRestricted(request, internalCall=True, node=n, network=param_value_dict['network'][0])
-            if restricted.status_code == 500:
-                return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
-            if restricted.status_code == 400:
-                continue
-            else:
-                noEntry = False
-            if restricted.json['restricted'] == 'no':
+        # if no node is specified, check all nodes
+        nodes = param_value_dict.get('node') or node_catalog.names(request.dbsession)
+        for policy in (p for n in nodes for p in restriction_policies.match(n, param_value_dict['network'][0])):
+            noEntry = False
+            if policy.restricted == 'no':
                 log.debug('Network is open at least in one node')
                 access = True
                 break
             # if network is restricted, check if user has access
-            elif restricted.json['restricted'] == 'yes' and restricted.json['group'] in tokenDict['memberof'].split(';'):
+            elif policy.restricted == 'yes' and policy.group in tokenDict['memberof'].split(';'):
                 log.info('User can access restricted network')
                 access = True
                 break
@@ -181,175 +368,14 @@ def restricted(request):
 
         log.info('Checked network restriction')
 
-    try:
-        log.debug('Connecting to db, SELECT and FROM clause')
-        session = Session()
-        sqlreq = session.query(DataselectStat).join(Node).with_entities()
-
-        # select needed columns depending on level and details
-        # return '*' for not selected columns meaning all matching instances
-        if 'level' in param_value_dict:
-            sqlreq = sqlreq.add_columns(Node.name)
-        if param_value_dict.get('level') in ['network', 'station', 'location', 'channel']:
-            sqlreq = sqlreq.add_columns(DataselectStat.network)
-        if param_value_dict.get('level') in ['station', 'location', 'channel']:
-            sqlreq = sqlreq.add_columns(DataselectStat.station)
-        if param_value_dict.get('level') in ['location', 'channel']:
-            sqlreq = sqlreq.add_columns(DataselectStat.location)
-        if param_value_dict.get('level') == 'channel':
-            sqlreq = sqlreq.add_columns(DataselectStat.channel)
-        if 'month' in param_value_dict['details']:
-            sqlreq = sqlreq.add_columns(DataselectStat.date)
-        elif 'year' in param_value_dict['details']:
-            sqlreq = sqlreq.add_columns(extract('year', DataselectStat.date).label('year'))
-        if 'country' in param_value_dict['details']:
-            sqlreq = sqlreq.add_columns(DataselectStat.country)
-
-        # fields to be summed up
-        sqlreq = sqlreq.add_columns(func.sum(DataselectStat.nb_reqs).label('nb_reqs'),
-                    func.sum(DataselectStat.nb_successful_reqs).label('nb_successful_reqs'),
-                    func.sum(DataselectStat.bytes).label('bytes'), literal_column('hll_union_agg(dataselect_stats.clients)').label('clients'))
-
-        # where clause
-        log.debug('Making the WHERE clause')
-        if 'start' in param_value_dict:
-            sqlreq = sqlreq.filter(DataselectStat.date >= param_value_dict['start'])
-        if 'end' in param_value_dict:
-            sqlreq = sqlreq.filter(DataselectStat.date <= param_value_dict['end'])
-        if 'node' in param_value_dict:
-            sqlreq = sqlreq.filter(Node.name.in_(param_value_dict['node']))
-        if 'network' in param_value_dict:
-            multiOR = or_(False)
-            for net in param_value_dict['network']:
-                if '%' or '_' in net:
-                    multiOR = or_(multiOR, DataselectStat.network.like(net))
-                else:
-                    multiOR = or_(multiOR, DataselectStat.network == net)
-            sqlreq = sqlreq.filter(multiOR)
-        if 'station' in param_value_dict:
-            multiOR = or_(False)
-            for sta in param_value_dict['station']:
-                if '%' or '_' in sta:
-                    multiOR = or_(multiOR, DataselectStat.station.like(sta))
-                else:
-                    multiOR = or_(multiOR, DataselectStat.station == sta)
-            sqlreq = sqlreq.filter(multiOR)
-        if 'country' in param_value_dict:
-            sqlreq = sqlreq.filter(DataselectStat.country.in_(param_value_dict['country']))
-        if 'location' in param_value_dict:
-            multiOR = or_(False)
-            for loc in param_value_dict['location']:
-                if '%' or '_' in loc:
-                    multiOR = or_(multiOR, DataselectStat.location.like(loc))
-                else:
-                    multiOR = or_(multiOR, DataselectStat.location == loc)
-            sqlreq = sqlreq.filter(multiOR)
-        if 'channel' in param_value_dict:
-            multiOR = or_(False)
-            for cha in param_value_dict['channel']:
-                if '%' or '_' in cha:
-                    multiOR = or_(multiOR, DataselectStat.channel.like(cha))
-                else:
-                    multiOR = or_(multiOR, DataselectStat.channel == cha)
-            sqlreq = sqlreq.filter(multiOR)
-
-        # group_by clause for the details
-        log.debug('Making the GROUP BY clause')
-        if 'level' in param_value_dict:
-            sqlreq = sqlreq.group_by(Node.name)
-        if param_value_dict.get('level') in ['network', 'station', 'location', 'channel']:
-            sqlreq = sqlreq.group_by(DataselectStat.network)
-        if param_value_dict.get('level') in ['station', 'location', 'channel']:
-            sqlreq = sqlreq.group_by(DataselectStat.station)
-        if param_value_dict.get('level') in ['location', 'channel']:
-            sqlreq = sqlreq.group_by(DataselectStat.location)
-        if param_value_dict.get('level') == 'channel':
-            sqlreq = sqlreq.group_by(DataselectStat.channel)
-        if 'month' in param_value_dict['details']:
-            sqlreq = sqlreq.group_by(DataselectStat.date)
-        elif 'year' in param_value_dict['details']:
-            sqlreq = sqlreq.group_by('year')
-        if 'country' in param_value_dict['details']:
-            sqlreq = sqlreq.group_by(DataselectStat.country)
-        session.close()
-
-    except Exception as e:
-        log.error(str(e))
-        return Response("<h1>500 Internal Server Error</h1><p>Database connection error or invalid SQL statement passed to database</p>", status_code=500)
-
-    # get results as dictionaries
-    # assign '*' at aggregated parameters
-    log.debug('Getting the results')
-    results = []
-    restricted_results = {}
-    for row in sqlreq:
-        if row != (None, None, None, None):
-            rowToDict = DataselectStat.to_dict_for_human(row)
-            if not operator:
-                # if below datacenter level, check for networks that user has no access and group them in the no-access networks result item
-                if param_value_dict.get('level') in ['network', 'station', 'location', 'channel']:
-                    # first check if network is open
-                    restricted = isRestricted(request, internalCall=True, node=row.name, network=row.network)
-                    if restricted.status_code != 200:
-                        return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
-                    elif restricted.json['restricted'] == 'yes' and restricted.json['group'] not in tokenDict['memberof'].split(';'):
-                        log.debug('Grouping network as non-accessable in results')
-                        date = str(row.date)[:-3] if 'month' in param_value_dict['details'] else str(row.year)[:4] if 'year' in param_value_dict['details'] else '*'
-                        country = row.country if 'country' in param_value_dict['details'] else '*'
-                        if (date, country) in restricted_results:
-                            restricted_results[(date, country)]['bytes'] += int(row.bytes)
-                            restricted_results[(date, country)]['nb_reqs'] += row.nb_reqs
-                            restricted_results[(date, country)]['nb_successful_reqs'] += row.nb_successful_reqs
-                            restricted_results[(date, country)]['clients'].union(HLL.from_bytes(NumberUtil.from_hex(row.clients[2:], 0, len(row.clients[2:]))))
-                        else:
-                            restricted_results[(date, country)] = {'date':date, 'node':'Other', 'network':'Other', 'country':country,
-                                'station':'*', 'location':'*', 'channel':'*', 'bytes': 0, 'nb_reqs': 0, 'nb_successful_reqs': 0, 'clients': HLL(11,5)}
-                        continue
-
-            rowToDict = DataselectStat.to_dict_for_human(row)
-            rowToDict['date'] = str(row.date)[:-3] if 'month' in param_value_dict['details'] else\
-                                        str(row.year)[:4] if 'year' in param_value_dict['details'] else '*'
-            rowToDict['node'] = row.name if 'level' in param_value_dict else '*'
-            rowToDict['network'] = row.network if param_value_dict.get('level') in ['network', 'station', 'location', 'channel'] else '*'
-            rowToDict['station'] = row.station if param_value_dict.get('level') in ['station', 'location', 'channel'] else '*'
-            rowToDict['location'] = row.location if param_value_dict.get('level') in ['location', 'channel'] else '*'
-            rowToDict['channel'] = row.channel if param_value_dict.get('level') == 'channel' else '*'
-            rowToDict['country'] = row.country if 'country' in param_value_dict['details'] else '*'
-            rowToDict['clients'] = HLL.from_bytes(NumberUtil.from_hex(row.clients[2:], 0, len(row.clients[2:]))).cardinality()
-            # add hll_client field if hllvalues parameter is set to true
-            if param_value_dict.get('hllvalues') == 'true':
-                rowToDict['hll_clients'] = row.clients
-            results.append(rowToDict)
-
-    # calculate cardinalities for other items
-    for (k, v) in restricted_results.items():
-        # add hll_client field if hllvalues parameter is set to true
-        if param_value_dict.get('hllvalues') == 'true':
-            v['hll_clients'] = "\\x" + NumberUtil.to_hex(v['clients'].to_bytes(), 0, len(v['clients'].to_bytes()))
-        v['clients'] = v['clients'].cardinality()
-
-    # concatenate open and restricted results
-    results.extend(restricted_results.values())
-
-    # sort results by date
-    if 'details' in param_value_dict and any(x in param_value_dict['details'] for x in ['month', 'year']):
-        results = sorted(results, key=lambda x: x['date'])
-
-    # return json or csv with metadata
-    if param_value_dict.get('format') == 'json':
-        log.debug('Returning the results as JSON')
-        return Response(text=json.dumps({'version': '1.0.0', 'request_parameters': request.query_string, 'results': results}, default=str),
-                content_type='application/json', charset='utf-8')
-    else:
-        log.debug('Returning the results as CSV')
-        csvText = "# version: 1.0.0\n# request_parameters: " + request.query_string +\
-            "\ndate,node,network,station,location,channel,country,bytes,nb_reqs,nb_successful_reqs,clients"
-        for res in results:
-            csvText += '\n'
-            for field in res:
-                csvText += str(res[field]) + ','
-            csvText = csvText[:-1]
-        return Response(text=csvText, content_type='text/csv')
+    log.debug('Compiling the query')
+    query = compile_shape(query_shape(param_value_dict, hidden=None if operator else 'restricted'))
+    if 'cursor' in param_value_dict and (not query.keys or len(param_value_dict['cursor']) != len(query.keys)):
+        return Response("<h1>400 Bad Request</h1><p>Cursor does not match request parameters</p>", status_code=400)
+    values = bound_values(query, param_value_dict, memberof=tokenDict['memberof'].split(';'))
+    # pages and rankings are bounded, other results below network level are streamed with a server-side cursor
+    stream = 'limit' not in param_value_dict and 'n' not in param_value_dict and param_value_dict.get('level') in ['station', 'location', 'channel']
+    return Plan(param_value_dict, query, values, stream, None, None, None, compression.negotiate(request), None)
 
 
 @view_config(route_name='dataselectpublic', request_method='GET', openapi=True)
@@ -361,6 +387,96 @@ def public(request):
     """
 
     log.info(f"{request.method} {request.url}")
+    plan = plan_public(request)
+    return plan if isinstance(plan, Response) else run_plan(request, plan)
+
+
+@view_config(route_name='dataselecttop', request_method=('GET', 'POST'), openapi=True)
+def top(request):
+    """
+    Returns the statistics with the most bytes, requests or clients, in decreasing order
+    GET requests are checked as public requests, POST requests as restricted requests
+    Restricted networks hidden to the user are ranked together as 'Other'
+    """
+
+    log.info(f"{request.method} {request.url}")
+    plan = plan_restricted(request) if request.method == 'POST' else plan_public(request)
+    return plan if isinstance(plan, Response) else run_plan(request, plan)
+
+
+def plan_public(request):
+    """
+    Checks parameters of a public request, answers it from validators or cache if possible, or compiles its query
+    Returns the Plan of the request, or the response
+    """
+
+    param_value_dict = public_parameters(request)
+    if isinstance(param_value_dict, Response):
+        return param_value_dict
+
+    # make sure the in-memory restriction policies are up to date
+    try:
+        restriction_policies.refresh(request.dbsession)
+    except Exception as e:
+        log.error(str(e))
+        return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
+
+    response = check_public_network(request, param_value_dict)
+    if response is not None:
+        return response
+
+    # get the change watermark of the statistics covered by the request
+    try:
+        watermark = stats_watermark(request.dbsession, param_value_dict.get('node'), param_value_dict['start'], param_value_dict.get('end'))
+    except Exception as e:
+        log.error(str(e))
+        return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
+
+    # answer conditional requests without running the aggregation
+    # compressed and uncompressed representations have their own validators
+    encoding = compression.negotiate(request) if param_value_dict.get('format') not in ARROW_FORMATS else None
+    etag = hashlib.sha1(f"{request.query_string}|{restriction_policies.version}|{watermark.version}|{encoding}".encode('utf-8')).hexdigest()
+    last_modified = max([t for t in [watermark.updated_at, restriction_policies.updated_at] if t is not None], default=None)
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return encoded(response, None)
+
+    # serve the cached result items if the statistics they cover did not change since they were cached
+    # compressed bodies are cached whole, with the metadata of the request
+    if result_cache.enabled and param_value_dict.get('format') not in ARROW_FORMATS:
+        flags = (param_value_dict.get('format', 'csv'), param_value_dict.get('hllvalues', 'false'), restriction_policies.version)
+        scope = Scope(watermark.node_ids, param_value_dict['start'][:7], param_value_dict['end'][:7] if 'end' in param_value_dict else None)
+        cache_entry = (result_cache.key(param_value_dict, *flags), watermark.version, scope)
+        encoded_cache_entry = None
+        if encoding is not None:
+            encoded_cache_entry = (result_cache.key(param_value_dict, *flags, encoding, request.query_string), watermark.version, scope)
+            body = result_cache.get(*encoded_cache_entry[:2])
+            if body is not None:
+                log.debug('Returning cached compressed results')
+                response = Response(body=body, content_type='application/json' if param_value_dict.get('format') == 'json' else 'text/csv', charset='utf-8')
+                return set_validators(encoded(response, encoding), etag, last_modified)
+        body = result_cache.get(*cache_entry[:2])
+        if body is not None:
+            log.debug('Returning cached results')
+            return set_validators(results_response(request, param_value_dict, body=body, encoding=encoding,
+                        encoded_cache_entry=encoded_cache_entry), etag, last_modified)
+    else:
+        (cache_entry, encoded_cache_entry) = (None, None)
+
+    log.debug('Compiling the query')
+    query = compile_shape(query_shape(param_value_dict, hidden='public'))
+    values = bound_values(query, param_value_dict)
+    # node-level and total results are bounded by the number of nodes and use the prepared statement,
+    # network-level results are streamed with a server-side cursor
+    stream = param_value_dict.get('level') == 'network'
+    return Plan(param_value_dict, query, values, stream, cache_entry, etag, last_modified, encoding, encoded_cache_entry)
+
+
+def public_parameters(request):
+    """
+    Checks parameters of a public request
+    Returns the dictionary of parameters and values, or the error response
+    """
 
     # check parameters and values
     # return dictionary with parameters and values if acceptable
@@ -380,160 +496,127 @@ def public(request):
         return Response("<h1>500 Internal Server Error</h1>", status_code=500)
 
     log.info('Checked parameters of request')
+    return param_value_dict
 
-    # if network is specified, check if network is open at least in one node or restricted in all nodes
-    if 'network' in param_value_dict:
-        open = False
-        noEntry = True
-        nodes = param_value_dict.get('node')
-        # if no node is specified, get all available nodes from database
-        if nodes is None:
-            try:
-                nodes = [node['name'] for node in get_nodes(request, internalCall=True).json['nodes']]
-            except Exception as e:
-                raise Exception(e)
-        for n in nodes:
-            restricted = isRestricted(request, internalCall=True, node=n, network=param_value_dict['network'][0])
-            if restricted.status_code == 500:
-                return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
-            if restricted.status_code == 400:
-                continue
-            else:
-                noEntry = False
-            if restricted.json['restricted'] == 'no':
-                log.debug('Network is open at least in one node')
-                open = True
-                break
-        if noEntry:
-            return Response(f"<h1>400 Bad Request</h1><p>No entry that matches given node and network parameters</p>", status_code=400)
-        if not open:
-            log.debug('Network is restricted')
-            return Response("<h1>401 Unauthorized</h1><p>No access to restricted networks for non-authenticated users<br>"+\
-                    "If you are a member of EIDA consider using /restricted method instead</p>", status_code=401)
 
-        log.info('Checked network restriction')
+def check_public_network(request, param_value_dict):
+    """
+    Checks that the network of a public request, if specified, is open at least in one node
+    Restriction policies must be up to date
+    Returns the error response, None if the request can be answered
+    """
 
-    try:
-        log.debug('Connecting to db, SELECT and FROM clause')
-        session = Session()
-        sqlreq = session.query(DataselectStat).join(Node).with_entities()
-
-        # select needed columns depending on level and details
-        # return '*' for not selected columns meaning all matching instances
-        if 'level' in param_value_dict:
-            sqlreq = sqlreq.add_columns(Node.name)
-        if param_value_dict.get('level') == 'network':
-            sqlreq = sqlreq.add_columns(DataselectStat.network)
-        if 'month' in param_value_dict['details']:
-            sqlreq = sqlreq.add_columns(DataselectStat.date)
-        elif 'year' in param_value_dict['details']:
-            sqlreq = sqlreq.add_columns(extract('year', DataselectStat.date).label('year'))
-        if 'country' in param_value_dict['details']:
-            sqlreq = sqlreq.add_columns(DataselectStat.country)
-
-        # fields to be summed up
-        sqlreq = sqlreq.add_columns(func.sum(DataselectStat.nb_reqs).label('nb_reqs'),
-                    func.sum(DataselectStat.nb_successful_reqs).label('nb_successful_reqs'),
-                    func.sum(DataselectStat.bytes).label('bytes'), literal_column('hll_union_agg(dataselect_stats.clients)').label('clients'))
-
-        # where clause
-        log.debug('Making the WHERE clause')
-        if 'start' in param_value_dict:
-            sqlreq = sqlreq.filter(DataselectStat.date >= param_value_dict['start'])
-        if 'end' in param_value_dict:
-            sqlreq = sqlreq.filter(DataselectStat.date <= param_value_dict['end'])
-        if 'node' in param_value_dict:
-            sqlreq = sqlreq.filter(Node.name.in_(param_value_dict['node']))
-        if 'network' in param_value_dict:
-            sqlreq = sqlreq.filter(DataselectStat.network.in_(param_value_dict['network']))
-        if 'country' in param_value_dict:
-            sqlreq = sqlreq.filter(DataselectStat.country.in_(param_value_dict['country']))
-
-        # group_by clause for the details
-        log.debug('Making the GROUP BY clause')
-        if 'level' in param_value_dict:
-            sqlreq = sqlreq.group_by(Node.name)
-        if param_value_dict.get('level') == 'network':
-            sqlreq = sqlreq.group_by(DataselectStat.network)
-        if 'month' in param_value_dict['details']:
-            sqlreq = sqlreq.group_by(DataselectStat.date)
-        elif 'year' in param_value_dict['details']:
-            sqlreq = sqlreq.group_by('year')
-        if 'country' in param_value_dict['details']:
-            sqlreq = sqlreq.group_by(DataselectStat.country)
-        session.close()
+    if 'network' not in param_value_dict:
+        return None
+    open = False
+    noEntry = True
+    # if no node is specified, check all nodes
+    nodes = param_value_dict.get('node') or node_catalog.names(request.dbsession)
+    for policy in (p for n in nodes for p in restriction_policies.match(n, param_value_dict['network'][0])):
+        noEntry = False
+        if policy.restricted == 'no':
+            log.debug('Network is open at least in one node')
+            open = True
+            break
+    if noEntry:
+        return Response(f"<h1>400 Bad Request</h1><p>No entry that matches given node and network parameters</p>", status_code=400)
+    if not open:
+        log.debug('Network is restricted')
+        return Response("<h1>401 Unauthorized</h1><p>No access to restricted networks for non-authenticated users<br>"+\
+                "If you are a member of EIDA consider using /restricted method instead</p>", status_code=401)
+
+    log.info('Checked network restriction')
+    return None
+
+
+# maximum number of parameter sets of a batch request
+MAX_BATCH_QUERIES = 50
+
+
+@view_config(route_name='dataselectbatch', request_method='POST', openapi=True)
+def batch(request):
+    """
+    Returns public statistics of several requests at once, as a json document keyed by the names of the requests
+    Requests with the same filters, i.e. differing only in level and details, are answered from a single scan
+    Returns 400 bad request if the body is not a json object of named parameter sets
+    Invalid or unauthorized parameter sets get their own error in the document
+    """
 
+    log.info(f"{request.method} {request.url}")
+
+    # parameter sets are objects of parameter values, given as strings or lists of strings
+    try:
+        queries = request.json_body['queries']
+        if not isinstance(queries, dict) or not 0 < len(queries) <= MAX_BATCH_QUERIES or\
+                not all(isinstance(params, dict) and all(isinstance(v, str) or (isinstance(v, list) and all(isinstance(x, str) for x in v))
+                for v in params.values()) for params in queries.values()):
+            raise ValueError('queries')
+    except Exception:
+        return Response("<h1>400 Bad Request</h1><p>Body must be a json object whose 'queries' object maps "+\
+                f"at most {MAX_BATCH_QUERIES} names to objects of request parameters</p>", status_code=400)
+
+    # make sure the in-memory restriction policies are up to date
+    try:
+        restriction_policies.refresh(request.dbsession)
     except Exception as e:
         log.error(str(e))
-        return Response("<h1>500 Internal Server Error</h1><p>Database connection error or invalid SQL statement passed to database</p>", status_code=500)
+        return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
 
-    # get results as dictionaries
-    # assign '*' at non-selected columns
-    log.debug('Getting the results')
-    results = []
-    restricted_results = {}
-    for row in sqlreq:
-        if row != (None, None, None, None):
-            rowToDict = DataselectStat.to_dict_for_human(row)
-            # if below datacenter level, check for restricted networks and group them in the restricted networks result item
-            if param_value_dict.get('level') == 'network':
-                restricted = isRestricted(request, internalCall=True, node=row.name, network=row.network)
-                if restricted.status_code != 200:
-                    return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
-                elif restricted.json['restricted'] == 'yes':
-                    log.debug('Grouping network as restricted in results')
-                    date = str(row.date)[:-3] if 'month' in param_value_dict['details'] else str(row.year)[:4] if 'year' in param_value_dict['details'] else '*'
-                    country = row.country if 'country' in param_value_dict['details'] else '*'
-                    if (date, country) in restricted_results:
-                        restricted_results[(date, country)]['bytes'] += int(row.bytes)
-                        restricted_results[(date, country)]['nb_reqs'] += row.nb_reqs
-                        restricted_results[(date, country)]['nb_successful_reqs'] += row.nb_successful_reqs
-                        restricted_results[(date, country)]['clients'].union(HLL.from_bytes(NumberUtil.from_hex(row.clients[2:], 0, len(row.clients[2:]))))
-                    else:
-                        restricted_results[(date, country)] = {'date':date, 'node':'Other', 'network':'Other', 'country':country,
-                            'station':'*', 'location':'*', 'channel':'*', 'bytes': 0, 'nb_reqs': 0, 'nb_successful_reqs': 0, 'clients': HLL(11,5)}
-                    continue
-
-            rowToDict['date'] = str(row.date)[:-3] if 'month' in param_value_dict['details'] else\
-                                        str(row.year)[:4] if 'year' in param_value_dict['details'] else '*'
-            rowToDict['node'] = row.name if 'level' in param_value_dict else '*'
-            rowToDict['network'] = row.network if param_value_dict.get('level') == 'network' else '*'
-            rowToDict['country'] = row.country if 'country' in param_value_dict['details'] else '*'
-            rowToDict['station'] = '*'
-            rowToDict['location'] = '*'
-            rowToDict['channel'] = '*'
-            rowToDict['clients'] = HLL.from_bytes(NumberUtil.from_hex(row.clients[2:], 0, len(row.clients[2:]))).cardinality()
-            # add hll_client field if hllvalues parameter is set to true
-            if param_value_dict.get('hllvalues') == 'true':
-                rowToDict['hll_clients'] = row.clients
-            results.append(rowToDict)
-
-    # calculate cardinalities for other items
-    for (k, v) in restricted_results.items():
-        # add hll_client field if hllvalues parameter is set to true
-        if param_value_dict.get('hllvalues') == 'true':
-            v['hll_clients'] = "\\x" + NumberUtil.to_hex(v['clients'].to_bytes(), 0, len(v['clients'].to_bytes()))
-        v['clients'] = v['clients'].cardinality()
+    # check each parameter set as a /dataselect/public request
+    # and group the valid ones by filters, each group is answered by one statement
+    documents = {}
+    groups = {}
+    for (name, params) in queries.items():
+        subrequest = Request.blank(request.route_path('dataselectpublic'), query_string=urlencode(params, doseq=True))
+        subrequest.dbsession = request.dbsession
+        documents[name] = {'request_parameters': subrequest.query_string}
+        param_value_dict = public_parameters(subrequest)
+        if isinstance(param_value_dict, Response):
+            documents[name]['error'] = batch_error(param_value_dict)
+            continue
+        response = check_public_network(subrequest, param_value_dict)
+        if response is None and param_value_dict.get('format', 'json') != 'json':
+            response = Response("<h1>400 Bad Request</h1><p>Batch results are only available as json</p>", status_code=400)
+        if response is not None:
+            documents[name]['error'] = batch_error(response)
+            continue
+        filters = tuple((f, str(param_value_dict[f])) for (f, _) in FILTERS if f in param_value_dict)
+        groups.setdefault(filters, []).append((name, param_value_dict))
+
+    log.debug(f"Answering {len(queries)} requests with {len(groups)} statements")
+    for group in groups.values():
+        shapes = tuple(query_shape(param_value_dict, hidden='public') for (_, param_value_dict) in group)
+        (query, sets) = compile_batch(shapes)
+        try:
+            rows = execute(request.dbsession, query, bound_values(query, group[0][1])).all()
+        except Exception as e:
+            log.error(str(e))
+            return Response("<h1>500 Internal Server Error</h1><p>Database connection error or invalid SQL statement passed to database</p>", status_code=500)
+        for ((name, param_value_dict), s, (mask, positions)) in zip(group, shapes, sets):
+            labels = [label for (_, label, _) in ordering_keys(s)]
+            selected = [grouped_row(row, labels, positions) for row in rows if row.grouping_mask == mask]
+            if s.date:
+                selected.sort(key=lambda row: getattr(row, labels[0]))
+            documents[name]['results'] = list(results_items(selected, param_value_dict))
+
+    body = json.dumps({'version': VERSION, 'results': documents}, default=str)
+    return Response(body=body.encode('utf-8'), content_type='application/json', charset='utf-8')
+
+
+def batch_error(response):
+    """
+    Returns the error of a parameter set of a batch request, from its error response
+    """
 
-    # concatenate open and restricted results
-    results.extend(restricted_results.values())
+    return {'status': response.status_code, 'message': re.sub(r'<[^>]+>', ' ', response.text).strip()}
 
-    # sort results by date
-    if 'details' in param_value_dict and any(x in param_value_dict['details'] for x in ['month', 'year']):
-        results = sorted(results, key=lambda x: x['date'])
 
-    # return json or csv with metadata
-    if param_value_dict.get('format') == 'json':
-        log.debug('Returning the results as JSON')
-        return Response(text=json.dumps({'version': '1.0.0', 'request_parameters': request.query_string, 'results': results}, default=str),
-                content_type='application/json', charset='utf-8')
-    else:
-        log.debug('Returning the results as CSV')
-        csvText = "# version: 1.0.0\n# request_parameters: " + request.query_string +\
-            "\ndate,node,network,station,location,channel,country,bytes,nb_reqs,nb_successful_reqs,clients"
-        for res in results:
-            csvText += '\n'
-            for field in res:
-                csvText += str(res[field]) + ','
-            csvText = csvText[:-1]
-        return Response(text=csvText, content_type='text/csv')
+def grouped_row(row, labels, positions):
+    """
+    Returns the row of a batch statement with the labels of the ordering keys of a request,
+    as expected by results_items
+    """
+
+    values = {label: getattr(row, f'c{position}') for (label, position) in zip(labels, positions)}
+    return SimpleNamespace(nb_reqs=row.nb_reqs, nb_successful_reqs=row.nb_successful_reqs, bytes=row.bytes,
+                           clients_cardinality=row.clients_cardinality, clients=getattr(row, 'clients', None), **values)
@@ -3,7 +3,8 @@ from pyramid.view import view_config
 import os
 import re
 from ws_eidastats.model import Node, Network
-from ws_eidastats.helper_functions import check_authentication, log, Session
+from ws_eidastats.helper_functions import check_authentication, log
+from ws_eidastats.restriction_policies import restriction_policies
 
 
 @view_config(route_name='isrestricted', request_method='GET')
@@ -27,24 +28,16 @@ def isRestricted(request, internalCall=False, node=None, network=None):
         network = request.params.get('network')
 
     try:
-        session = Session()
-        sqlreq = session.query(Network).join(Node).with_entities(Node.restriction_policy, Network.inverted_policy, Network.eas_group)
-        sqlreq = sqlreq.filter(Node.name == node).filter(Network.name == network).first()
-        session.close()
+        restriction_policies.refresh(request.dbsession)
+        policy = restriction_policies.get(node, network)
 
     except Exception as e:
         log.error(str(e))
         return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
 
-    row = sqlreq
-    if not row:
+    if not policy:
         return Response(f"<h1>400 Bad Request</h1><p>No entry that matches given node and network parameters</p>", status_code=400)
-    if any(x is None for x in [row.restriction_policy, row.inverted_policy]):
-        return Response(json={"restricted": "not yet defined", "group":row.eas_group}, content_type='application/json')
-    elif int(row.restriction_policy)^int(row.inverted_policy):
-        return Response(json={"restricted": "yes", "group":row.eas_group}, content_type='application/json')
-    else:
-        return Response(json={"restricted": "no", "group":row.eas_group}, content_type='application/json')
+    return Response(json={"restricted": policy.restricted, "group": policy.group}, content_type='application/json')
 
 
 @view_config(route_name='noderestriction', request_method='GET')
@@ -67,9 +60,7 @@ def node_restriction_policy(request):
     log.info('Checked parameters')
 
     try:
-        session = Session()
-        sqlreq = session.query(Node).filter(Node.name == request.params.get('node')).first()
-        session.close()
+        sqlreq = request.dbsession.query(Node).filter(Node.name == request.params.get('node')).first()
     except Exception as e:
         log.error(str(e))
         return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
@@ -102,10 +93,8 @@ def network_restriction_policy(request):
     log.info('Checked parameters')
 
     try:
-        session = Session()
-        sqlreq = session.query(Node).join(Network).with_entities(Network.inverted_policy, Network.eas_group)
+        sqlreq = request.dbsession.query(Node).join(Network).with_entities(Network.inverted_policy, Network.eas_group)
         sqlreq = sqlreq.filter(Node.name == request.params.get('node')).filter(Network.name == request.params.get('network')).first()
-        session.close()
     except Exception as e:
         log.error(str(e))
         return Response("<h1>500 Internal Server Error</h1><p>Database connection error</p>", status_code=500)
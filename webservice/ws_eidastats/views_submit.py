@@ -1,14 +1,14 @@
 from pyramid.response import Response
 from pyramid.view import view_config
-from datetime import datetime
-import json
-import mmh3
-from ws_eidastats.helper_functions import log, Session
+from ws_eidastats.helper_functions import log
+from ws_eidastats.ingest import ingest, DuplicatePayload, OverlappingPayload
+from ws_eidastats.ingest_queue import ingest_queue, QueueFull, PayloadTooLarge
+from ws_eidastats.payload import PayloadReader, PayloadError, body_stream
 from sqlalchemy import exc
 from sqlalchemy.sql import text
 
 
-def get_node_from_token(token):
+def get_node_from_token(session, token):
     """
     Returns the node name for a given token.
     Checks if the token is valid.
@@ -18,13 +18,11 @@ def get_node_from_token(token):
     node = ""
     node_id = 0
     try:
-        session = Session()
         sqlreq = session.execute(text("SELECT nodes.name, nodes.id from nodes join tokens on nodes.id = tokens.node_id where tokens.value=:tok and now() between tokens.valid_from and tokens.valid_until"), {'tok':token}).first()
         if sqlreq:
             node, node_id = sqlreq
         else:
             raise ValueError("No valid token found")
-        session.close()
 
     except exc.DBAPIError as err:
         log.error("Postgresql error %s getting node from token", err.orig.pgcode)
@@ -34,172 +32,97 @@ def get_node_from_token(token):
     return node_id
 
 
-def check_payload(payload):
+def authenticated_node(request):
     """
-    Checks the payload format before trying to insert
+    Returns the id of the node whose token is given in the Authentication header of the request,
+    or the error response to return
     """
-    check_stats = True
-    check_metadata = 'generated_at' in payload.keys() and 'version' in payload.keys() and 'stats' in payload.keys() and 'days_coverage' in payload.keys()
-    if check_metadata:
-        for stat in payload['stats']:
-            if 'month' in stat.keys() and 'clients' in stat.keys() and 'network' in stat.keys():
-                continue
-            check_stats = False
-    return check_metadata and check_stats
-
-
-def register_payload(node_id, payload):
-    """
-    Register payload to database
-    """
-    coverage = sorted([ datetime.strptime(v, '%Y-%m-%d') for v in payload['days_coverage'] ])
-    log.debug(coverage)
+    log.info("Verifying token")
+    if request.headers.get('Authentication') is None:
+        return Response(text="No token provided. Permission denied", status_code=401, content_type='text/plain')
+    log.debug("Headers: %s", request.headers.get('Authentication'))
     try:
-        session = Session()
-        # Insert bulk
-        session.execute(text("INSERT INTO payloads (node_id, hash, version, generated_at, coverage)  VALUES (:n, :h, :v, :g, :c)"),
-        {'n':node_id, 'h':mmh3.hash(str(payload['stats'])), 'v':payload['version'], 'g':payload['generated_at'], 'c':coverage})
-        session.commit()
-        session.close()
-    except exc.DBAPIError as err:
-        log.error("Postgresql error %s registering payload", err.orig.pgcode)
-        log.error(err.orig.pgerror)
-        if err.orig.pgcode == '23505':
-            log.error("Duplicate payload")
-            raise ValueError
-        raise err
+        return get_node_from_token(request.dbsession, request.headers.get('Authentication').split(' ')[1])
+    except ValueError:
+        return Response(text="No valid token provided", status_code=403, content_type='text/plain')
+    except exc.DBAPIError:
+        return Response(text="Internal error", status_code=500, content_type='text/plain')
 
 
-def register_statistics(statistics, node_id, operation='POST'):
+def enqueue_stat(request, node_id):
     """
-    Connects to the database and insert or update statistics
-    params:
-    - statistics is a list of dictionaries of all statistics, mapping to the table dataselect_stats schema but without the node_id
-    - operation is the method POST of PUT
-    Note: If statistics with a new network are to be inserted, an SQL trigger function takes care of inserting
-    the appropriate necessary record at networks table first
+    Queues the posted statistic for ingestion by the ingestion workers
     """
-    if operation == 'POST':
-        sqlreq = text("""
-                INSERT INTO dataselect_stats
-                (
-                  node_id, date, network, station, location, channel, country,
-                  bytes, nb_reqs, nb_successful_reqs, nb_failed_reqs, clients
-                )
-                VALUES :values_list ON CONFLICT ON CONSTRAINT uniq_stat DO UPDATE SET
-                bytes = EXCLUDED.bytes + dataselect_stats.bytes,
-                nb_reqs = EXCLUDED.nb_reqs + dataselect_stats.nb_reqs,
-                nb_successful_reqs = EXCLUDED.nb_successful_reqs + dataselect_stats.nb_successful_reqs,
-                nb_failed_reqs = EXCLUDED.nb_failed_reqs + dataselect_stats.nb_failed_reqs,
-                clients = EXCLUDED.clients || dataselect_stats.clients,
-                updated_at = now()
-                """)
-    elif operation == 'PUT':
-        sqlreq = text("""
-                INSERT INTO dataselect_stats
-                (
-                  node_id, date, network, station, location, channel, country,
-                  bytes, nb_reqs, nb_successful_reqs, nb_failed_reqs, clients
-                )
-                VALUES :values_list ON CONFLICT ON CONSTRAINT uniq_stat DO UPDATE SET
-                bytes = EXCLUDED.bytes,
-                nb_reqs = EXCLUDED.nb_reqs,
-                nb_successful_reqs = EXCLUDED.nb_successful_reqs,
-                nb_failed_reqs = EXCLUDED.nb_failed_reqs,
-                clients = EXCLUDED.clients,
-                created_at = now()
-                """)
-    else:
-        log.error("Operation %s not supported (POST or PUT only)")
-        raise ValueError
-
-    values_list = []
-    # Normalize some keys
-    for item in statistics:
-        log.debug("item: %s", item)
-        if 'country' not in item.keys() or item['country'] is None or len(item['country']) != 2:
-            log.debug("Fixing country")
-            item['country'] = ''
-        # if unsuccessful requests in Null, set it to 0
-        if 'nb_unsuccessful_requests' not in item.keys() or item['nb_unsuccessful_requests'] is None:
-            log.debug("Fixing nb_unsuccessful_requests")
-            item['nb_unsuccessful_requests'] = 0
-        # if successful requests is Null, set it to nb_requests+nb_unsuccessful_requests
-        if 'nb_requests' not in item.keys() or item['nb_requests'] is None:
-            log.debug("Fixing nb_requests")
-            item['nb_requests'] = item['nb_successful_requests'] + item['nb_unsuccessful_requests']
-
-        # Add the nodeid to all elements of payload.
-        # Convert list of dictionary to list of list
-        values_list.append((
-            node_id, item['month'], item['network'], item['station'], item['location'], item['channel'], item['country'],
-            item['bytes'], item['nb_requests'], item['nb_successful_requests'], item['nb_unsuccessful_requests'], item['clients']
-        ))
-    log.info(f"Registering {len(values_list)} statistics.")
+    too_large = Response(text=f"Statistics larger than {ingest_queue.max_bytes} bytes can not be queued", status_code=413, content_type='text/plain')
+    if request.content_length is not None and request.content_length > ingest_queue.max_bytes:
+        return too_large
     try:
-        session = Session()
-        # Insert bulk
-        session.execute(sqlreq, [{'values_list':vl} for vl in values_list])
-        session.commit()
-        session.close()
-    except exc.DBAPIError as err:
-        log.error("Postgresql error %s registering statistic", err.orig.pgcode)
-        log.error(err.orig.pgerror)
-        raise err
-    log.info(f"Statistics successfully registered")
+        job_id = ingest_queue.enqueue(request.dbsession, node_id, request.method, request.body_file)
+    except QueueFull:
+        response = Response(text="Too many statistics waiting for ingestion, retry later", status_code=429, content_type='text/plain')
+        response.headers['Retry-After'] = str(ingest_queue.retry_after)
+        return response
+    except PayloadTooLarge:
+        return too_large
+    except Exception as e:
+        log.error(e)
+        return Response(text="Error on statistics queueing. Please contact the maintainer of the service.", status_code=500, content_type='text/plain')
+    response = Response(json_body={'job': job_id, 'status': 'queued'}, status_code=202)
+    response.headers['Location'] = request.route_url('submitjob', id=job_id)
+    response.headers['Preference-Applied'] = 'respond-async'
+    return response
+
 
 @view_config(route_name='submitstat')
 def add_stat(request):
     """
     Adding the posted statistic to the database
+    With a Prefer: respond-async header, and a spool directory configured, the statistic is queued instead
     """
     log.info(f"{request.method} {request.url}")
     if request.method == 'GET':
         log.info(f"Method {request.method} not allowed")
         return Response(text="Only PUT or POST method allowed.", status_code=405, content_type='text/plain')
 
-    log.info("Verifying token")
+    node_id = authenticated_node(request)
+    if isinstance(node_id, Response):
+        return node_id
 
-    # Check authentication token
-    if request.headers.get('Authentication') is not None:
-        log.debug("Headers: %s", request.headers.get('Authentication'))
-        try:
-            node_id = get_node_from_token(request.headers.get('Authentication').split(' ')[1])
-        except ValueError:
-            return Response(text="No valid token provided", status_code=403, content_type='text/plain')
-        except exc.DBAPIError:
-            return Response(text="Internal error", status_code=500, content_type='text/plain')
-    else:
-        return Response(text="No token provided. Permission denied", status_code=401, content_type='text/plain')
+    if ingest_queue.enabled and 'respond-async' in request.headers.get('Prefer', ''):
+        log.info("Token verified. Queueing payload")
+        return enqueue_stat(request, node_id)
 
     log.info("Token verified. Analysing payload")
-    # Analyse payload
-    try:
-        payload = request.json
-        log.debug("Data is JSON")
-    except:
-        log.debug("Data is sent as other content type. Try to load as JSON")
-        try:
-            payload = json.loads(request.body)
-        except Exception as err:
-            log.error(request.body)
-            log.error(err)
-            return Response(text="Data can not be parsed as JSON format", status_code=400, content_type='text/plain')
-
-    if not check_payload(payload):
-        return Response(text="Malformed payload", status_code=400, content_type='text/plain')
+    # The payload is read, checked and ingested as it is received
     try:
         log.info("Registering statistics")
-        register_payload(node_id, payload)
-    except exc.DBAPIError:
-        return Response(text="Internal error", status_code=500, content_type='text/plain')
-    except ValueError:
+        ingest(request.dbsession, node_id, PayloadReader(body_stream(request)).payload, operation=request.method)
+    except PayloadError as err:
+        return Response(text=str(err), status_code=400, content_type='text/plain')
+    except DuplicatePayload:
         return Response(text="This statistic already exists on the server. Refusing to merge", status_code=400, content_type='text/plain')
-
-    try:
-      register_statistics(payload['stats'], node_id=node_id, operation=request.method)
+    except OverlappingPayload as err:
+        return Response(text=str(err), status_code=409, content_type='text/plain')
     except Exception as e:
         log.error(e)
         return Response(text="Error on statistics ingestion. Please contact the maintainer of the service.", status_code=500, content_type='text/plain')
 
     return Response(text="Statistic successfully ingested to database!", content_type='text/plain')
+
+
+@view_config(route_name='submitjob', request_method='GET')
+def job_status(request):
+    """
+    Returns the status of an ingestion job of the node of the token
+    """
+    node_id = authenticated_node(request)
+    if isinstance(node_id, Response):
+        return node_id
+    try:
+        job_id = int(request.matchdict['id'])
+    except ValueError:
+        return Response(text="Invalid job id", status_code=400, content_type='text/plain')
+    status = ingest_queue.status(request.dbsession, node_id, job_id)
+    if status is None:
+        return Response(text="No such job for this node", status_code=404, content_type='text/plain')
+    return Response(json_body=status)
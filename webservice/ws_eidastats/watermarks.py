@@ -0,0 +1,54 @@
+from collections import namedtuple
+from sqlalchemy.sql import text
+
+
+# node_ids are the ids of the nodes covered by a request
+# version is the latest change version of the covered nodes and months, 0 if none
+# updated_at is the timestamp of that latest change, None if none
+Watermark = namedtuple('Watermark', ['node_ids', 'version', 'updated_at'])
+
+POLICY_WATERMARK_SQL = text("SELECT version, updated_at FROM restriction_policy_version")
+
+WATERMARK_SQL = text("""
+        SELECT nodes.id, max(w.version), max(w.updated_at)
+        FROM nodes LEFT JOIN stats_watermarks w
+        ON w.node_id = nodes.id
+        AND (CAST(:start AS date) IS NULL OR w.date >= CAST(:start AS date))
+        AND (CAST(:end AS date) IS NULL OR w.date <= CAST(:end AS date))
+        WHERE CAST(:nodes AS text[]) IS NULL OR nodes.name = ANY(CAST(:nodes AS text[]))
+        GROUP BY nodes.id
+        """)
+
+BUMP_SQL = text("""
+        INSERT INTO stats_watermarks (node_id, date)
+        SELECT :node_id, d FROM unnest(CAST(:dates AS date[])) AS d
+        ON CONFLICT (node_id, date) DO UPDATE SET
+        version = nextval('stats_watermarks_version_seq'),
+        updated_at = now()
+        """)
+
+
+def policy_watermark(session):
+    """
+    Returns the version and the timestamp of the last change of the nodes or networks tables
+    """
+    return tuple(session.execute(POLICY_WATERMARK_SQL).first())
+
+
+def stats_watermark(session, nodes=None, start=None, end=None):
+    """
+    Returns the Watermark of the statistics of the given nodes (all if None) between start and end months (included)
+    Costs one lookup on the small stats_watermarks table
+    """
+    rows = session.execute(WATERMARK_SQL, {'nodes': nodes, 'start': start, 'end': end}).all()
+    versions = [v for (_, v, _) in rows if v is not None]
+    timestamps = [t for (_, _, t) in rows if t is not None]
+    return Watermark(frozenset(i for (i, _, _) in rows), max(versions, default=0), max(timestamps, default=None))
+
+
+def bump_watermarks(session, node_id, months):
+    """
+    Marks the statistics of the given node and months as changed
+    To be executed in the transaction that changes the statistics
+    """
+    session.execute(BUMP_SQL, {'node_id': node_id, 'dates': sorted(set(months))})